@@ -0,0 +1,356 @@
+"""
+Admission control: concurrency limits and token-bucket rate limits
+A Limiter guards one kind of work (uploads, thumbnail runs, ffmpeg runs). Each
+piece of work takes one of a fixed number of slots and a token from a global
+bucket and, for requests, from the bucket of its client; buckets refill at a
+steady rate and save up to a burst. Requests that can't be admitted are
+turned away with a reason and a retry delay, background work waits for its
+turn instead. Limits hold for the whole host: slots are locked files and the
+buckets live in a memory-mapped file, both in RMUSIC_ADMISSION_DIR, so every
+gunicorn worker and pool process counts against the same limits. The locks of
+a process that dies are released with it. Without fcntl (Windows) the limits
+are per process.
+This module must stay importable without Flask so it can run in a process pool
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no file locks, limits are kept per process
+
+ADMISSION_DIR = os.environ.get('RMUSIC_ADMISSION_DIR', 'admission')
+BURST_SECONDS = 2  # default burst: this many seconds' worth of tokens
+CLIENT_RECORDS = 4096  # client buckets kept; a client whose record was reused starts with a full burst
+HOLD_SMOOTHING = 0.2  # weight of the latest slot hold time in its running average
+INITIAL_HOLD_SECONDS = 1.0  # hold time assumed until a slot has been released
+SHARED_POLL_SECONDS = 0.5  # waiting work checks this often for slots freed by other processes
+
+# Why work was turned away: a status for requests and the seconds to wait
+Rejection = namedtuple('Rejection', 'status reason retry_after')
+
+# State file: the global bucket and the average hold time, then one record per client bucket
+HEADER = struct.Struct('<ddd')  # tokens, updated, hold seconds
+CLIENT = struct.Struct('<Qdd')  # client key, tokens, updated
+
+_limiters = {}
+
+
+class TokenBucket:
+    """rate tokens a second, saved up to burst; callers do the locking
+
+    updated is 0 for a bucket that was never used, which starts full.
+    """
+
+    def __init__(self, rate, burst, tokens=0.0, updated=0.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = tokens
+        self.updated = updated
+
+    def _refill(self, now):
+        if not self.updated:
+            self.tokens = self.burst
+        else:
+            # Wall clock time is shared by all processes; never refill backwards
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Take a token; returns 0 when there was one, else the seconds until there is"""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def level(self, now):
+        self._refill(now)
+        return self.tokens
+
+
+class _SharedFile:
+    """A file of one limiter in ADMISSION_DIR, reopened after a fork
+
+    A forked child shares the parent's open file descriptions, and with them
+    their locks, so it opens its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def fd(self):
+        if self._pid != os.getpid():
+            if self._fd is not None:
+                os.close(self._fd)
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+        return self._fd
+
+
+class _State:
+    """The bucket records of a limiter, in a shared file or, without fcntl, in memory"""
+
+    def __init__(self, path, client_records):
+        self.size = HEADER.size + client_records * CLIENT.size
+        self._file = _SharedFile(path) if fcntl else None
+        self._buffer = None if fcntl else bytearray(self.size)
+        self._pid = None
+
+    @contextmanager
+    def locked(self):
+        """The state buffer, held exclusively by this process; callers hold the limiter lock"""
+        if self._file is None:
+            yield self._buffer
+            return
+
+        fd = self._file.fd()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if self._pid != os.getpid():
+                if os.fstat(fd).st_size < self.size:
+                    os.ftruncate(fd, self.size)
+                self._buffer = mmap.mmap(fd, self.size)
+                self._pid = os.getpid()
+            yield self._buffer
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class _Slots:
+    """count concurrency slots: a file per slot, held while it's locked
+
+    Slots are interchangeable, so any slot this process holds can be given
+    back for any of its work. Callers hold the limiter lock.
+    """
+
+    def __init__(self, path, count):
+        self.count = count
+        self._files = [_SharedFile(f"{path}.slot-{number}") for number in range(count)] if fcntl else None
+        self._held = set()  # slot numbers locked by this process
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # The child doesn't hold its parent's slots
+        if self._pid != os.getpid():
+            self._held = set()
+            self._pid = os.getpid()
+
+    def _try_lock(self, number):
+        if self._files is None:
+            return True
+        try:
+            fcntl.flock(self._files[number].fd(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def take(self):
+        """Lock a free slot; False when all of them are taken"""
+        self._check_fork()
+        for number in range(self.count):
+            if number not in self._held and self._try_lock(number):
+                self._held.add(number)
+                return True
+        return False
+
+    def give_back(self):
+        self._check_fork()
+        if not self._held:
+            return
+        number = self._held.pop()
+        if self._files is not None:
+            fcntl.flock(self._files[number].fd(), fcntl.LOCK_UN)
+
+    def active(self):
+        """Slots held by any process"""
+        self._check_fork()
+        active = len(self._held)
+        for number in range(self.count):
+            if number not in self._held and self._files is not None:
+                if self._try_lock(number):
+                    fcntl.flock(self._files[number].fd(), fcntl.LOCK_UN)
+                else:
+                    active += 1
+        return active
+
+    def held(self):
+        self._check_fork()
+        return len(self._held)
+
+
+class Limiter:
+    """Concurrency slots plus global and per-client token buckets for one kind of work
+
+    A limit that is None or 0 isn't enforced. Bursts default to BURST_SECONDS
+    of the rate.
+    """
+
+    def __init__(self, name, concurrency=None, rate=None, burst=None, client_rate=None, client_burst=None):
+        self.name = name
+        self.concurrency = concurrency or None
+        self.rate = rate or None
+        self.burst = burst or max(1, (rate or 0) * BURST_SECONDS)
+        self.client_rate = client_rate or None
+        self.client_burst = client_burst or max(1, (client_rate or 0) * BURST_SECONDS)
+        path = os.path.join(ADMISSION_DIR, name)
+        self._state = _State(path, CLIENT_RECORDS if self.client_rate else 0)
+        self._slots = _Slots(path, self.concurrency) if self.concurrency else None
+        self._condition = threading.Condition()
+        self._waiting = 0
+        self._rejected = {}
+        _limiters[name] = self
+
+    def _client_offset(self, client):
+        """Record of a client's bucket and the key telling whose it is"""
+        digest = hashlib.blake2b(str(client).encode('utf-8'), digest_size=8).digest()
+        key = int.from_bytes(digest, 'little') or 1
+        return HEADER.size + (key % CLIENT_RECORDS) * CLIENT.size, key
+
+    def _take(self, client):
+        """Take a slot and the tokens, or return why not; called with the lock held"""
+        with self._state.locked() as state:
+            tokens, updated, hold_seconds = HEADER.unpack_from(state)
+            hold_seconds = hold_seconds or INITIAL_HOLD_SECONDS
+            if self._slots and not self._slots.take():
+                # Slots free up about every average hold time / slot count
+                return Rejection(503, 'busy', hold_seconds / self.concurrency)
+
+            now = time.time()
+            client_bucket = None
+            if client is not None and self.client_rate:
+                offset, key = self._client_offset(client)
+                record_key, client_tokens, client_updated = CLIENT.unpack_from(state, offset)
+                if record_key != key:
+                    # A new client, or one whose record was taken over
+                    client_tokens, client_updated = 0.0, 0.0
+                client_bucket = TokenBucket(self.client_rate, self.client_burst, client_tokens, client_updated)
+                wait = client_bucket.take(now)
+                CLIENT.pack_into(state, offset, key, client_bucket.tokens, client_bucket.updated)
+                if wait:
+                    self._give_back_slot()
+                    return Rejection(429, 'client_rate', wait)
+
+            if self.rate:
+                bucket = TokenBucket(self.rate, self.burst, tokens, updated)
+                wait = bucket.take(now)
+                HEADER.pack_into(state, 0, bucket.tokens, bucket.updated, hold_seconds)
+                if wait:
+                    # The client didn't get in, it keeps its token
+                    if client_bucket:
+                        client_bucket.give_back()
+                        CLIENT.pack_into(state, offset, key, client_bucket.tokens, client_bucket.updated)
+                    self._give_back_slot()
+                    return Rejection(503, 'rate', wait)
+
+        return None
+
+    def _give_back_slot(self):
+        if self._slots:
+            self._slots.give_back()
+
+    def admit(self, client=None):
+        """Take a slot without waiting; returns None when admitted, else a Rejection"""
+        with self._condition:
+            rejection = self._take(client)
+            if rejection:
+                self._rejected[rejection.reason] = self._rejected.get(rejection.reason, 0) + 1
+        if rejection:
+            metrics.ADMISSION_REJECTED.inc(limiter=self.name, reason=rejection.reason)
+        return rejection
+
+    def acquire(self):
+        """Wait until a slot and a token are free and take them"""
+        with self._condition:
+            self._waiting += 1
+            try:
+                while True:
+                    rejection = self._take(None)
+                    if rejection is None:
+                        return
+                    # Woken early when a slot of this process is released; slots of
+                    # other processes are looked for every SHARED_POLL_SECONDS
+                    self._condition.wait(min(rejection.retry_after, SHARED_POLL_SECONDS))
+            finally:
+                self._waiting -= 1
+
+    def release(self, held_seconds=None):
+        """Give a slot back; held_seconds feeds the Retry-After estimate of busy rejections"""
+        with self._condition:
+            self._give_back_slot()
+            if held_seconds is not None:
+                with self._state.locked() as state:
+                    tokens, updated, hold_seconds = HEADER.unpack_from(state)
+                    hold_seconds = hold_seconds or INITIAL_HOLD_SECONDS
+                    hold_seconds += HOLD_SMOOTHING * (held_seconds - hold_seconds)
+                    HEADER.pack_into(state, 0, tokens, updated, hold_seconds)
+            self._condition.notify()
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot for a block of work, waiting for one first"""
+        with metrics.stage(f'{self.name}_wait'):
+            self.acquire()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def active(self):
+        """Slots in use by all processes"""
+        with self._condition:
+            return self._slots.active() if self._slots else 0
+
+    def occupancy(self):
+        """Slots in use and waited for, tokens left and rejections so far
+
+        active and tokens are host-wide, the rest is this process's.
+        """
+        with self._condition:
+            with self._state.locked() as state:
+                tokens, updated, hold_seconds = HEADER.unpack_from(state)
+            bucket = TokenBucket(self.rate, self.burst, tokens, updated) if self.rate else None
+            return {
+                'active': self._slots.active() if self._slots else 0,
+                'held_here': self._slots.held() if self._slots else 0,
+                'concurrency': self.concurrency,
+                'waiting': self._waiting,
+                'rate': self.rate,
+                'tokens': round(bucket.level(time.time()), 2) if bucket else None,
+                'client_rate': self.client_rate,
+                'hold_seconds': round(hold_seconds or INITIAL_HOLD_SECONDS, 3),
+                'rejected': dict(self._rejected),
+                'shared': fcntl is not None,
+            }
+
+
+def occupancy():
+    """Occupancy of every limiter of this process, by name"""
+    return {name: limiter.occupancy() for name, limiter in sorted(_limiters.items())}
+
+
+metrics.Gauge(
+    'rmusic_admission_active', 'Slots in use per limiter, by all processes', ('limiter',),
+    collect=lambda: {(name,): limiter.active() for name, limiter in _limiters.items()}
+)
+metrics.Gauge(
+    'rmusic_admission_waiting', 'Background work of this process waiting for a slot per limiter', ('limiter',),
+    collect=lambda: {(name,): limiter._waiting for name, limiter in _limiters.items()}
+)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Asyncio serving mode for many concurrent players
+/video, /thumb, /waveform and /hls are answered on the event loop: byte
+ranges are read in blocks by a small thread pool and sent as the client takes
+them, so an open stream costs a coroutine instead of a worker thread and
+thousands of idle or slow clients fit in a few processes. Every other route
+runs the Flask app in a thread pool through a WSGI bridge that streams request
+and response bodies, which keeps its SQLite queries and ffmpeg runs off the
+event loop.
+Remote stores (RMUSIC_STORAGE=s3) and the proxy serving modes (x-accel,
+x-sendfile) go through the bridge too, those responses carry no file bytes.
+The launcher needs uvicorn (see requirements.txt); any ASGI server can run
+asgi:app, e.g. gunicorn -k uvicorn.workers.UvicornWorker -w 4 asgi:app
+Usage: python asgi.py [--host HOST] [--port PORT] [--workers N]
+"""
+
+import argparse
+import asyncio
+import os
+import stat
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Response
+
+import layout
+import logs
+import metrics
+import server
+from delivery import file_response
+
+ASGI_WORKERS = int(os.environ.get('RMUSIC_ASGI_WORKERS', min(4, os.cpu_count() or 1)))  # processes
+WSGI_THREADS = int(os.environ.get('RMUSIC_ASGI_THREADS', 32))  # Flask requests running at once, per process
+FILE_READ_THREADS = 16  # blocks read from disk at once, per process
+KEEP_ALIVE_SECONDS = 75  # idle keep-alive connections are closed after this long
+BACKLOG = 4096  # connections waiting to be accepted
+NATIVE_MODES = ('python', 'sendfile')  # serving modes in which the app sends the bytes itself
+SERVER_HEADERS = (b'date', b'server')  # set by the ASGI server, dropped from the app's responses
+
+# Routes answered on the event loop: prefix, route label, kind, not-found message
+NATIVE_ROUTES = (
+    ('/video/', '/video/<filename>', 'video', 'Video not found'),
+    ('/thumb/', '/thumb/<filename>', 'thumbnail', 'Thumbnail not found'),
+    ('/waveform/', '/waveform/<filename>', 'waveform', 'Waveform not found'),
+    ('/hls/', '/hls/<path:filename>', 'hls', 'HLS file not found'),
+)
+
+_wsgi_executor = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+_file_executor = ThreadPoolExecutor(FILE_READ_THREADS, thread_name_prefix='asgi-file')
+
+
+class ClientDisconnected(OSError):
+    pass
+
+
+def wsgi_environ(scope, body=None):
+    """WSGI environ of an ASGI HTTP request"""
+    host, port = scope.get('server') or ('localhost', 80)
+    client_host, client_port = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': host,
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client_host,
+        'REMOTE_PORT': str(client_port),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _response_start(status, headers):
+    encoded = ((name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers)
+    return {
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name, value) for name, value in encoded if name not in SERVER_HEADERS],
+    }
+
+
+async def _wait_for_disconnect(receive, disconnected):
+    """Read what is left of the request until the client goes away"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+
+class RequestBody:
+    """wsgi.input that receives the ASGI request body as the app reads it, from a worker thread"""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more = True
+
+    def _fill(self, size):
+        while self._more and (size < 0 or len(self._buffer) < size):
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ClientDisconnected('Client disconnected during the request body')
+            self._buffer += message.get('body', b'')
+            self._more = message.get('more_body', False)
+
+    def _take(self, size):
+        size = len(self._buffer) if size < 0 else min(size, len(self._buffer))
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        size = -1 if size is None else size
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self, size=-1):
+        size = -1 if size is None else size
+        while b'\n' not in self._buffer and self._more and (size < 0 or len(self._buffer) < size):
+            self._fill(len(self._buffer) + 1)
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self._take(end if size < 0 else min(end, size))
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+
+async def call_wsgi(scope, receive, send):
+    """Run the Flask app for one request in the thread pool, streaming both bodies"""
+    loop = asyncio.get_running_loop()
+    disconnected = asyncio.Event()
+    watcher = None
+
+    def send_message(message):
+        # Called from the worker thread; waits until the event loop took the message
+        if disconnected.is_set():
+            raise ClientDisconnected('Client disconnected during the response')
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run():
+        started = []
+
+        def send_start():
+            nonlocal watcher
+            if watcher is None:
+                send_message(started[0])
+                # The app is done with the request body: from here on receive only reports a disconnect
+                watcher = asyncio.run_coroutine_threadsafe(_wait_for_disconnect(receive, disconnected), loop)
+
+        def write(data):
+            send_start()
+            send_message({'type': 'http.response.body', 'body': data, 'more_body': True})
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [_response_start(int(status.split(' ', 1)[0]), headers)]
+            return write
+
+        iterable = server.app(wsgi_environ(scope, RequestBody(receive, loop)), start_response)
+        try:
+            for chunk in iterable:
+                if chunk:
+                    write(chunk)
+            send_start()
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except ClientDisconnected:
+            pass
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    try:
+        await loop.run_in_executor(_wsgi_executor, run)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+
+def _open_stored(folder, filename, sharded=True):
+    """Open a file of a local store; returns (fd, stat) or None when it's missing
+
+    HLS ladders aren't sharded, their files are opened at their path below folder.
+    """
+    relative = layout.relative(folder, filename) if sharded else filename
+    path = safe_join(os.path.join(server.app.root_path, folder), relative)
+    if path is None:
+        return None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return None
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+        os.close(fd)
+        return None
+    return fd, st
+
+
+async def _send_range(send, fd, start, length, disconnected):
+    """Send length bytes of an open file from start, reading each block in the file pool"""
+    loop = asyncio.get_running_loop()
+    read_size = server.app.config['SERVE_READ_SIZE']
+    while length > 0 and not disconnected.is_set():
+        block = await loop.run_in_executor(_file_executor, os.pread, fd, min(read_size, length), start)
+        if not block:
+            break
+        start += len(block)
+        length -= len(block)
+        # Waits while the client's socket buffer is full, so a slow client holds one block
+        await send({'type': 'http.response.body', 'body': block, 'more_body': length > 0})
+    if length > 0 and not disconnected.is_set():
+        # The file shrank since it was opened; returning early makes the server drop the connection
+        logs.warning('file_truncated', missing_bytes=length)
+
+
+def _native_route(scope):
+    """(route, kind, not-found message, filename) when the request is answered on the event loop"""
+    if scope['method'] not in ('GET', 'HEAD') or server.app.config['SERVE_MODE'] not in NATIVE_MODES:
+        return None
+    for prefix, route, kind, missing in NATIVE_ROUTES:
+        filename = scope['path'][len(prefix):]
+        # Only HLS files live in subdirectories, one per ladder
+        if scope['path'].startswith(prefix) and filename and (kind == 'hls' or '/' not in filename):
+            # The HLS folder is always local
+            store = {'video': server.video_store, 'hls': None}.get(kind, server.thumbnail_store)
+            return (route, kind, missing, filename) if store is None or store.local else None
+    return None
+
+
+def _stored_file(kind, filename):
+    """(folder, sharded, mimetype, max age) of a file of a native route, None when the route doesn't serve it"""
+    config = server.app.config
+    if kind == 'video':
+        return config['UPLOAD_FOLDER'], True, None, None
+    if kind == 'thumbnail':
+        return (config['THUMBNAILS_FOLDER'], True, *server.thumbnail_caching(filename))
+    if kind == 'waveform':
+        # The peaks of a stored file never change
+        if not filename.endswith(server.WAVEFORM_EXTENSION):
+            return None
+        return config['THUMBNAILS_FOLDER'], True, 'application/octet-stream', 31536000
+    caching = server.hls_caching(filename)
+    return (config['HLS_FOLDER'], False, *caching) if caching else None
+
+
+async def serve_stored(scope, receive, send, route, kind, missing, filename):
+    """Send a file of a local store or the HLS folder with Range and ETag handling, like the Flask routes"""
+    loop = asyncio.get_running_loop()
+    headers = dict(scope['headers'])
+    request_id = headers.get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex
+    context = logs.context_id.set(request_id)
+    request_start = time.perf_counter()
+    opened = None
+    start = None
+
+    try:
+        served = _stored_file(kind, filename)
+        if served is not None:
+            folder, sharded, mimetype, max_age = served
+            opened = await loop.run_in_executor(_file_executor, _open_stored, folder, filename, sharded)
+        if opened is None:
+            response = Response(missing, 404, mimetype='text/html')
+        else:
+            st = opened[1]
+            response, start = file_response(
+                wsgi_environ(scope), filename, st.st_size, st.st_mtime, f"{st.st_mtime_ns:x}-{st.st_size:x}",
+                mimetype, max_age
+            )
+            if max_age:
+                response.cache_control.immutable = True
+    except Exception as e:
+        logs.error(f'{kind}_error', error=str(e))
+        response = Response(missing, 404, mimetype='text/html')
+
+    try:
+        response.headers['X-Request-ID'] = request_id
+        elapsed = time.perf_counter() - request_start
+        metrics.REQUEST_SECONDS.observe(elapsed, method=scope['method'], route=route, status=response.status_code)
+        logs.info(
+            'request', method=scope['method'], path=scope['path'], route=route, status=response.status_code,
+            duration_ms=round(elapsed * 1000, 2), bytes=response.content_length, stages=None
+        )
+
+        await send(_response_start(response.status_code, response.headers.to_wsgi_list()))
+        if start is None:
+            await send({'type': 'http.response.body', 'body': response.get_data()})
+            return
+
+        if kind == 'video':
+            metrics.VIDEO_BYTES_SERVED.inc(response.content_length, mode='asgi')
+        disconnected = asyncio.Event()
+        watcher = asyncio.ensure_future(_wait_for_disconnect(receive, disconnected))
+        try:
+            await _send_range(send, opened[0], start, response.content_length, disconnected)
+        finally:
+            watcher.cancel()
+    finally:
+        if opened is not None:
+            os.close(opened[0])
+        logs.context_id.reset(context)
+
+
+async def lifespan(receive, send):
+    loop = asyncio.get_running_loop()
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                # What the first request starts under the Flask servers: job workers, reconcile, ...
+                await loop.run_in_executor(_wsgi_executor, server.start_background_workers)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """The ASGI application"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        # No websocket routes
+        await send({'type': 'websocket.close'})
+        return
+
+    native = _native_route(scope)
+    if native:
+        await serve_stored(scope, receive, send, *native)
+    else:
+        await call_wsgi(scope, receive, send)
+
+
+def raise_open_file_limit():
+    """Every held connection is an open socket: lift the soft limit to the hard one"""
+    try:
+        import resource
+    except ImportError:
+        # Not on Windows
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the async server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=ASGI_WORKERS, help='server processes')
+    args = parser.parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        print("The async server needs uvicorn: pip install 'uvicorn[standard]'")
+        sys.exit(1)
+
+    server.init_database()
+    open_files = raise_open_file_limit()
+
+    print("=" * 60)
+    print("Video Streaming Server - Async Mode")
+    print("=" * 60)
+    print(f"Server URL: http://localhost:{args.port}")
+    print(f"Processes: {args.workers}, Flask threads per process: {WSGI_THREADS}")
+    if open_files:
+        print(f"Open file limit: {open_files} per process, a playing stream holds two")
+    print("=" * 60)
+
+    # Request lines are logged by the app itself
+    uvicorn.run(
+        'asgi:app', host=args.host, port=args.port, workers=args.workers,
+        timeout_keep_alive=KEEP_ALIVE_SECONDS, backlog=BACKLOG, access_log=False
+    )
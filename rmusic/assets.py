@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Build step for the static assets: minify, fingerprint and precompress
+styles.css and script.js are minified and the icons copied as they are; every
+file is written to the build folder with its content hash in its name (e.g.
+css/styles.3f2a9c1b04d2.css) so browsers can cache it forever. Text files get
+gzip and, when the brotli package is installed, brotli siblings (.gz, .br)
+that the server sends as they are. index.html is rewritten to refer to the
+hashed names. The server runs the build on startup when the sources changed;
+a lock file in the build folder lets one process build while the other
+workers wait for it and then use its manifest.
+This module must stay importable without Flask
+Usage: python assets.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import brotli
+except ImportError:
+    # Only gzip variants are written without it
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no file locks (Windows), concurrent builds only rely on unique temp files
+
+ASSET_FOLDERS = ('css', 'js', 'icon')
+INDEX_PAGE = 'index.html'
+BUILD_FOLDER = 'build'
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.build.lock'
+HASH_LENGTH = 12  # hex digits of the content hash in a file name
+COMPRESS_EXTENSIONS = ('.css', '.js', '.html', '.svg', '.json')
+COMPRESS_MIN_SIZE = 256  # smaller files aren't worth a compressed copy
+ASSET_REFERENCE = re.compile(r'((?:href|src)=")(/?)((?:' + '|'.join(ASSET_FOLDERS) + r')/[^"?#]+)(")')
+JS_REGEX_PREFIX = '(,=:[!&|?{};+-*%~^<>'  # a / after one of these starts a regex literal
+# ... and so does a / after one of these keywords, e.g. return /x/.test(s)
+JS_REGEX_KEYWORDS = frozenset((
+    'return', 'typeof', 'case', 'do', 'else', 'in', 'instanceof', 'new', 'delete', 'void',
+    'throw', 'yield', 'await', 'of'
+))
+
+
+def minify_css(text):
+    """Drop comments and the whitespace CSS doesn't need"""
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    # Not around ':', which separates descendant selectors from pseudo-classes
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    # Inside declaration blocks ':' is always a property separator
+    text = re.sub(r'\{([^{}]*)\}', lambda m: '{' + re.sub(r':\s+', ':', m.group(1)) + '}', text)
+    return text.replace(';}', '}').strip()
+
+
+def minify_js(text):
+    """Drop comments, indentation and blank lines, leaving strings, templates and regexes alone
+
+    Line breaks are kept, so automatic semicolon insertion works as before.
+    """
+    out = []
+    i = 0
+    n = len(text)
+    last = ''  # last significant character of code
+    word = ''  # identifier or keyword ending at last, if any
+    line_start = True
+
+    while i < n:
+        c = text[i]
+
+        if c in '"\'`':
+            # String or template literal, copied up to its closing quote
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == '\\' else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+            last = c
+            word = ''
+            line_start = False
+        elif text.startswith('//', i):
+            i = text.find('\n', i)
+            i = n if i == -1 else i
+        elif text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+        elif c == '/' and (last == '' or last in JS_REGEX_PREFIX or word in JS_REGEX_KEYWORDS):
+            # Regex literal: a / inside a character class doesn't end it
+            j = i + 1
+            in_class = False
+            while j < n and text[j] != '\n' and (in_class or text[j] != '/'):
+                if text[j] == '\\':
+                    j += 1
+                elif text[j] == '[':
+                    in_class = True
+                elif text[j] == ']':
+                    in_class = False
+                j += 1
+            out.append(text[i:j + 1])
+            i = j + 1
+            last = '/'
+            word = ''
+            line_start = False
+        elif c == '\n':
+            if not line_start:
+                out.append('\n')
+            line_start = True
+            i += 1
+        elif c in ' \t\r':
+            # Indentation and trailing spaces go, one space between tokens stays
+            j = i
+            while j < n and text[j] in ' \t\r':
+                j += 1
+            if not line_start and j < n and text[j] != '\n':
+                out.append(' ')
+            i = j
+        else:
+            out.append(c)
+            if c.isalnum() or c in '_$':
+                word = word + c if last.isalnum() or last in '_$' else c
+            else:
+                word = ''
+            last = c
+            line_start = False
+            i += 1
+
+    return ''.join(out).strip() + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+def hashed_name(path, data):
+    """path with the content hash before its extension"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A name of its own, another process may be writing the same file
+    fd, temp_path = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def write_asset(path, data):
+    """Write a file and its precompressed variants, those that come out smaller"""
+    _write(path, data)
+    if not path.endswith(COMPRESS_EXTENSIONS) or len(data) < COMPRESS_MIN_SIZE:
+        return
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(data):
+            _write(path + suffix, compressed)
+
+
+def source_files(source_dir='.'):
+    """Relative paths of the asset sources, with '/' separators"""
+    paths = []
+    for folder in ASSET_FOLDERS:
+        folder_path = os.path.join(source_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for root, dirs, files in os.walk(folder_path):
+            dirs.sort()
+            for name in sorted(files):
+                if not name.startswith('.'):
+                    paths.append(os.path.relpath(os.path.join(root, name), source_dir).replace(os.sep, '/'))
+    return paths
+
+
+def source_hash(source_dir='.'):
+    """Hash of every source and of index.html, changes whenever a build would"""
+    digest = hashlib.sha256()
+    for path in source_files(source_dir) + [INDEX_PAGE]:
+        digest.update(path.encode('utf-8') + b'\0')
+        with open(os.path.join(source_dir, path), 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def read_manifest(build_dir=BUILD_FOLDER):
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def rewrite_references(html, files):
+    """Point asset URLs in a page at their hashed names"""
+    def replace(match):
+        prefix, slash, path, quote = match.groups()
+        return f"{prefix}{slash}{files.get(path, path)}{quote}"
+    return ASSET_REFERENCE.sub(replace, html)
+
+
+def _prune(build_dir, keep):
+    """Remove built files that neither the new nor the previous manifest refers to
+
+    The previous build stays so pages loaded before a deploy can still fetch
+    their assets.
+    """
+    for folder in ASSET_FOLDERS:
+        folder_path = os.path.join(build_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for root, _, names in os.walk(folder_path):
+            for name in names:
+                # Temporary files of a write in progress
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                relative = os.path.relpath(path, build_dir).replace(os.sep, '/')
+                for suffix in ('.gz', '.br'):
+                    if relative.endswith(suffix):
+                        relative = relative[:-len(suffix)]
+                if relative not in keep:
+                    os.remove(path)
+
+
+@contextmanager
+def build_lock(build_dir=BUILD_FOLDER):
+    """Hold the build folder's lock, so only one process builds and prunes at a time"""
+    os.makedirs(build_dir, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(build_dir, LOCK_NAME), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def build(source_dir='.', build_dir=BUILD_FOLDER):
+    """Build every asset and index.html; returns the manifest"""
+    with build_lock(build_dir):
+        return _build(source_dir, build_dir)
+
+
+def _build(source_dir, build_dir):
+    previous = read_manifest(build_dir)
+    files = {}
+    sizes = {'source': 0, 'built': 0}
+
+    for path in source_files(source_dir):
+        with open(os.path.join(source_dir, path), 'rb') as f:
+            data = f.read()
+        sizes['source'] += len(data)
+
+        minify = MINIFIERS.get(os.path.splitext(path)[1])
+        # Vendored files come minified already
+        if minify and '.min.' not in os.path.basename(path):
+            data = minify(data.decode('utf-8')).encode('utf-8')
+        sizes['built'] += len(data)
+
+        files[path] = hashed_name(path, data)
+        write_asset(os.path.join(build_dir, files[path]), data)
+
+    with open(os.path.join(source_dir, INDEX_PAGE), encoding='utf-8') as f:
+        html = f.read()
+    write_asset(os.path.join(build_dir, INDEX_PAGE), rewrite_references(html, files).encode('utf-8'))
+
+    manifest = {'source_hash': source_hash(source_dir), 'files': files, 'sizes': sizes}
+    # Written last: a build interrupted before this point runs again on the next start
+    _write(os.path.join(build_dir, MANIFEST_NAME), json.dumps(manifest, indent=2).encode('utf-8'))
+
+    keep = set(files.values()) | set((previous or {}).get('files', {}).values())
+    _prune(build_dir, keep)
+    return manifest
+
+
+def ensure_built(source_dir='.', build_dir=BUILD_FOLDER):
+    """Build the assets unless the build folder already matches the sources; returns the manifest"""
+    current = source_hash(source_dir)
+    manifest = read_manifest(build_dir)
+    if manifest and manifest.get('source_hash') == current:
+        return manifest
+
+    with build_lock(build_dir):
+        # Another worker may have built while this one waited for the lock
+        manifest = read_manifest(build_dir)
+        if manifest and manifest.get('source_hash') == current:
+            return manifest
+        return _build(source_dir, build_dir)
+
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print("Static Asset Build")
+    print("=" * 50)
+
+    manifest = build()
+    for source, built in manifest['files'].items():
+        print(f"  ✓ {source} -> {built}")
+
+    sizes = manifest['sizes']
+    print(f"\n{len(manifest['files'])} assets, {sizes['source']} bytes minified to {sizes['built']}")
+    if brotli is None:
+        print("brotli isn't installed, only gzip variants were written")
+
+    print("=" * 50)
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark of the media server
+Builds a synthetic library in a scratch directory: short test clips rendered
+with ffmpeg's lavfi sources and tens of thousands of rows pointing at them. It
+then starts the app under the Werkzeug server, gunicorn or uvicorn (asgi.py)
+and measures
+  list        /videos pages, full listing and 304 revalidation
+  search      /search prefix queries
+  upload      /upload and chunked /uploads throughput
+  thumbnails  JPEG and WebP/AVIF thumbnail generation rate (in process)
+  range       concurrent Range requests against /video
+Results are written as JSON; --compare prints the change against an earlier file.
+The real library and database are never touched.
+Usage: python benchmark.py [--rows N] [--server werkzeug|gunicorn|asgi] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+import layout
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Words the synthetic names are made of, so searches have realistic hit counts
+WORDS = (
+    'live', 'session', 'acoustic', 'remix', 'official', 'video', 'concert', 'tour', 'night', 'summer',
+    'piano', 'guitar', 'drums', 'cover', 'studio', 'version', 'radio', 'edit', 'extended', 'mix',
+    'lyrics', 'dance', 'jazz', 'blues', 'rock', 'soul', 'house', 'ambient', 'orchestra', 'choir',
+)
+SEARCH_QUERIES = ('live', 'acoustic session', 'pi', 'remix official', 'night tour 2', 'zzz')
+
+# Test clips: (width, height, seconds)
+CLIP_SIZES = ((640, 360, 10), (1280, 720, 10), (1920, 1080, 5))
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def summarize(latencies):
+    """Latency statistics in milliseconds"""
+    if not latencies:
+        return {'count': 0}
+    return {
+        'count': len(latencies),
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3),
+        'p50_ms': round(1000 * percentile(latencies, 0.50), 3),
+        'p95_ms': round(1000 * percentile(latencies, 0.95), 3),
+        'p99_ms': round(1000 * percentile(latencies, 0.99), 3),
+        'max_ms': round(1000 * max(latencies), 3),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=APP_DIR, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Library
+
+def render_clips(clips_folder, count):
+    """Render test clips with lavfi sources; returns their file names"""
+    os.makedirs(clips_folder, exist_ok=True)
+    names = []
+    for i in range(count):
+        width, height, seconds = CLIP_SIZES[i % len(CLIP_SIZES)]
+        name = f"clip_{i:03d}_{height}p.mp4"
+        subprocess.run([
+            'ffmpeg', '-y', '-v', 'error',
+            '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=25:duration={seconds}',
+            '-f', 'lavfi', '-i', f'sine=frequency={220 + 110 * i}:duration={seconds}',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-shortest', '-movflags', '+faststart',
+            layout.path(clips_folder, name)
+        ], check=True, capture_output=True)
+        names.append(name)
+    return names
+
+
+def build_library(rows, clips):
+    """Insert rows that share the rendered clips as their stored files"""
+    import db
+    from media import generate_video_thumbnail
+
+    thumbnails = {}
+    for clip in clips:
+        thumb_name = f"{os.path.splitext(clip)[0]}.jpg"
+        if generate_video_thumbnail(layout.locate('upload', clip), layout.path('thumbnails', thumb_name), 1):
+            thumbnails[clip] = thumb_name
+
+    rng = random.Random(42)
+    params = []
+    for i in range(rows):
+        clip = clips[i % len(clips)]
+        name = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))) + f' {i}'
+        filename = f"{uuid.UUID(int=rng.getrandbits(128)).hex[:8]}_{i}.mp4"
+        params.append((
+            name, filename, f"{name}.mp4", os.path.getsize(layout.locate('upload', clip)),
+            thumbnails.get(clip), None, f"synthetic-{i % len(clips)}", clip, None, None, None
+        ))
+
+    with db.transaction():
+        db.executemany('video_insert', params)
+
+
+# Server
+
+def bench_app():
+    """The app with absolute media folders, for gunicorn ('benchmark:bench_app()')"""
+    import server
+    for key in ('UPLOAD_FOLDER', 'THUMBNAILS_FOLDER', 'HLS_FOLDER', 'QUARANTINE_FOLDER'):
+        server.app.config[key] = os.path.abspath(server.app.config[key])
+    return server.app
+
+
+def bench_asgi():
+    """The async server over bench_app(), for uvicorn ('benchmark:bench_asgi' with --factory)"""
+    bench_app()
+    import asgi
+    return asgi.app
+
+
+def serve_werkzeug(port):
+    from werkzeug.serving import make_server
+    make_server('127.0.0.1', port, bench_app(), threaded=True).serve_forever()
+
+
+def start_server(kind, workdir, workers):
+    """Start the app in a subprocess rooted in workdir; returns (process, port)"""
+    port = free_port()
+    env = dict(os.environ, RMUSIC_DB_PATH=os.path.join(workdir, 'videos.db'),
+               PYTHONPATH=os.pathsep.join(filter(None, [APP_DIR, os.environ.get('PYTHONPATH')])))
+
+    if kind == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k', 'gthread', '--threads', '8',
+                   '-b', f'127.0.0.1:{port}', 'benchmark:bench_app()']
+    elif kind == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', '--factory', 'benchmark:bench_asgi', '--workers', str(workers),
+                   '--host', '127.0.0.1', '--port', str(port), '--no-access-log']
+    else:
+        command = [sys.executable, '-c', f'import benchmark; benchmark.serve_werkzeug({port})']
+
+    log = open(os.path.join(workdir, 'server.log'), 'wb')
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited, see {os.path.join(workdir, 'server.log')}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/livez')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('Server did not become ready')
+
+
+class Client:
+    """A keep-alive HTTP connection that times each request"""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def request(self, method, path, body=None, headers=None):
+        start = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            # Reconnect once, the server may have closed an idle connection
+            self.conn.close()
+            self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            self.conn.request(method, path, body=body, headers=headers or {})
+            response = self.conn.getresponse()
+            data = response.read()
+        return response, data, time.perf_counter() - start
+
+
+# Measurements
+
+def bench_list(client, pages):
+    page_latencies = []
+    cursor = None
+    for _ in range(pages):
+        query = {'limit': 50, 'fields': 'id,name,thumbnail_url,url'}
+        if cursor:
+            query['after'] = cursor
+        response, data, elapsed = client.request('GET', '/videos?' + urlencode(query))
+        page_latencies.append(elapsed)
+        cursor = json.loads(data)['next_cursor']
+        if not cursor:
+            break
+
+    full_latencies = []
+    etag = None
+    for _ in range(5):
+        response, data, elapsed = client.request('GET', '/videos')
+        full_latencies.append(elapsed)
+        etag = response.getheader('ETag')
+
+    revalidate_latencies = []
+    for _ in range(50):
+        response, _, elapsed = client.request('GET', '/videos', headers={'If-None-Match': etag})
+        revalidate_latencies.append(elapsed)
+
+    return {
+        'page': summarize(page_latencies),
+        'full': dict(summarize(full_latencies), bytes=len(data)),
+        'not_modified': summarize(revalidate_latencies),
+    }
+
+
+def bench_search(client, repeat):
+    results = {}
+    for query in SEARCH_QUERIES:
+        latencies = []
+        for _ in range(repeat):
+            _, data, elapsed = client.request('GET', '/search?' + urlencode({'q': query, 'limit': 50}))
+            latencies.append(elapsed)
+        results[query] = dict(summarize(latencies), hits=len(json.loads(data)['videos']))
+    return results
+
+
+def multipart(filename, content):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def bench_upload(client, count, size, chunk_size):
+    """Random bytes named .mp3 so no background jobs compete with the measurement"""
+    form_seconds = 0
+    for i in range(count):
+        body, content_type = multipart(f'bench_{i}.mp3', os.urandom(size))
+        response, _, elapsed = client.request('POST', '/upload', body, {'Content-Type': content_type})
+        if response.status != 201:
+            raise RuntimeError(f'/upload answered {response.status}')
+        form_seconds += elapsed
+
+    chunked_seconds = 0
+    for i in range(count):
+        content = os.urandom(size)
+        start = time.perf_counter()
+        response, data, _ = client.request(
+            'POST', '/uploads', json.dumps({'filename': f'bench_chunked_{i}.mp3', 'size': size}),
+            {'Content-Type': 'application/json'}
+        )
+        upload_id = json.loads(data)['upload_id']
+        for offset in range(0, size, chunk_size):
+            client.request('PUT', f'/uploads/{upload_id}?offset={offset}', content[offset:offset + chunk_size])
+        response, _, _ = client.request('POST', f'/uploads/{upload_id}/finalize')
+        if response.status != 201:
+            raise RuntimeError(f'finalize answered {response.status}')
+        chunked_seconds += time.perf_counter() - start
+
+    total = count * size
+    return {
+        'files': count,
+        'file_bytes': size,
+        'form_mb_per_s': round(total / form_seconds / 1e6, 2),
+        'chunked_mb_per_s': round(total / chunked_seconds / 1e6, 2),
+    }
+
+
+def bench_thumbnails(clips, repeat):
+    from media import generate_video_thumbnail, generate_thumbnail_variants
+
+    output = os.path.abspath('bench_thumbs')
+    os.makedirs(output, exist_ok=True)
+    results = {}
+    for label, generate in (
+        ('jpeg', lambda path, i: generate_video_thumbnail(path, os.path.join(output, f'{i}.jpg'), 1)),
+        ('variants', lambda path, i: generate_thumbnail_variants(path, output, f'bench{i}', 1)),
+    ):
+        latencies = []
+        failed = 0
+        for i in range(repeat):
+            start = time.perf_counter()
+            if not generate(layout.locate('upload', clips[i % len(clips)]), i):
+                failed += 1
+            latencies.append(time.perf_counter() - start)
+        results[label] = dict(summarize(latencies), failed=failed,
+                              per_second=round(len(latencies) / sum(latencies), 2))
+    shutil.rmtree(output, ignore_errors=True)
+    return results
+
+
+def bench_range(port, clips, concurrency, requests_per_worker, max_range):
+    sizes = {clip: os.path.getsize(layout.locate('upload', clip)) for clip in clips}
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = Client(port)
+        latencies, transferred, errors = [], 0, 0
+        for _ in range(requests_per_worker):
+            clip = rng.choice(clips)
+            length = rng.randint(1, min(max_range, sizes[clip]))
+            start = rng.randint(0, sizes[clip] - length)
+            response, data, elapsed = client.request(
+                'GET', f'/video/{quote(clip)}', headers={'Range': f'bytes={start}-{start + length - 1}'}
+            )
+            if response.status != 206 or len(data) != length:
+                errors += 1
+            latencies.append(elapsed)
+            transferred += len(data)
+        return latencies, transferred, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - start
+
+    latencies = [latency for result in results for latency in result[0]]
+    transferred = sum(result[1] for result in results)
+    return dict(
+        summarize(latencies),
+        concurrency=concurrency,
+        errors=sum(result[2] for result in results),
+        requests_per_s=round(len(latencies) / wall, 1),
+        mb_per_s=round(transferred / wall / 1e6, 2),
+    )
+
+
+def compare(old, new, path=''):
+    """Print numeric results that differ between two result files"""
+    for key, value in new.items():
+        name = f'{path}.{key}' if path else key
+        before = old.get(key) if isinstance(old, dict) else None
+        if isinstance(value, dict):
+            compare(before or {}, value, name)
+        elif isinstance(value, (int, float)) and isinstance(before, (int, float)) and before and value != before:
+            print(f"  {name}: {before} -> {value} ({100.0 * (value - before) / before:+.1f}%)")
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='rmusic-bench-')
+    os.environ['RMUSIC_DB_PATH'] = os.path.join(workdir, 'videos.db')
+    sys.path.insert(0, APP_DIR)
+    os.chdir(workdir)
+    for folder in ('upload', 'thumbnails', 'hls'):
+        os.makedirs(folder)
+
+    import db
+    db.init_schema()
+
+    print(f"Scratch directory: {workdir}")
+    print(f"Rendering {args.clips} test clips...")
+    clips = render_clips('upload', args.clips)
+    print(f"Inserting {args.rows} rows...")
+    build_library(args.rows, clips)
+    db.close_connection()
+
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'server': args.server,
+            'params': vars(args),
+        }
+    }
+
+    process, port = start_server(args.server, workdir, args.workers)
+    try:
+        client = Client(port)
+        print("Listing...")
+        results['list'] = bench_list(client, args.pages)
+        print("Searching...")
+        results['search'] = bench_search(client, args.repeat)
+        print(f"Range requests with {args.concurrency} clients...")
+        results['range'] = bench_range(port, clips, args.concurrency, args.range_requests, args.max_range)
+        print("Uploading...")
+        results['upload'] = bench_upload(client, args.uploads, args.upload_size, args.chunk_size)
+    finally:
+        process.terminate()
+        process.wait()
+
+    print("Generating thumbnails...")
+    results['thumbnails'] = bench_thumbnails(clips, args.thumbnails)
+
+    if not args.keep:
+        os.chdir(APP_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the media server against a synthetic library')
+    parser.add_argument('--rows', type=int, default=20000, help='videos rows in the synthetic library')
+    parser.add_argument('--clips', type=int, default=6, help='test clips rendered with ffmpeg')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn', 'asgi'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn or uvicorn worker processes')
+    parser.add_argument('--pages', type=int, default=100, help='/videos pages to walk')
+    parser.add_argument('--repeat', type=int, default=50, help='requests per search query')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent Range clients')
+    parser.add_argument('--range-requests', type=int, default=200, help='Range requests per client')
+    parser.add_argument('--max-range', type=int, default=1024 * 1024, help='largest Range length in bytes')
+    parser.add_argument('--uploads', type=int, default=4, help='files per upload method')
+    parser.add_argument('--upload-size', type=int, default=32 * 1024 * 1024)
+    parser.add_argument('--chunk-size', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--thumbnails', type=int, default=12, help='thumbnails generated per kind')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    print("=" * 50)
+    print("Media Server Benchmark")
+    print("=" * 50)
+
+    results = run(args)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+
+    if previous:
+        with open(previous) as f:
+            old = json.load(f)
+        print(f"Changes since {old['meta'].get('revision') or previous}:")
+        compare(old, {k: v for k, v in results.items() if k != 'meta'})
+
+    print("=" * 50)
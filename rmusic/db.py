@@ -0,0 +1,664 @@
+"""
+SQLite data access layer
+Every route, background worker and maintenance script goes through this module.
+Connections are pooled per thread, run in WAL mode so readers never wait for
+writers, and all queries live here as named statements.
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import metrics
+
+# Database location, override with the RMUSIC_DB_PATH environment variable
+DB_PATH = os.environ.get(
+    'RMUSIC_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'videos.db')
+)
+
+BUSY_TIMEOUT = 10  # seconds a writer waits for the lock before failing
+STATEMENT_CACHE_SIZE = 256  # compiled statements kept per connection
+
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',  # safe with WAL, avoids an fsync per commit
+    'PRAGMA cache_size=-16000',  # 16MB page cache per connection
+    'PRAGMA mmap_size=268435456',  # 256MB memory-mapped reads
+    'PRAGMA temp_store=MEMORY',
+)
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS videos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        filename TEXT UNIQUE NOT NULL,
+        original_filename TEXT NOT NULL,
+        file_size INTEGER,
+        thumbnail TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # Index for keyset pagination of /videos (newest first)
+    'CREATE INDEX IF NOT EXISTS idx_videos_created_at_id ON videos(created_at DESC, id DESC)',
+    # Library version, bumped by triggers on every change; used for ETag/Last-Modified
+    '''
+    CREATE TABLE IF NOT EXISTS library_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    'INSERT OR IGNORE INTO library_state (id) VALUES (1)',
+    # Background job queue
+    '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        video_id INTEGER,
+        payload TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 3,
+        run_after REAL NOT NULL,
+        locked_until REAL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_jobs_status_run_after ON jobs(status, run_after)',
+    # Resumable chunked uploads
+    '''
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        original_filename TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'uploading',
+        video_id INTEGER,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        upload_id TEXT NOT NULL,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (upload_id, offset)
+    )
+    ''',
+    # Full-text index over video names, kept in sync with videos by triggers
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS videos_fts USING fts5(
+        name,
+        original_filename,
+        content='videos',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    ''',
+    # Bulk thumbnail runs
+    '''
+    CREATE TABLE IF NOT EXISTS thumbnail_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        status TEXT NOT NULL DEFAULT 'running',
+        total INTEGER NOT NULL DEFAULT 0,
+        processed INTEGER NOT NULL DEFAULT 0,
+        generated INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        skipped INTEGER NOT NULL DEFAULT 0,
+        last_video_id INTEGER NOT NULL DEFAULT 0,
+        max_video_id INTEGER,
+        heartbeat REAL,
+        started_at REAL NOT NULL,
+        finished_at REAL,
+        error TEXT
+    )
+    ''',
+    # Source files brought in by import_library.py, so an import can be run again
+    '''
+    CREATE TABLE IF NOT EXISTS import_files (
+        source_path TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        imported_at REAL NOT NULL
+    )
+    ''',
+    # Folder state seen by the last reconcile pass, lets incremental passes skip unchanged folders
+    '''
+    CREATE TABLE IF NOT EXISTS reconcile_state (
+        folder TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        library_version INTEGER NOT NULL,
+        checked_at REAL NOT NULL
+    )
+    ''',
+)
+
+# Columns added after the first release, created on startup if missing
+REQUIRED_COLUMNS = (
+    ('videos', 'thumbnail', 'TEXT'),
+    ('videos', 'content_hash', 'TEXT'),  # SHA-256 of the uploaded bytes
+    ('videos', 'storage_name', 'TEXT'),  # file in the upload folder, shared by duplicates
+    ('videos', 'hls', 'TEXT'),  # HLS ladder directory, set once packaging succeeded
+    ('videos', 'thumbnail_variants', 'TEXT'),  # JSON list of {name, width, type} WebP/AVIF files
+    ('videos', 'previews', 'TEXT'),  # WebVTT track of the scrubbing preview sprites
+    ('videos', 'waveform', 'TEXT'),  # min/max peaks file of an audio track, in the thumbnails folder
+    ('videos', 'faststart', 'INTEGER'),  # 1 index in front, 0 not an MP4/MOV, NULL not checked yet
+    # Stream details read by ffprobe at ingest
+    ('videos', 'duration', 'REAL'),  # seconds
+    ('videos', 'width', 'INTEGER'),
+    ('videos', 'height', 'INTEGER'),
+    ('videos', 'video_codec', 'TEXT'),
+    ('videos', 'audio_codec', 'TEXT'),
+    ('videos', 'bit_rate', 'INTEGER'),  # bits per second of the whole file
+    ('videos', 'has_video', 'INTEGER'),
+    ('videos', 'has_audio', 'INTEGER'),
+    ('videos', 'probed', 'INTEGER'),  # 1 probed, 0 ffprobe couldn't read the file, NULL not probed yet
+    # Row counts kept by triggers so /health doesn't scan the table
+    ('library_state', 'video_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('library_state', 'thumbnail_count', 'INTEGER NOT NULL DEFAULT 0'),
+    # Last video a bulk thumbnail run covers, rows added after it started are left out
+    ('thumbnail_runs', 'max_video_id', 'INTEGER'),
+)
+
+# Run after missing columns were added
+DATA_MIGRATIONS = (
+    # Rows from before deduplication own their file
+    'UPDATE videos SET storage_name = filename WHERE storage_name IS NULL',
+    # Resync the counters once per start, the triggers keep them exact afterwards
+    '''
+    UPDATE library_state SET
+        video_count = (SELECT COUNT(*) FROM videos),
+        thumbnail_count = (SELECT COUNT(thumbnail) FROM videos)
+    WHERE id = 1
+    ''',
+)
+
+# Created after the columns they refer to exist
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_videos_content_hash ON videos(content_hash)',
+    'CREATE INDEX IF NOT EXISTS idx_videos_storage_name ON videos(storage_name)',
+    'CREATE INDEX IF NOT EXISTS idx_videos_thumbnail ON videos(thumbnail)',
+)
+
+TRIGGERS = tuple(
+    f'''
+    CREATE TRIGGER IF NOT EXISTS videos_version_{event.lower()} AFTER {event} ON videos
+    BEGIN
+        UPDATE library_state SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1;
+    END
+    '''
+    for event in ('INSERT', 'UPDATE', 'DELETE')
+) + (
+    '''
+    CREATE TRIGGER IF NOT EXISTS videos_count_insert AFTER INSERT ON videos
+    BEGIN
+        UPDATE library_state SET video_count = video_count + 1,
+               thumbnail_count = thumbnail_count + (new.thumbnail IS NOT NULL)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS videos_count_delete AFTER DELETE ON videos
+    BEGIN
+        UPDATE library_state SET video_count = video_count - 1,
+               thumbnail_count = thumbnail_count - (old.thumbnail IS NOT NULL)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS videos_count_thumbnail AFTER UPDATE OF thumbnail ON videos
+    WHEN (old.thumbnail IS NULL) != (new.thumbnail IS NULL)
+    BEGIN
+        UPDATE library_state SET
+               thumbnail_count = thumbnail_count + (new.thumbnail IS NOT NULL) - (old.thumbnail IS NOT NULL)
+        WHERE id = 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS videos_fts_insert AFTER INSERT ON videos
+    BEGIN
+        INSERT INTO videos_fts (rowid, name, original_filename)
+        VALUES (new.id, new.name, new.original_filename);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS videos_fts_delete AFTER DELETE ON videos
+    BEGIN
+        INSERT INTO videos_fts (videos_fts, rowid, name, original_filename)
+        VALUES ('delete', old.id, old.name, old.original_filename);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS videos_fts_update AFTER UPDATE OF name, original_filename ON videos
+    BEGIN
+        INSERT INTO videos_fts (videos_fts, rowid, name, original_filename)
+        VALUES ('delete', old.id, old.name, old.original_filename);
+        INSERT INTO videos_fts (rowid, name, original_filename)
+        VALUES (new.id, new.name, new.original_filename);
+    END
+    ''',
+)
+
+STATEMENTS = {
+    # Videos
+    'video_insert': '''
+        INSERT INTO videos (name, filename, original_filename, file_size, thumbnail,
+                            thumbnail_variants, content_hash, storage_name, hls, previews, waveform)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'video_files_by_id': '''
+        SELECT filename, storage_name, thumbnail, thumbnail_variants, hls, previews, waveform, faststart,
+               duration, has_video, has_audio, probed
+        FROM videos WHERE id = ?
+    ''',
+    # Duplicates share the blob, so they share its thumbnail too
+    'video_set_thumbnail': 'UPDATE videos SET thumbnail = ? WHERE storage_name = ?',
+    'video_set_thumbnail_variants': 'UPDATE videos SET thumbnail_variants = ? WHERE storage_name = ?',
+    'video_set_hls': 'UPDATE videos SET hls = ? WHERE storage_name = ?',
+    'video_set_previews': 'UPDATE videos SET previews = ? WHERE storage_name = ?',
+    'video_set_waveform': 'UPDATE videos SET waveform = ? WHERE storage_name = ?',
+    'video_set_faststart': 'UPDATE videos SET faststart = ?, file_size = ? WHERE storage_name = ?',
+    'video_set_metadata': '''
+        UPDATE videos SET duration = ?, width = ?, height = ?, video_codec = ?, audio_codec = ?,
+               bit_rate = ?, has_video = ?, has_audio = ?, probed = ?
+        WHERE storage_name = ?
+    ''',
+    # A duplicate takes the details of an already probed copy
+    'video_copy_metadata': '''
+        UPDATE videos SET (duration, width, height, video_codec, audio_codec, bit_rate,
+                           has_video, has_audio, probed) = (
+            SELECT duration, width, height, video_codec, audio_codec, bit_rate, has_video, has_audio, probed
+            FROM videos AS probed_copy
+            WHERE probed_copy.storage_name = videos.storage_name AND probed_copy.probed IS NOT NULL
+            LIMIT 1
+        )
+        WHERE id = ?
+    ''',
+    'video_delete': 'DELETE FROM videos WHERE id = ?',
+    'video_id_by_filename': 'SELECT id FROM videos WHERE filename = ?',
+    'blob_by_hash': '''
+        SELECT storage_name, thumbnail, thumbnail_variants, hls, previews, waveform, file_size FROM videos
+        WHERE content_hash = ?
+        ORDER BY id
+        LIMIT 1
+    ''',
+    'blob_ref_count': 'SELECT COUNT(*) FROM videos WHERE storage_name = ?',
+    'thumbnail_ref_count': 'SELECT COUNT(*) FROM videos WHERE thumbnail = ?',
+    'video_count': 'SELECT COUNT(*) FROM videos',
+    'video_thumbnail_count': 'SELECT COUNT(*) FROM videos WHERE thumbnail IS NOT NULL',
+    'videos_reconcile_files': '''
+        SELECT id, storage_name, thumbnail, thumbnail_variants, previews, waveform, hls FROM videos
+    ''',
+    'videos_missing_thumbnail': '''
+        SELECT id, storage_name, duration, has_video FROM videos WHERE thumbnail IS NULL
+    ''',
+    # One row per stored file without a ladder or a packaging job in the queue
+    'videos_missing_hls': '''
+        SELECT MIN(id), storage_name FROM videos
+        WHERE hls IS NULL AND NOT EXISTS (
+            SELECT 1 FROM jobs JOIN videos AS queued ON queued.id = jobs.video_id
+            WHERE jobs.kind = 'hls' AND jobs.status IN ('pending', 'running')
+              AND queued.storage_name = videos.storage_name
+        )
+        GROUP BY storage_name
+    ''',
+    'videos_missing_thumbnail_variants': '''
+        SELECT MIN(id), storage_name FROM videos
+        WHERE thumbnail_variants IS NULL AND NOT EXISTS (
+            SELECT 1 FROM jobs JOIN videos AS queued ON queued.id = jobs.video_id
+            WHERE jobs.kind = 'thumbnail' AND jobs.status IN ('pending', 'running')
+              AND queued.storage_name = videos.storage_name
+        )
+        GROUP BY storage_name
+    ''',
+    'videos_thumbnail_variants': '''
+        SELECT DISTINCT thumbnail_variants FROM videos WHERE thumbnail_variants IS NOT NULL
+    ''',
+    'videos_missing_previews': '''
+        SELECT MIN(id), storage_name FROM videos
+        WHERE previews IS NULL AND NOT EXISTS (
+            SELECT 1 FROM jobs JOIN videos AS queued ON queued.id = jobs.video_id
+            WHERE jobs.kind = 'previews' AND jobs.status IN ('pending', 'running')
+              AND queued.storage_name = videos.storage_name
+        )
+        GROUP BY storage_name
+    ''',
+    'videos_previews': 'SELECT DISTINCT previews FROM videos WHERE previews IS NOT NULL',
+    'videos_missing_waveform': '''
+        SELECT MIN(id), storage_name FROM videos
+        WHERE waveform IS NULL AND NOT EXISTS (
+            SELECT 1 FROM jobs JOIN videos AS queued ON queued.id = jobs.video_id
+            WHERE jobs.kind = 'waveform' AND jobs.status IN ('pending', 'running')
+              AND queued.storage_name = videos.storage_name
+        )
+        GROUP BY storage_name
+    ''',
+    'videos_missing_metadata': '''
+        SELECT MIN(id), storage_name FROM videos
+        WHERE probed IS NULL AND NOT EXISTS (
+            SELECT 1 FROM jobs JOIN videos AS queued ON queued.id = jobs.video_id
+            WHERE jobs.kind = 'probe' AND jobs.status IN ('pending', 'running')
+              AND queued.storage_name = videos.storage_name
+        )
+        GROUP BY storage_name
+    ''',
+    'videos_missing_faststart': 'SELECT DISTINCT storage_name FROM videos WHERE faststart IS NULL',
+    'videos_missing_thumbnail_range': '''
+        SELECT COUNT(*), COALESCE(MAX(id), 0) FROM videos WHERE thumbnail IS NULL
+    ''',
+    'videos_missing_thumbnail_after': '''
+        SELECT id, storage_name, duration, has_video FROM videos
+        WHERE thumbnail IS NULL AND id > ? AND id <= ?
+        ORDER BY id
+        LIMIT ?
+    ''',
+    'library_state': 'SELECT version, updated_at FROM library_state WHERE id = 1',
+    'library_counters': 'SELECT video_count, thumbnail_count FROM library_state WHERE id = 1',
+    'ping': 'SELECT 1',
+    'fts_exists': "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'videos_fts'",
+    'fts_rebuild': "INSERT INTO videos_fts (videos_fts) VALUES ('rebuild')",
+
+    # Jobs
+    'job_insert': '''
+        INSERT INTO jobs (kind, video_id, payload, max_attempts, run_after, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''',
+    'job_get': '''
+        SELECT id, kind, video_id, status, attempts, max_attempts, run_after,
+               last_error, created_at, updated_at
+        FROM jobs WHERE id = ?
+    ''',
+    'job_counts_by_status': 'SELECT status, COUNT(*) FROM jobs GROUP BY status',
+    'job_counts_by_kind': '''
+        SELECT kind, status, COUNT(*) FROM jobs WHERE status IN ('pending', 'running') GROUP BY kind, status
+    ''',
+    'job_active_of_kind': '''
+        SELECT id FROM jobs WHERE kind = ? AND status IN ('pending', 'running') LIMIT 1
+    ''',
+    # A job of this kind waiting or running for any copy of a stored file
+    'job_active_for_storage': '''
+        SELECT jobs.id FROM jobs JOIN videos ON videos.id = jobs.video_id
+        WHERE jobs.kind = ? AND jobs.status IN ('pending', 'running') AND videos.storage_name = ?
+        LIMIT 1
+    ''',
+    # Pending jobs whose backoff elapsed, or running jobs whose worker died
+    'job_next_runnable': '''
+        SELECT id, kind, video_id, payload, attempts, max_attempts FROM jobs
+        WHERE (status = 'pending' AND run_after <= ?)
+           OR (status = 'running' AND locked_until < ?)
+        ORDER BY run_after, id
+        LIMIT 1
+    ''',
+    'job_claim': '''
+        UPDATE jobs SET status = 'running', attempts = attempts + 1,
+               locked_until = ?, updated_at = ?
+        WHERE id = ?
+    ''',
+    'job_renew': '''
+        UPDATE jobs SET locked_until = ? WHERE id = ? AND status = 'running'
+    ''',
+    'job_complete': '''
+        UPDATE jobs SET status = 'done', locked_until = NULL, last_error = NULL, updated_at = ?
+        WHERE id = ?
+    ''',
+    'job_retry': '''
+        UPDATE jobs SET status = 'pending', run_after = ?, locked_until = NULL,
+               last_error = ?, updated_at = ?
+        WHERE id = ?
+    ''',
+    'job_fail': '''
+        UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ?, updated_at = ?
+        WHERE id = ?
+    ''',
+
+    # Chunked uploads
+    'upload_session_insert': '''
+        INSERT INTO upload_sessions (id, original_filename, filename, size, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''',
+    'upload_session_get': '''
+        SELECT id, original_filename, filename, size, status, video_id, created_at, updated_at
+        FROM upload_sessions WHERE id = ?
+    ''',
+    'upload_session_touch': 'UPDATE upload_sessions SET updated_at = ? WHERE id = ?',
+    'upload_session_complete': '''
+        UPDATE upload_sessions SET status = 'completed', video_id = ?, updated_at = ? WHERE id = ?
+    ''',
+    'upload_session_delete': 'DELETE FROM upload_sessions WHERE id = ?',
+    'upload_sessions_idle': 'SELECT id, filename, status FROM upload_sessions WHERE updated_at < ?',
+    'upload_chunk_insert': 'INSERT OR REPLACE INTO upload_chunks (upload_id, offset, length) VALUES (?, ?, ?)',
+    'upload_chunks_for_session': 'SELECT offset, length FROM upload_chunks WHERE upload_id = ? ORDER BY offset',
+    'upload_chunks_delete': 'DELETE FROM upload_chunks WHERE upload_id = ?',
+
+    # Bulk thumbnail runs
+    'run_get': 'SELECT * FROM thumbnail_runs WHERE id = ?',
+    'run_active': "SELECT id, heartbeat FROM thumbnail_runs WHERE status = 'running' ORDER BY id LIMIT 1",
+    'run_interrupted': '''
+        SELECT id FROM thumbnail_runs
+        WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)
+    ''',
+    'run_insert': '''
+        INSERT INTO thumbnail_runs (total, max_video_id, heartbeat, started_at) VALUES (?, ?, ?, ?)
+    ''',
+    # Runs are owned by whoever wrote the current heartbeat: every write checks it, so
+    # a process whose run was taken over stops updating it
+    'run_heartbeat': '''
+        UPDATE thumbnail_runs SET heartbeat = ? WHERE id = ? AND status = 'running' AND heartbeat IS ?
+    ''',
+    'run_remaining': "SELECT COALESCE(SUM(total - processed), 0) FROM thumbnail_runs WHERE status = 'running'",
+    'run_position': 'SELECT last_video_id, max_video_id FROM thumbnail_runs WHERE id = ?',
+    'run_progress': '''
+        UPDATE thumbnail_runs
+        SET processed = processed + ?, generated = generated + ?, failed = failed + ?,
+            skipped = skipped + ?, last_video_id = ?
+        WHERE id = ? AND heartbeat IS ?
+    ''',
+    'run_complete': '''
+        UPDATE thumbnail_runs SET status = 'completed', finished_at = ? WHERE id = ? AND heartbeat IS ?
+    ''',
+    'run_fail': '''
+        UPDATE thumbnail_runs SET status = 'failed', error = ?, finished_at = ? WHERE id = ? AND heartbeat IS ?
+    ''',
+
+    # Library import
+    'import_files_all': 'SELECT source_path FROM import_files',
+    'import_file_insert': 'INSERT INTO import_files (source_path, filename, imported_at) VALUES (?, ?, ?)',
+    'import_file_stored': '''
+        SELECT videos.storage_name FROM import_files JOIN videos ON videos.filename = import_files.filename
+        WHERE import_files.source_path = ?
+    ''',
+
+    # Reconciler
+    'reconcile_state_get': 'SELECT mtime_ns, library_version FROM reconcile_state WHERE folder = ?',
+    'reconcile_state_set': '''
+        INSERT OR REPLACE INTO reconcile_state (folder, mtime_ns, library_version, checked_at)
+        VALUES (?, ?, ?, ?)
+    ''',
+}
+
+# Fields that /videos can return, selectable with ?fields=
+VIDEO_LIST_COLUMNS = {
+    'id': 'id',
+    'name': 'name',
+    'filename': 'filename',
+    'original_filename': 'original_filename',
+    'file_size': 'file_size',
+    'duration': 'duration',
+    'width': 'width',
+    'height': 'height',
+    'thumbnail': 'thumbnail',
+    'created_at': "strftime('%Y-%m-%d %H:%M:%S', created_at) AS created_at",
+    'url': "'/video/' || storage_name AS url",
+    'thumbnail_url': "'/thumb/' || thumbnail AS thumbnail_url",
+    # Decoded into srcset-ready sources by the server
+    'thumbnail_sources': 'thumbnail_variants AS thumbnail_sources',
+    'hls_url': "'/hls/' || hls || '/master.m3u8' AS hls_url",
+    'preview_url': "'/thumb/' || previews AS preview_url",
+    'waveform_url': "'/waveform/' || waveform AS waveform_url",
+}
+
+_local = threading.local()
+
+
+def get_connection():
+    """Return this thread's pooled connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+
+    # A forked worker process must not reuse its parent's connection
+    if conn is not None and _local.pid == os.getpid() and _local.path == DB_PATH:
+        return conn
+
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,  # autocommit; use transaction() to group writes
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _local.path = DB_PATH
+    return conn
+
+
+def close_connection():
+    """Close this thread's pooled connection"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+@contextmanager
+def transaction(immediate=False):
+    """Group statements into one transaction on this thread's connection
+
+    immediate=True takes the write lock up front, for read-then-write
+    sequences that must not interleave with other writers. Nested calls
+    join the outer transaction.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    with metrics.DB_QUERY_SECONDS.time(statement='COMMIT'):
+        conn.execute('COMMIT')
+
+
+def execute(name, params=()):
+    """Run a named statement and return the cursor"""
+    with metrics.DB_QUERY_SECONDS.time(statement=name):
+        return get_connection().execute(STATEMENTS[name], params)
+
+
+def executemany(name, seq_of_params):
+    """Run a named statement once per parameter set"""
+    with metrics.DB_QUERY_SECONDS.time(statement=name):
+        return get_connection().executemany(STATEMENTS[name], seq_of_params)
+
+
+def query_one(name, params=()):
+    """Run a named query and return the first row, or None"""
+    with metrics.DB_QUERY_SECONDS.time(statement=name):
+        return get_connection().execute(STATEMENTS[name], params).fetchone()
+
+
+def query_all(name, params=()):
+    """Run a named query and return all rows"""
+    with metrics.DB_QUERY_SECONDS.time(statement=name):
+        return get_connection().execute(STATEMENTS[name], params).fetchall()
+
+
+def query_value(name, params=()):
+    """Run a named query and return the first column of the first row"""
+    row = query_one(name, params)
+    return row[0] if row else None
+
+
+def list_videos(fields, after=None, limit=None):
+    """Return videos newest first, as a keyset page when after/limit are given
+
+    after is a (created_at, id) tuple taken from the last row of the previous
+    page. Rows also carry _cursor_created_at and _cursor_id to build the next
+    cursor, whether or not those fields were requested.
+    """
+    columns = [VIDEO_LIST_COLUMNS[f] for f in fields]
+    columns += ['created_at AS _cursor_created_at', 'id AS _cursor_id']
+
+    query = f"SELECT {', '.join(columns)} FROM videos"
+    params = []
+    if after:
+        query += ' WHERE (created_at, id) < (?, ?)'
+        params += list(after)
+    query += ' ORDER BY created_at DESC, id DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+
+    with metrics.DB_QUERY_SECONDS.time(statement='list_videos'):
+        return get_connection().execute(query, params).fetchall()
+
+
+def search_videos(fields, match, limit, offset=0):
+    """Return videos matching an FTS5 query, best match first
+
+    Names weigh more than original filenames in the bm25 ranking.
+    """
+    columns = [VIDEO_LIST_COLUMNS[f] for f in fields]
+
+    query = f'''
+        SELECT {', '.join(columns)} FROM videos
+        JOIN (
+            SELECT rowid AS match_id, bm25(videos_fts, 10.0, 1.0) AS rank
+            FROM videos_fts
+            WHERE videos_fts MATCH ?
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        ) AS matches ON videos.id = matches.match_id
+        ORDER BY matches.rank
+    '''
+    with metrics.DB_QUERY_SECONDS.time(statement='search_videos'):
+        return get_connection().execute(query, (match, limit, offset)).fetchall()
+
+
+def table_columns(table):
+    """Return the column names of a table"""
+    return [row[1] for row in get_connection().execute(f'PRAGMA table_info({table})')]
+
+
+def init_schema():
+    """Create tables, indexes and triggers, and add missing columns"""
+    with transaction(immediate=True) as conn:
+        fts_existed = query_one('fts_exists') is not None
+
+        for statement in SCHEMA:
+            conn.execute(statement)
+
+        for table, column, column_type in REQUIRED_COLUMNS:
+            if column not in table_columns(table):
+                print(f"Adding {column} column to {table} table...")
+                conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+        for statement in DATA_MIGRATIONS + INDEXES + TRIGGERS:
+            conn.execute(statement)
+
+        # Index the existing library the first time the search index is created
+        if not fts_existed:
+            execute('fts_rebuild')
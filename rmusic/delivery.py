@@ -0,0 +1,163 @@
+"""
+File delivery for media, thumbnails and static assets
+The serving mode decides who moves the bytes:
+  python      read the file in Python in SERVE_READ_SIZE blocks
+  sendfile    let the WSGI server send the file with the kernel's sendfile()
+              (falls back to python when the server has no wsgi.file_wrapper)
+  x-accel     hand the file to nginx with X-Accel-Redirect
+  x-sendfile  hand the file to Apache/lighttpd with X-Sendfile
+In the python and sendfile modes Range, If-Range and ETag are handled here,
+the proxy modes leave them to the proxy.
+Files in a remote store (see storage.py) are streamed from it by send_object().
+Built static assets are sent in a precompressed variant (see assets.py) by
+send_precompressed(). file_response() decides status and headers without an
+app context, so the async server (asgi.py) answers ranges the same way.
+"""
+
+import mimetypes
+import os
+from urllib.parse import quote
+
+from flask import current_app, request, Response
+from werkzeug.exceptions import NotFound, RequestedRangeNotSatisfiable
+from werkzeug.security import safe_join
+
+SERVE_MODES = ('python', 'sendfile', 'x-accel', 'x-sendfile')
+PRECOMPRESSED = (('br', '.br'), ('gzip', '.gz'))  # Content-Encoding and file suffix, preferred first
+
+
+def send_media(folder, filename, mimetype=None, max_age=None):
+    """Send a file from folder using the configured serving mode
+
+    Without max_age the response must be revalidated, which is cheap thanks to
+    the ETag.
+    Raises NotFound for missing files and paths outside of folder.
+    """
+    # Relative folders are resolved like send_from_directory does
+    path = safe_join(os.path.join(current_app.root_path, folder), filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mode = current_app.config['SERVE_MODE']
+
+    if mode == 'x-accel':
+        # nginx: location <SERVE_X_ACCEL_PREFIX> { internal; alias <app folder>/; }
+        response = _new_response(filename, mimetype, max_age)
+        prefix = current_app.config['SERVE_X_ACCEL_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = quote(f"{prefix}/{folder}/{filename}")
+        return response
+
+    if mode == 'x-sendfile':
+        response = _new_response(filename, mimetype, max_age)
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+        return response
+
+    # Decide between 200, 206 and 304 before opening the file
+    stat = os.stat(path)
+    response, start = file_response(
+        request.environ, filename, stat.st_size, stat.st_mtime, f"{stat.st_mtime_ns:x}-{stat.st_size:x}",
+        mimetype, max_age
+    )
+    if start is None:
+        return response
+    length = response.content_length
+
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if mode == 'sendfile' and file_wrapper is not None:
+        # The server sends Content-Length bytes from the current position
+        f = open(path, 'rb')
+        f.seek(start)
+        response.response = file_wrapper(f, current_app.config['SERVE_READ_SIZE'])
+    else:
+        response.response = _read_range(path, start, length, current_app.config['SERVE_READ_SIZE'])
+
+    return response
+
+
+def send_precompressed(folder, filename, mimetype=None, max_age=None):
+    """Send a file, or the .br/.gz variant next to it that the client accepts
+
+    The variant is sent as it is with Content-Encoding set, so nothing is
+    compressed per request.
+    """
+    mimetype = mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    directory = os.path.join(current_app.root_path, folder)
+
+    for encoding, suffix in PRECOMPRESSED:
+        path = safe_join(directory, filename + suffix)
+        if request.accept_encodings[encoding] and path is not None and os.path.isfile(path):
+            response = send_media(folder, filename + suffix, mimetype=mimetype, max_age=max_age)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_media(folder, filename, mimetype=mimetype, max_age=max_age)
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def send_object(store, name, mimetype=None, max_age=None):
+    """Stream a file from a storage backend, with the same Range and ETag handling
+
+    Raises NotFound for missing files.
+    """
+    stat = store.stat(name)
+    if stat is None:
+        raise NotFound()
+
+    response, start = file_response(
+        request.environ, name, stat['size'], stat['mtime'], stat['etag'], mimetype, max_age
+    )
+    if start is not None:
+        response.response = store.read(name, start, response.content_length)
+    return response
+
+
+def _new_response(filename, mimetype=None, max_age=None):
+    response = Response(
+        mimetype=mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        direct_passthrough=True
+    )
+
+    if max_age is None:
+        response.cache_control.no_cache = True
+    else:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
+
+def file_response(environ, filename, size, mtime, etag, mimetype=None, max_age=None):
+    """Status and headers of a file response, from the request's Range and validators
+
+    Returns (response, start): the caller adds the body from byte start on,
+    Content-Length bytes of it. start is None when no body is sent (304, 416
+    or HEAD).
+    """
+    response = _new_response(filename, mimetype, max_age)
+    response.accept_ranges = 'bytes'
+    response.content_length = size
+    response.last_modified = mtime
+    response.set_etag(etag)
+
+    try:
+        response.make_conditional(environ, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response(environ), None
+
+    if response.status_code not in (200, 206) or environ['REQUEST_METHOD'] == 'HEAD':
+        response.response = []
+        return response, None
+
+    return response, response.content_range.start if response.status_code == 206 else 0
+
+
+def _read_range(path, start, length, read_size):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(read_size, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Move the MP4/MOV index to the front of every file in the library
+Files are remuxed without re-encoding, so playback can start right away.
+Usage: python faststart.py [--dry-run]
+"""
+
+import os
+import sys
+
+import db
+import storage
+from media import needs_faststart, ensure_faststart, FASTSTART_EXTENSIONS
+
+UPLOAD_FOLDER = 'upload'
+
+def optimize_library(dry_run=False):
+    """Remux every file that hasn't been checked yet"""
+    storage_names = [row[0] for row in db.query_all('videos_missing_faststart')]
+    video_store = storage.open_store(UPLOAD_FOLDER)
+    
+    print(f"Files to check: {len(storage_names)}")
+    
+    optimized_count = 0
+    skipped_count = 0
+    failed_count = 0
+    
+    for storage_name in storage_names:
+        stat = video_store.stat(storage_name)
+        
+        if stat is None:
+            print(f"  ✗ Missing file: {storage_name}")
+            failed_count += 1
+            continue
+        
+        # Other formats are marked as checked so they aren't looked at again
+        if not storage_name.lower().endswith(FASTSTART_EXTENSIONS):
+            if not dry_run:
+                db.execute('video_set_faststart', (0, stat['size'], storage_name))
+            skipped_count += 1
+            continue
+        
+        # Objects in a remote store are remuxed in a downloaded copy
+        with video_store.fetch(storage_name) as video_path:
+            if dry_run:
+                needed = needs_faststart(video_path)
+                print(f"  {'needs remux' if needed else 'ok':>11}: {storage_name}")
+                continue
+            
+            optimized = ensure_faststart(video_path)
+            if optimized is False:
+                print(f"  ✗ Remux failed: {storage_name}")
+                failed_count += 1
+                continue
+            
+            file_size = os.path.getsize(video_path)
+            if optimized == 'remuxed' and not video_store.local:
+                video_store.save(storage_name, video_path)
+        
+        db.execute('video_set_faststart', (1 if optimized else 0, file_size, storage_name))
+        optimized_count += 1
+        print(f"  ✓ {storage_name}")
+    
+    print(f"\nOptimized: {optimized_count}, skipped: {skipped_count}, failed: {failed_count}")
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print("Faststart Library Optimizer")
+    print("=" * 50)
+    
+    db.init_schema()
+    optimize_library(dry_run='--dry-run' in sys.argv)
+    db.close_connection()
+    
+    print("=" * 50)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Import an existing media directory into the library
+Files are validated like uploads, hard-linked into the upload folder (copied
+only when the source is on another filesystem), saved to the video store when
+it isn't local (RMUSIC_STORAGE) and added in batched
+transactions together with the same background jobs an upload gets. Every
+imported path is recorded, so an interrupted import can simply be run again.
+Files whose content is already stored become rows sharing the stored file.
+New files are probed with ffprobe for their duration and stream details.
+Thumbnails are made by the queued thumbnail jobs once the server runs.
+Usage: python import_library.py <directory> [--copy] [--move] [--dry-run]
+"""
+
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import jobs
+import layout
+import uploads
+from server import (
+    clean_upload_filename, find_blob, generate_unique_filename, video_store,
+    UPLOAD_FOLDER, VIDEO_EXTENSIONS, AUDIO_EXTENSIONS
+)
+from media import FASTSTART_EXTENSIONS, METADATA_FIELDS, ffprobe_available, probe_media
+
+BATCH_SIZE = 200  # files hashed, placed and committed together
+HASH_WORKERS = 4  # files hashed or probed at once, hashlib and ffprobe release the GIL
+
+def find_files(source_dir):
+    """Yield the paths of all files under source_dir in a stable order"""
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(files):
+            if not name.startswith('.') and not name.endswith(uploads.PART_SUFFIX):
+                yield os.path.abspath(os.path.join(root, name))
+
+def hash_source(path):
+    try:
+        return uploads.hash_file(path)
+    except OSError as e:
+        print(f"  ✗ Can't read {path}: {e}")
+        return None
+
+def storage_name_for(original_filename, content_hash):
+    """Stored file name derived from the content, so a re-run finds the files it already placed"""
+    base, ext = original_filename.rsplit('.', 1)
+    return f"{base}_{content_hash[:12]}.{ext.lower()}"
+
+def place_file(source_path, target_path, copy=False):
+    """Hard-link a file into the upload folder, copying when that isn't possible"""
+    if os.path.exists(target_path):
+        return 'existing'
+    
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    if not copy:
+        try:
+            os.link(source_path, target_path)
+            return 'linked'
+        except OSError:
+            # Another filesystem, or links aren't supported
+            pass
+    
+    temp_path = target_path + uploads.PART_SUFFIX
+    shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+    return 'copied'
+
+def import_batch(batch, stats, copy=False, move=False):
+    """Place and register a batch of (source_path, original_filename) files"""
+    with ThreadPoolExecutor(HASH_WORKERS) as pool:
+        hashes = list(pool.map(hash_source, [source_path for source_path, _ in batch]))
+    
+    rows = []
+    records = []
+    placed = []  # storage names of the new files
+    stored = {}  # content hash -> blob, for copies within the batch
+    now = time.time()
+    
+    for (source_path, original_filename), content_hash in zip(batch, hashes):
+        if content_hash is None:
+            stats['failed'] += 1
+            continue
+        
+        video_name = original_filename.rsplit('.', 1)[0]
+        blob = stored.get(content_hash) or find_blob(content_hash)
+        
+        if blob:
+            # Same content as a stored file: a new row pointing at it
+            filename = generate_unique_filename(original_filename)
+            rows.append((
+                video_name, filename, original_filename, blob['file_size'], blob['thumbnail'],
+                blob['thumbnail_variants'], content_hash, blob['storage_name'], blob['hls'], blob['previews'],
+                blob['waveform']
+            ))
+            stats['duplicates'] += 1
+        else:
+            filename = storage_name_for(original_filename, content_hash)
+            # An earlier run may have stored it already
+            try:
+                if video_store.exists(filename):
+                    how = 'existing'
+                else:
+                    target_path = layout.path(UPLOAD_FOLDER, filename)
+                    how = place_file(source_path, target_path, copy)
+                    video_store.save(filename, target_path)
+            except Exception as e:
+                print(f"  ✗ Can't place {source_path}: {e}")
+                stats['failed'] += 1
+                continue
+            stats[how] += 1
+            
+            file_size = video_store.stat(filename)['size']
+            stored[content_hash] = {
+                'storage_name': filename, 'file_size': file_size, 'thumbnail': None,
+                'thumbnail_variants': None, 'hls': None, 'previews': None, 'waveform': None
+            }
+            rows.append((
+                video_name, filename, original_filename, file_size, None,
+                None, content_hash, filename, None, None, None
+            ))
+            placed.append(filename)
+        
+        records.append((source_path, filename, now))
+    
+    probed = []
+    if ffprobe_available():
+        with ThreadPoolExecutor(HASH_WORKERS) as pool:
+            paths = [video_store.source(storage_name) for storage_name in placed]
+            for storage_name, metadata in zip(placed, pool.map(probe_media, paths)):
+                values = [metadata[field] for field in METADATA_FIELDS] if metadata else [None] * len(METADATA_FIELDS)
+                probed.append((*values, 1 if metadata else 0, storage_name))
+    
+    # Rows, jobs and the record of imported paths commit together
+    with db.transaction():
+        db.executemany('video_insert', rows)
+        db.executemany('import_file_insert', records)
+        db.executemany('video_set_metadata', probed)
+        
+        for row in rows:
+            storage_name = row[7]
+            video_id = db.query_value('video_id_by_filename', (row[1],))
+            if row[1] != storage_name:
+                db.execute('video_copy_metadata', (video_id,))
+                continue
+            if storage_name.lower().endswith(AUDIO_EXTENSIONS):
+                jobs.enqueue('waveform', video_id)
+            if not storage_name.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            # The same jobs an upload gets
+            if storage_name.lower().endswith(FASTSTART_EXTENSIONS):
+                jobs.enqueue('faststart', video_id)
+            jobs.enqueue('thumbnail', video_id)
+            jobs.enqueue('previews', video_id)
+            jobs.enqueue('hls', video_id)
+    
+    stats['imported'] += len(rows)
+    
+    if move:
+        for source_path, _, _ in records:
+            os.remove(source_path)
+
+def remove_imported_source(source_path):
+    """--move on a re-run: drop sources imported before an interruption"""
+    storage_name = db.query_value('import_file_stored', (source_path,))
+    if storage_name and video_store.exists(storage_name):
+        os.remove(source_path)
+
+def import_library(source_dir, copy=False, move=False, dry_run=False):
+    """Import every allowed file under source_dir; returns the number of new rows"""
+    recorded = {row[0] for row in db.query_all('import_files_all')}
+    stats = dict.fromkeys(('imported', 'linked', 'copied', 'existing', 'duplicates', 'failed'), 0)
+    already_imported = 0
+    rejected = 0
+    batch = []
+    
+    for source_path in find_files(source_dir):
+        if source_path in recorded:
+            already_imported += 1
+            if move and not dry_run:
+                remove_imported_source(source_path)
+            continue
+        
+        original_filename, error = clean_upload_filename(os.path.basename(source_path))
+        if error:
+            rejected += 1
+            continue
+        
+        batch.append((source_path, original_filename))
+        if len(batch) >= BATCH_SIZE:
+            if not dry_run:
+                import_batch(batch, stats, copy, move)
+                print(f"  ✓ {stats['imported']} files imported")
+            else:
+                stats['imported'] += len(batch)
+            batch = []
+    
+    if batch:
+        if not dry_run:
+            import_batch(batch, stats, copy, move)
+        else:
+            stats['imported'] += len(batch)
+    
+    verb = 'Would import' if dry_run else 'Imported'
+    print(f"\n{verb}: {stats['imported']}, already imported: {already_imported}, not supported: {rejected}")
+    if not dry_run:
+        print(f"Linked: {stats['linked']}, copied: {stats['copied']}, already placed: {stats['existing']}, "
+              f"duplicates: {stats['duplicates']}, failed: {stats['failed']}")
+    return stats['imported']
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        print(__doc__.strip().splitlines()[-1])
+        sys.exit(1)
+    
+    if os.path.commonpath([os.path.abspath(args[0]), os.path.abspath(UPLOAD_FOLDER)]) == os.path.abspath(UPLOAD_FOLDER):
+        print("The upload folder can't be imported into itself")
+        sys.exit(1)
+    
+    print("=" * 50)
+    print("Library Import")
+    print("=" * 50)
+    
+    db.init_schema()
+    dry_run = '--dry-run' in sys.argv
+    import_library(args[0], copy='--copy' in sys.argv, move='--move' in sys.argv, dry_run=dry_run)
+    
+    db.close_connection()
+    
+    print("=" * 50)
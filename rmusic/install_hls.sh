@@ -0,0 +1,23 @@
+#!/bin/bash
+
+# Vendor hls.js into js/vendor so the page doesn't load a third-party script.
+# The asset build fingerprints it like the other scripts; bump HLS_VERSION to upgrade.
+HLS_VERSION="1.5.17"
+TARGET="$(dirname "$0")/js/vendor/hls.min.js"
+
+echo "Downloading hls.js $HLS_VERSION..."
+mkdir -p "$(dirname "$TARGET")"
+TMP_DIR="$(mktemp -d)"
+trap 'rm -rf "$TMP_DIR"' EXIT
+
+curl -fsSL "https://registry.npmjs.org/hls.js/-/hls.js-$HLS_VERSION.tgz" -o "$TMP_DIR/hls.tgz" \
+    && tar -xzf "$TMP_DIR/hls.tgz" -C "$TMP_DIR" package/dist/hls.min.js \
+    && cp "$TMP_DIR/package/dist/hls.min.js" "$TARGET"
+
+if [ $? -eq 0 ]; then
+    echo " hls.js $HLS_VERSION saved to $TARGET, commit it with the other assets"
+    echo " sha384: $(openssl dgst -sha384 -binary "$TARGET" | openssl base64 -A)"
+else
+    echo " hls.js download failed"
+    exit 1
+fi
@@ -0,0 +1,183 @@
+"""
+Persistent background job queue backed by SQLite
+Jobs are stored in the videos database so they survive restarts and are
+processed by a bounded pool of worker threads
+"""
+
+import json
+import threading
+import time
+
+import db
+import logs
+import metrics
+
+# Queue settings
+WORKER_COUNT = 2
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 5  # seconds, doubled after every failed attempt
+LEASE_SECONDS = 300  # a running job whose lease expired is picked up again
+LEASE_RENEW_INTERVAL = LEASE_SECONDS / 5  # seconds between lease renewals of running jobs
+POLL_INTERVAL = 2.0
+
+_handlers = {}
+_workers = []
+_running = set()  # ids of the jobs this process is working on
+_running_lock = threading.Lock()
+_start_lock = threading.Lock()
+_wakeup = threading.Event()
+
+
+class PermanentError(Exception):
+    """Raised by a handler when retrying can't help; the job fails right away"""
+
+
+def register_handler(kind, handler):
+    """Register the function that processes jobs of a given kind"""
+    _handlers[kind] = handler
+
+
+def enqueue(kind, video_id=None, payload=None, max_attempts=MAX_ATTEMPTS, delay=0):
+    """Add a job to the queue and return its id
+
+    Called inside db.transaction() the job only becomes visible once the
+    caller's transaction commits. delay postpones the job by that many seconds.
+    """
+    now = time.time()
+    cursor = db.execute('job_insert', (
+        kind, video_id, json.dumps(payload) if payload is not None else None,
+        max_attempts, now + delay, now, now
+    ))
+    _wakeup.set()
+    return cursor.lastrowid
+
+
+def has_active_job(kind):
+    """Whether a job of this kind is waiting or running"""
+    return db.query_one('job_active_of_kind', (kind,)) is not None
+
+
+def get_job(job_id):
+    """Return job details as a dict, or None if it doesn't exist"""
+    row = db.query_one('job_get', (job_id,))
+    return dict(row) if row else None
+
+
+def queue_depth():
+    """Return the number of jobs per status"""
+    return {status: count for status, count in db.query_all('job_counts_by_status')}
+
+
+metrics.Gauge(
+    'rmusic_jobs', 'Background jobs waiting or running', ('kind', 'status'),
+    collect=lambda: {(kind, status): count for kind, status, count in db.query_all('job_counts_by_kind')}
+)
+
+
+def _claim_next_job():
+    """Atomically mark the next runnable job as running and return it"""
+    now = time.time()
+    with db.transaction(immediate=True):
+        row = db.query_one('job_next_runnable', (now, now))
+        if not row:
+            return None
+        db.execute('job_claim', (now + LEASE_SECONDS, now, row['id']))
+
+    job = dict(row)
+    job['attempts'] += 1
+    job['payload'] = json.loads(job['payload']) if job['payload'] else None
+    return job
+
+
+def _complete_job(job_id):
+    db.execute('job_complete', (time.time(), job_id))
+
+
+def _fail_job(job, error, permanent=False):
+    """Schedule a retry with exponential backoff, or give up after max attempts"""
+    now = time.time()
+
+    if job['attempts'] < job['max_attempts'] and not permanent:
+        delay = RETRY_BASE_DELAY * (2 ** (job['attempts'] - 1))
+        db.execute('job_retry', (now + delay, error, now, job['id']))
+        logs.warning('job_retry', kind=job['kind'], attempt=job['attempts'], retry_in=delay, error=error)
+    else:
+        db.execute('job_fail', (error, now, job['id']))
+        logs.error('job_failed', kind=job['kind'], attempt=job['attempts'], error=error)
+
+
+def _renew_leases():
+    """Extend the leases of the jobs running here, so long encodes aren't picked up twice"""
+    while True:
+        time.sleep(LEASE_RENEW_INTERVAL)
+        with _running_lock:
+            job_ids = list(_running)
+        if not job_ids:
+            continue
+        locked_until = time.time() + LEASE_SECONDS
+        try:
+            with db.transaction():
+                db.executemany('job_renew', [(locked_until, job_id) for job_id in job_ids])
+        except Exception as e:
+            logs.error('job_lease_error', error=str(e))
+
+
+def _run_job(job):
+    """Run the handler of a claimed job and record the outcome"""
+    handler = _handlers.get(job['kind'])
+    if handler is None:
+        _fail_job(job, f"No handler registered for job kind '{job['kind']}'")
+        return
+
+    # Log lines written by the handler carry the job id
+    token = logs.context_id.set(f"job-{job['id']}")
+    start = time.perf_counter()
+    with _running_lock:
+        _running.add(job['id'])
+    try:
+        handler(job)
+        _complete_job(job['id'])
+        outcome = 'done'
+    except Exception as e:
+        _fail_job(job, str(e) or e.__class__.__name__, permanent=isinstance(e, PermanentError))
+        outcome = 'failed'
+    finally:
+        with _running_lock:
+            _running.discard(job['id'])
+        logs.context_id.reset(token)
+
+    metrics.JOB_SECONDS.observe(time.perf_counter() - start, kind=job['kind'], outcome=outcome)
+
+
+def _worker_loop():
+    while True:
+        try:
+            job = _claim_next_job()
+        except Exception as e:
+            logs.error('job_queue_error', error=str(e))
+            job = None
+
+        if job is None:
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+
+        _run_job(job)
+
+
+def start_workers(count=None):
+    """Start the worker pool once per process"""
+    if _workers:
+        return
+
+    with _start_lock:
+        if _workers:
+            return
+
+        for i in range(count or WORKER_COUNT):
+            worker = threading.Thread(target=_worker_loop, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+
+        threading.Thread(target=_renew_leases, name="job-lease-renewer", daemon=True).start()
+        logs.info('job_workers_started', count=len(_workers))
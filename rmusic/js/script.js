@@ -28,6 +28,7 @@ const playerSystem = {
         btnMinimize: getElementByIdSafe("minimize"),
         bar: document.querySelector(".bar"),
         progress: document.querySelector(".prbar"),
+        waveform: document.querySelector(".waveform"),
         time1: getElementByIdSafe("time1"),
         time2: getElementByIdSafe("time2")
     },
@@ -45,6 +46,23 @@ const playerSystem = {
     currentIndex: -1,
     isPlaying: false,
     currentVideoId: null,
+    nextCursor: null,
+    isLoadingPage: false,
+    pageSize: 48,
+    pageObserver: null,
+    cardListenersBound: false,
+    searchQuery: '',
+    searchAbort: null,
+    searchDelay: 250,
+    listFields: ['id', 'name', 'filename', 'file_size', 'duration', 'thumbnail_url', 'thumbnail_sources', 'url', 'hls_url', 'preview_url', 'waveform_url'],
+    // Rendered width of a card thumbnail, lets the browser pick the smallest sufficient variant
+    thumbnailSizes: '(max-width: 480px) 50vw, 320px',
+    hlsPlayers: [],
+    previewUrl: null,
+    previewCues: [],
+    previewTooltip: null,
+    waveformUrl: null,
+    waveformLevels: [],
     
     init: function() {
         console.log("🎬 Initializing player system...");
@@ -56,21 +74,15 @@ const playerSystem = {
     },
     
     fetchVideosFromServer: async function() {
+        // Keep showing search results while a search is active
+        if (this.searchQuery) return this.searchLibrary(this.searchQuery);
+        
         try {
-            const response = await fetch('/videos');
-            
-            if (!response.ok) {
-                throw new Error(`Server error: ${response.status}`);
-            }
+            const page = await this.fetchVideoPage(null);
             
-            const videos = await response.json();
-            
-            if (!Array.isArray(videos)) {
-                throw new Error('Invalid response format');
-            }
-            
-            this.videos = videos;
-            this.currentPlaylist = [...videos];
+            this.videos = page.videos;
+            this.currentPlaylist = [...page.videos];
+            this.nextCursor = page.next_cursor;
             
             console.log(`✅ Loaded ${this.videos.length} videos`);
             this.buildVideoCards();
@@ -82,6 +94,106 @@ const playerSystem = {
         }
     },
     
+    fetchVideoPage: async function(cursor) {
+        const params = new URLSearchParams({
+            limit: this.pageSize,
+            fields: this.listFields.join(',')
+        });
+        if (cursor) params.set('after', cursor);
+        
+        // The server answers 304 while the library is unchanged, the browser reuses its cached copy
+        const response = await fetch(`/videos?${params}`);
+        
+        if (!response.ok) {
+            throw new Error(`Server error: ${response.status}`);
+        }
+        
+        const page = await response.json();
+        
+        if (!page || !Array.isArray(page.videos)) {
+            throw new Error('Invalid response format');
+        }
+        
+        return page;
+    },
+    
+    searchLibrary: async function(query) {
+        this.searchQuery = query;
+        
+        // Drop the results of a search the user has already typed past
+        if (this.searchAbort) this.searchAbort.abort();
+        
+        if (!query) return this.fetchVideosFromServer();
+        
+        const controller = new AbortController();
+        this.searchAbort = controller;
+        
+        try {
+            const page = await this.fetchSearchPage(query, 0, controller.signal);
+            
+            this.videos = page.videos;
+            this.currentPlaylist = [...page.videos];
+            this.nextCursor = page.next_offset;
+            
+            this.buildVideoCards();
+            
+        } catch (error) {
+            if (error.name === 'AbortError') return;
+            console.error("❌ Search error:", error);
+            this.showError("تعذر البحث. تأكد من اتصال السيرفر.");
+        }
+    },
+    
+    fetchSearchPage: async function(query, offset, signal) {
+        const params = new URLSearchParams({
+            q: query,
+            offset: offset,
+            limit: this.pageSize,
+            fields: this.listFields.join(',')
+        });
+        
+        const response = await fetch(`/search?${params}`, { signal });
+        
+        if (!response.ok) {
+            throw new Error(`Server error: ${response.status}`);
+        }
+        
+        const page = await response.json();
+        
+        if (!page || !Array.isArray(page.videos)) {
+            throw new Error('Invalid response format');
+        }
+        
+        return page;
+    },
+    
+    loadNextPage: async function() {
+        if (!this.nextCursor || this.isLoadingPage) return;
+        
+        const query = this.searchQuery;
+        this.isLoadingPage = true;
+        try {
+            const page = query ?
+                await this.fetchSearchPage(query, this.nextCursor) :
+                await this.fetchVideoPage(this.nextCursor);
+            
+            // The search changed while this page was loading
+            if (query !== this.searchQuery) return;
+            
+            this.videos.push(...page.videos);
+            this.currentPlaylist.push(...page.videos);
+            this.nextCursor = query ? page.next_offset : page.next_cursor;
+            
+            console.log(`✅ Loaded ${page.videos.length} more videos`);
+            this.appendVideoCards(page.videos);
+            
+        } catch (error) {
+            console.error("❌ Error loading more videos:", error);
+        } finally {
+            this.isLoadingPage = false;
+        }
+    },
+    
     buildVideoCards: function() {
         const container = getElementByIdSafe('contentcatd');
         if (!container) {
@@ -91,6 +203,18 @@ const playerSystem = {
         
         container.innerHTML = '';
         
+        if (this.videos.length === 0 && this.searchQuery) {
+            const noResults = createElementWithClass('div', 'empty-state');
+            noResults.innerHTML = `
+                <i class="fas fa-search"></i>
+                <h3>No results</h3>
+                <p>No matching videos were found.</p>
+            `;
+            noResults.querySelector('p').textContent += ` "${this.searchQuery}"`;
+            container.appendChild(noResults);
+            return;
+        }
+        
         if (this.videos.length === 0) {
             container.innerHTML = `
                 <div class="empty-state">
@@ -110,14 +234,46 @@ const playerSystem = {
         });
         
         this.setupCardEventListeners();
+        this.observePageEnd(container);
         console.log("✅ Video cards built successfully");
     },
     
+    appendVideoCards: function(videos) {
+        const container = getElementByIdSafe('contentcatd');
+        if (!container) return;
+        
+        const sentinel = container.querySelector('.page-sentinel');
+        const fragment = document.createDocumentFragment();
+        videos.forEach(video => fragment.appendChild(this.createVideoCard(video)));
+        container.insertBefore(fragment, sentinel);
+        
+        if (!this.nextCursor && sentinel) {
+            this.pageObserver.disconnect();
+            sentinel.remove();
+        }
+    },
+    
+    observePageEnd: function(container) {
+        if (this.pageObserver) this.pageObserver.disconnect();
+        if (!this.nextCursor) return;
+        
+        // Load the next page shortly before the user scrolls to the end of the grid
+        const sentinel = createElementWithClass('div', 'page-sentinel');
+        container.appendChild(sentinel);
+        
+        this.pageObserver = new IntersectionObserver((entries) => {
+            if (entries.some(entry => entry.isIntersecting)) this.loadNextPage();
+        }, { rootMargin: '600px' });
+        this.pageObserver.observe(sentinel);
+    },
+    
     createVideoCard: function(video) {
         const card = createElementWithClass('div', 'card');
         card.dataset.id = video.id;
         card.dataset.title = video.name;
         card.dataset.filename = video.filename;
+        card.dataset.url = video.url;
+        card.dataset.hls = video.hls_url || '';
         
         // Get file extension
         const ext = video.filename.split('.').pop().toLowerCase();
@@ -129,24 +285,43 @@ const playerSystem = {
         
         // Check if thumbnail exists
         if (video.thumbnail_url && isVideo) {
+            // WebP/AVIF variants at several widths, the JPEG is the fallback
+            const picture = document.createElement('picture');
+            (video.thumbnail_sources || []).forEach(source => {
+                const sourceEl = document.createElement('source');
+                sourceEl.type = source.type;
+                sourceEl.srcset = source.srcset;
+                sourceEl.sizes = this.thumbnailSizes;
+                picture.appendChild(sourceEl);
+            });
+            
             // Create image element for thumbnail
             const img = document.createElement('img');
             img.src = video.thumbnail_url;
             img.alt = video.name;
             img.loading = 'lazy';
+            img.decoding = 'async';
             img.onerror = () => {
                 // If thumbnail fails to load, show fallback
                 img.style.display = 'none';
                 thumbnail.style.background = this.getFallbackGradient(ext);
                 thumbnail.innerHTML = `<i class="${this.getFileIcon(ext)}"></i>`;
             };
-            thumbnail.appendChild(img);
+            picture.appendChild(img);
+            thumbnail.appendChild(picture);
         } else {
             // Show fallback based on file type
             thumbnail.style.background = this.getFallbackGradient(ext);
             thumbnail.innerHTML = `<i class="${this.getFileIcon(ext)}"></i>`;
         }
         
+        // Duration probed at upload
+        if (video.duration) {
+            const duration = createElementWithClass('span', 'card-duration');
+            duration.textContent = this.formatTime(video.duration);
+            thumbnail.appendChild(duration);
+        }
+        
         // File info
         const fileSize = video.file_size ? 
             this.formatFileSize(video.file_size) : 'غير معروف';
@@ -233,6 +408,11 @@ const playerSystem = {
         this.mainPlayer.btnBack.onclick = () => this.playPrevious();
         this.mainPlayer.btnNext.onclick = () => this.playNext();
         this.mainPlayer.progress.onclick = (e) => this.seekVideo(e);
+        this.mainPlayer.progress.onmousemove = (e) => this.showPreview(e);
+        this.mainPlayer.progress.onmouseleave = () => this.hidePreview();
+        if (this.mainPlayer.waveform) {
+            this.mainPlayer.waveform.onclick = (e) => this.seekVideo(e, this.mainPlayer.waveform);
+        }
     },
     
     bindMiniPlayerEvents: function() {
@@ -244,7 +424,8 @@ const playerSystem = {
     
     setupCardEventListeners: function() {
         const container = getElementByIdSafe('contentcatd');
-        if (!container) return;
+        if (!container || this.cardListenersBound) return;
+        this.cardListenersBound = true;
         
         container.addEventListener("click", (e) => {
             if (e.target.closest('.play-btn')) {
@@ -327,20 +508,25 @@ const playerSystem = {
     handleCardClick: function(card) {
         const videoId = parseInt(card.dataset.id);
         const videoTitle = card.dataset.title;
-        const videoFilename = card.dataset.filename;
+        const videoUrl = card.dataset.url;
+        const hlsUrl = card.dataset.hls;
         
-        this.playVideo(videoFilename, videoTitle, videoId);
+        this.playVideo(videoUrl, videoTitle, videoId, hlsUrl);
     },
     
-    playVideo: function(filename, title, videoId = -1) {
+    playVideo: function(videoSrc, title, videoId = -1, hlsSrc = null) {
         this.stopAllVideos();
         this.currentVideoId = videoId;
         
         this.currentIndex = this.currentPlaylist.findIndex(v => v.id === videoId);
         if (this.currentIndex === -1) this.currentIndex = 0;
         
-        const videoSrc = `/video/${filename}`;
-        this.setupVideoElements(videoSrc);
+        const current = this.currentPlaylist[this.currentIndex];
+        this.loadPreviews(current && current.id === videoId ? current.preview_url : null);
+        this.loadWaveform(current && current.id === videoId ? current.waveform_url : null);
+        
+        // Duplicate uploads share one stored file, so play the URL the server gave us
+        this.setupVideoElements(videoSrc, hlsSrc);
         
         if (this.mainPlayer.title) {
             this.mainPlayer.title.textContent = title;
@@ -356,14 +542,17 @@ const playerSystem = {
         this.updatePlayButtons();
     },
     
-    setupVideoElements: function(src) {
+    setupVideoElements: function(src, hlsSrc = null) {
         if (!this.mainPlayer.video) return;
         
         this.mainPlayer.video.pause();
         if (this.miniPlayer.video) this.miniPlayer.video.pause();
         
-        this.mainPlayer.video.src = src;
-        if (this.miniPlayer.video) this.miniPlayer.video.src = src;
+        this.hlsPlayers.forEach(hls => hls.destroy());
+        this.hlsPlayers = [];
+        
+        this.attachSource(this.mainPlayer.video, src, hlsSrc);
+        if (this.miniPlayer.video) this.attachSource(this.miniPlayer.video, src, hlsSrc);
         
         if (this.miniPlayer.visible && this.miniPlayer.video) {
             this.mainPlayer.video.muted = true;
@@ -372,9 +561,37 @@ const playerSystem = {
             this.mainPlayer.video.muted = false;
             if (this.miniPlayer.video) this.miniPlayer.video.muted = true;
         }
-        
-        this.mainPlayer.video.load();
-        if (this.miniPlayer.video) this.miniPlayer.video.load();
+    },
+    
+    attachSource: function(video, src, hlsSrc) {
+        // Adaptive stream when the video has an HLS ladder, the original file otherwise
+        video.onerror = null;
+        if (hlsSrc && video.canPlayType('application/vnd.apple.mpegurl')) {
+            video.onerror = () => {
+                console.warn("⚠️ HLS playback failed, falling back to original file");
+                video.onerror = null;
+                video.src = src;
+                video.load();
+            };
+            video.src = hlsSrc;
+            video.load();
+        } else if (hlsSrc && window.Hls && Hls.isSupported()) {
+            const hls = new Hls();
+            hls.on(Hls.Events.ERROR, (event, data) => {
+                if (!data.fatal) return;
+                console.warn("⚠️ HLS playback failed, falling back to original file:", data.details);
+                hls.destroy();
+                this.hlsPlayers = this.hlsPlayers.filter(h => h !== hls);
+                video.src = src;
+                video.load();
+            });
+            hls.loadSource(hlsSrc);
+            hls.attachMedia(video);
+            this.hlsPlayers.push(hls);
+        } else {
+            video.src = src;
+            video.load();
+        }
     },
     
     attemptVideoPlay: function() {
@@ -446,7 +663,7 @@ const playerSystem = {
         const nextVideo = this.currentPlaylist[nextIndex];
         
         if (nextVideo) {
-            this.playVideo(nextVideo.filename, nextVideo.name, nextVideo.id);
+            this.playVideo(nextVideo.url, nextVideo.name, nextVideo.id, nextVideo.hls_url);
         }
     },
     
@@ -465,7 +682,7 @@ const playerSystem = {
         const prevVideo = this.currentPlaylist[prevIndex];
         
         if (prevVideo) {
-            this.playVideo(prevVideo.filename, prevVideo.name, prevVideo.id);
+            this.playVideo(prevVideo.url, prevVideo.name, prevVideo.id, prevVideo.hls_url);
         }
     },
     
@@ -473,15 +690,15 @@ const playerSystem = {
         if (this.currentIndex >= 0 && this.currentIndex < this.currentPlaylist.length) {
             const currentVideo = this.currentPlaylist[this.currentIndex];
             if (currentVideo) {
-                this.playVideo(currentVideo.filename, currentVideo.name, currentVideo.id);
+                this.playVideo(currentVideo.url, currentVideo.name, currentVideo.id, currentVideo.hls_url);
             }
         }
     },
     
-    seekVideo: function(e) {
-        if (!this.mainPlayer.progress) return;
+    seekVideo: function(e, target = this.mainPlayer.progress) {
+        if (!target) return;
         
-        const rect = this.mainPlayer.progress.getBoundingClientRect();
+        const rect = target.getBoundingClientRect();
         const percent = Math.max(0, Math.min(1, (e.clientX - rect.left) / rect.width));
         
         const video = this.miniPlayer.visible ? this.miniPlayer.video : this.mainPlayer.video;
@@ -493,6 +710,158 @@ const playerSystem = {
         }
     },
     
+    loadPreviews: async function(url) {
+        this.previewCues = [];
+        this.previewUrl = url || null;
+        this.hidePreview();
+        if (!url) return;
+        
+        try {
+            const response = await fetch(url);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const cues = this.parsePreviewTrack(await response.text(), response.url);
+            
+            // Another video started while the track was loading
+            if (this.previewUrl !== url) return;
+            this.previewCues = cues;
+            
+            // Load every sprite sheet once now, hovering never waits for the network
+            new Set(cues.map(cue => cue.image)).forEach(src => { new Image().src = src; });
+        } catch (error) {
+            console.warn("⚠️ Could not load preview track:", error);
+        }
+    },
+    
+    loadWaveform: async function(url) {
+        this.waveformLevels = [];
+        this.waveformUrl = url || null;
+        if (this.mainPlayer.waveform) this.mainPlayer.waveform.hidden = true;
+        if (!url || !this.mainPlayer.waveform) return;
+        
+        try {
+            const response = await fetch(url);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const levels = this.parseWaveform(await response.arrayBuffer());
+            
+            // Another track started while the peaks were loading
+            if (this.waveformUrl !== url) return;
+            this.waveformLevels = levels;
+            this.mainPlayer.waveform.hidden = false;
+            this.updateProgress();
+        } catch (error) {
+            console.warn("⚠️ Could not load waveform:", error);
+        }
+    },
+    
+    parseWaveform: function(buffer) {
+        // Header: "RMWF", version, level count, sample rate; then (samples per peak, peak count) per level
+        const view = new DataView(buffer);
+        const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+        if (magic !== 'RMWF' || view.getUint16(4, true) !== 1) throw new Error("Unknown waveform format");
+        
+        const count = view.getUint16(6, true);
+        const sampleRate = view.getUint32(8, true);
+        const levels = [];
+        let offset = 12 + count * 8;
+        for (let i = 0; i < count; i++) {
+            const samplesPerPeak = view.getUint32(12 + i * 8, true);
+            const peakCount = view.getUint32(16 + i * 8, true);
+            // Interleaved signed min/max pairs
+            levels.push({ peakSeconds: samplesPerPeak / sampleRate, peaks: new Int8Array(buffer, offset, peakCount * 2) });
+            offset += peakCount * 2;
+        }
+        return levels;
+    },
+    
+    drawWaveform: function(percent) {
+        const canvas = this.mainPlayer.waveform;
+        if (!canvas || canvas.hidden || !this.waveformLevels.length) return;
+        
+        const ratio = window.devicePixelRatio || 1;
+        const width = Math.round(canvas.clientWidth * ratio);
+        const height = Math.round(canvas.clientHeight * ratio);
+        if (!width || !height) return;
+        if (canvas.width !== width || canvas.height !== height) {
+            canvas.width = width;
+            canvas.height = height;
+        }
+        
+        // The coarsest level that still has a peak for every pixel column, levels are finest first
+        const level = [...this.waveformLevels].reverse().find(l => l.peaks.length / 2 >= width) ||
+            this.waveformLevels[0];
+        const peaks = level.peaks;
+        const peakCount = peaks.length / 2;
+        const middle = height / 2;
+        const played = Math.round(width * percent / 100);
+        
+        const ctx = canvas.getContext('2d');
+        ctx.clearRect(0, 0, width, height);
+        for (let x = 0; x < width; x++) {
+            const first = Math.floor(x * peakCount / width);
+            const last = Math.max(first + 1, Math.floor((x + 1) * peakCount / width));
+            let min = 0;
+            let max = 0;
+            for (let i = first; i < last && i < peakCount; i++) {
+                min = Math.min(min, peaks[i * 2]);
+                max = Math.max(max, peaks[i * 2 + 1]);
+            }
+            const top = middle - (max / 128) * middle;
+            const bottom = middle - (min / 128) * middle;
+            ctx.fillStyle = x < played ? '#2ec27e' : '#5c637a';
+            ctx.fillRect(x, top, 1, Math.max(1, bottom - top));
+        }
+    },
+    
+    parsePreviewTrack: function(text, baseUrl) {
+        const toSeconds = (stamp) => stamp.split(':').reduce((total, part) => total * 60 + parseFloat(part), 0);
+        const cues = [];
+        
+        text.split(/\r?\n\r?\n/).forEach(block => {
+            const lines = block.trim().split(/\r?\n/);
+            const timing = lines.findIndex(line => line.includes('-->'));
+            if (timing === -1 || !lines[timing + 1]) return;
+            
+            const [start, end] = lines[timing].split('-->').map(stamp => toSeconds(stamp.trim()));
+            const [file, xywh] = lines[timing + 1].split('#xywh=');
+            if (!xywh) return;
+            
+            const [x, y, w, h] = xywh.split(',').map(Number);
+            cues.push({ start, end, image: new URL(file, baseUrl).href, x, y, w, h });
+        });
+        
+        return cues;
+    },
+    
+    showPreview: function(e) {
+        const video = this.miniPlayer.visible ? this.miniPlayer.video : this.mainPlayer.video;
+        if (!this.previewCues.length || !video || !video.duration || isNaN(video.duration)) return;
+        
+        const rect = this.mainPlayer.progress.getBoundingClientRect();
+        const percent = Math.max(0, Math.min(1, (e.clientX - rect.left) / rect.width));
+        const time = percent * video.duration;
+        const cue = this.previewCues.find(c => time >= c.start && time < c.end) ||
+            this.previewCues[this.previewCues.length - 1];
+        
+        if (!this.previewTooltip) {
+            this.previewTooltip = createElementWithClass('div', 'preview-tooltip');
+            this.mainPlayer.progress.appendChild(this.previewTooltip);
+        }
+        
+        const tooltip = this.previewTooltip;
+        tooltip.style.width = `${cue.w}px`;
+        tooltip.style.height = `${cue.h}px`;
+        tooltip.style.backgroundImage = `url("${cue.image}")`;
+        tooltip.style.backgroundPosition = `-${cue.x}px -${cue.y}px`;
+        // Centered on the cursor but kept above the bar
+        tooltip.style.left = `${Math.max(0, Math.min(rect.width - cue.w, e.clientX - rect.left - cue.w / 2))}px`;
+        tooltip.dataset.time = this.formatTime(time);
+        tooltip.style.display = 'block';
+    },
+    
+    hidePreview: function() {
+        if (this.previewTooltip) this.previewTooltip.style.display = 'none';
+    },
+    
     updateProgress: function() {
         if (!this.mainPlayer.time1 || !this.mainPlayer.time2 || !this.mainPlayer.bar) return;
         
@@ -509,6 +878,7 @@ const playerSystem = {
             
             const percent = (currentTime / duration) * 100;
             this.mainPlayer.bar.style.width = percent + "%";
+            this.drawWaveform(percent);
         }
     },
     
@@ -651,6 +1021,19 @@ const playerSystem = {
 // File Upload System
 // ============================
 
+// Resumable uploads: files are sent in chunks, several chunks and files at a time.
+// The server's chunk size and parallelism limits take precedence over these.
+const uploadConfig = {
+    parallelFiles: 2,
+    parallelChunks: 4,
+    chunkRetries: 5,
+    retryDelay: 1000,
+    // Times a request turned away as busy (429/503) is sent again after its Retry-After
+    busyRetries: 20,
+    // Files up to this size are hashed first so the server can skip ones it already has
+    maxHashSize: 256 * 1024 * 1024
+};
+
 async function uploadFilesToServer(files) {
     const processingBanner = getElementByIdSafe('processingBanner');
     if (!processingBanner) return;
@@ -660,39 +1043,47 @@ async function uploadFilesToServer(files) {
     
     let processedCount = 0;
     let successCount = 0;
+    const pendingJobs = [];
+    
+    const totalBytes = files.reduce((sum, file) => sum + file.size, 0) || 1;
+    let uploadedBytes = 0;
+    const onProgress = (bytes) => {
+        uploadedBytes += bytes;
+        updateProgressBar(processedCount, files.length, uploadedBytes / totalBytes);
+    };
+    
+    // The number of files sent at once is fixed when the workers start, so the
+    // server's limit is read first
+    let parallelFiles = uploadConfig.parallelFiles;
+    try {
+        const response = await fetch('/uploads');
+        if (response.ok) {
+            const limits = await response.json();
+            parallelFiles = Math.min(parallelFiles, limits.max_parallel_files);
+        }
+    } catch (error) {
+        console.warn("⚠️ Could not read upload limits:", error);
+    }
     
-    for (const file of files) {
+    await runWithConcurrency(files, parallelFiles, async (file) => {
         try {
             if (!file.type.startsWith('video/') && !file.type.startsWith('audio/')) {
                 console.warn("⚠️ Skipping non-video/audio file:", file.name);
-                processedCount++;
-                updateProgressBar(processedCount, files.length);
-                continue;
-            }
-            
-            const formData = new FormData();
-            formData.append('file', file);
-            
-            const response = await fetch('/upload', {
-                method: 'POST',
-                body: formData
-            });
-            
-            if (response.ok) {
-                successCount++;
-            } else {
-                console.error("❌ Upload failed for", file.name);
+                onProgress(file.size);
+                return;
             }
             
-            processedCount++;
-            updateProgressBar(processedCount, files.length);
-            
-            await new Promise(resolve => setTimeout(resolve, 100));
+            const result = await uploadFileInChunks(file, onProgress);
+            successCount++;
+            if (result.job_id) pendingJobs.push(result.job_id);
             
         } catch (error) {
             console.error("❌ Error processing", file.name, ":", error);
+        } finally {
+            processedCount++;
+            updateProgressBar(processedCount, files.length, uploadedBytes / totalBytes);
         }
-    }
+    });
     
     setTimeout(() => {
         processingBanner.style.display = 'none';
@@ -702,19 +1093,175 @@ async function uploadFilesToServer(files) {
         if (successCount > 0) {
             playerSystem.showNotification(`تم رفع ${successCount} ملف بنجاح`, "success");
             playerSystem.fetchVideosFromServer();
+            
+            // Thumbnails are generated in the background, refresh once they are ready
+            if (pendingJobs.length > 0) {
+                waitForBackgroundJobs(pendingJobs).then(() => playerSystem.fetchVideosFromServer());
+            }
         } else {
             playerSystem.showError("فشل رفع جميع الملفات");
         }
     }, 500);
 }
 
-function updateProgressBar(processedCount, totalFiles) {
+async function runWithConcurrency(items, limit, worker) {
+    let next = 0;
+    const runners = Array.from({ length: Math.min(limit, items.length) }, async () => {
+        while (next < items.length) {
+            await worker(items[next++]);
+        }
+    });
+    await Promise.all(runners);
+}
+
+async function uploadFileInChunks(file, onProgress) {
+    // Remember the session so an interrupted upload resumes after a reload
+    const resumeKey = `upload:${file.name}:${file.size}:${file.lastModified}`;
+    let session = null;
+    
+    const savedId = localStorage.getItem(resumeKey);
+    if (savedId) {
+        const response = await fetch(`/uploads/${savedId}`);
+        if (response.ok) {
+            session = await response.json();
+            if (session.status !== 'uploading') session = null;
+        }
+    }
+    
+    if (!session) {
+        const sha256 = await hashFile(file);
+        const response = await fetchWhenAdmitted('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ filename: file.name, size: file.size, sha256 })
+        });
+        if (!response.ok) throw new Error(`Upload rejected: ${response.status}`);
+        
+        session = await response.json();
+        
+        // The server already has this file: nothing to upload
+        if (session.deduplicated) {
+            console.log("♻️ Already in library, skipped upload:", file.name);
+            onProgress(file.size);
+            return session;
+        }
+        
+        localStorage.setItem(resumeKey, session.upload_id);
+    }
+    
+    // Only send the chunks the server doesn't have yet
+    const chunkSize = session.chunk_size;
+    const offsets = [];
+    for (let offset = 0; offset < file.size; offset += chunkSize) {
+        const end = Math.min(offset + chunkSize, file.size);
+        const received = session.ranges.some(([start, length]) => start <= offset && end <= start + length);
+        if (received) {
+            onProgress(end - offset);
+        } else {
+            offsets.push(offset);
+        }
+    }
+    
+    const parallelChunks = Math.min(uploadConfig.parallelChunks, session.max_parallel_chunks);
+    
+    await runWithConcurrency(offsets, parallelChunks, async (offset) => {
+        const chunk = file.slice(offset, offset + chunkSize);
+        await uploadChunk(session.upload_id, offset, chunk);
+        onProgress(chunk.size);
+    });
+    
+    const response = await fetchWhenAdmitted(`/uploads/${session.upload_id}/finalize`, { method: 'POST' });
+    if (!response.ok) throw new Error(`Finalize failed: ${response.status}`);
+    
+    localStorage.removeItem(resumeKey);
+    return response.json();
+}
+
+async function fetchWhenAdmitted(url, options = {}) {
+    // The server turns requests away with 429/503 when it's busy and says when to come back
+    for (let attempt = 1; ; attempt++) {
+        const response = await fetch(url, options);
+        if ((response.status !== 429 && response.status !== 503) || attempt >= uploadConfig.busyRetries) {
+            return response;
+        }
+        
+        const retryAfter = parseInt(response.headers.get('Retry-After'), 10);
+        const delay = Number.isFinite(retryAfter) ? retryAfter * 1000 : uploadConfig.retryDelay * attempt;
+        // Jitter, so uploads turned away together don't all come back at once
+        const wait = delay + Math.random() * uploadConfig.retryDelay;
+        console.warn(`⏳ Server busy, retrying in ${Math.round(wait / 1000)}s:`, url);
+        await new Promise(resolve => setTimeout(resolve, wait));
+    }
+}
+
+async function hashFile(file) {
+    // SubtleCrypto is only available on secure origins and hashes whole buffers
+    if (!window.crypto || !crypto.subtle || file.size > uploadConfig.maxHashSize) return null;
+    
+    try {
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+    } catch (error) {
+        console.warn("⚠️ Could not hash", file.name, ":", error);
+        return null;
+    }
+}
+
+async function uploadChunk(uploadId, offset, chunk) {
+    for (let attempt = 1; ; attempt++) {
+        let retryable = true;
+        try {
+            const response = await fetchWhenAdmitted(`/uploads/${uploadId}?offset=${offset}`, {
+                method: 'PUT',
+                headers: { 'Content-Type': 'application/offset+octet-stream' },
+                body: chunk
+            });
+            if (response.ok) return;
+            
+            // Client errors won't get better by sending the chunk again
+            retryable = response.status >= 500;
+            if (!retryable || attempt >= uploadConfig.chunkRetries) {
+                throw new Error(`Chunk upload failed: ${response.status}`);
+            }
+        } catch (error) {
+            if (!retryable || attempt >= uploadConfig.chunkRetries) throw error;
+            console.warn(`⚠️ Retrying chunk at ${offset}:`, error.message);
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, uploadConfig.retryDelay * attempt));
+    }
+}
+
+async function waitForBackgroundJobs(jobIds, interval = 2000, maxWait = 120000) {
+    const started = Date.now();
+    let remaining = [...jobIds];
+    
+    while (remaining.length > 0 && Date.now() - started < maxWait) {
+        await new Promise(resolve => setTimeout(resolve, interval));
+        
+        const statuses = await Promise.all(remaining.map(async (jobId) => {
+            try {
+                const response = await fetch(`/jobs/${jobId}`);
+                if (!response.ok) return 'failed';
+                const job = await response.json();
+                return job.status;
+            } catch (error) {
+                return 'pending';
+            }
+        }));
+        
+        remaining = remaining.filter((_, i) => statuses[i] !== 'done' && statuses[i] !== 'failed');
+    }
+}
+
+function updateProgressBar(processedCount, totalFiles, fraction = null) {
     const processingBar = getElementByIdSafe('processingBar');
     const processingText = getElementByIdSafe('processingText');
     
     if (!processingBar || !processingText) return;
     
-    const progressPercent = (processedCount / totalFiles) * 100;
+    // Byte progress when known, otherwise files done
+    const progressPercent = (fraction !== null ? fraction : processedCount / totalFiles) * 100;
     processingBar.style.width = progressPercent + '%';
     processingText.textContent = `جاري المعالجة ${processedCount} من ${totalFiles}`;
 }
@@ -815,13 +1362,14 @@ document.addEventListener('DOMContentLoaded', () => {
             
             const videoId = parseInt(currentCard.dataset.id);
             const videoTitle = currentCard.dataset.title;
-            const videoFilename = currentCard.dataset.filename;
+            const videoUrl = currentCard.dataset.url;
+            const hlsUrl = currentCard.dataset.hls;
             
             if (!playerSystem.miniPlayer.visible) {
                 playerSystem.minimizePlayer();
             }
             
-            playerSystem.playVideo(videoFilename, videoTitle, videoId);
+            playerSystem.playVideo(videoUrl, videoTitle, videoId, hlsUrl);
             contextMenu.style.display = 'none';
         });
     }
@@ -832,39 +1380,14 @@ document.addEventListener('DOMContentLoaded', () => {
 // ============================
 
 const searchInput = document.getElementById('searchcard');
+let searchTimer = null;
 if (searchInput) {
     searchInput.addEventListener('input', (e) => {
-        const searchTerm = e.target.value.toLowerCase().trim();
-        const cards = document.querySelectorAll('.card');
-        let visibleCount = 0;
-        
-        cards.forEach(card => {
-            const title = card.dataset.title || '';
-            
-            if (title.toLowerCase().includes(searchTerm)) {
-                card.style.display = 'block';
-                visibleCount++;
-            } else {
-                card.style.display = 'none';
-            }
-        });
+        const searchTerm = e.target.value.trim();
         
-        const container = getElementByIdSafe('contentcatd');
-        const emptyState = container.querySelector('.empty-state');
-        
-        if (visibleCount === 0 && searchTerm !== '') {
-            if (!emptyState) {
-                const noResults = createElementWithClass('div', 'empty-state');
-                noResults.innerHTML = `
-                    <i class="fas fa-search"></i>
-                    <h3>No results</h3>
-                    <p>No matching videos were found."${searchTerm}"</p>
-                `;
-                container.appendChild(noResults);
-            }
-        } else if (emptyState && searchTerm === '') {
-            emptyState.remove();
-        }
+        // Query the server once the user pauses typing
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => playerSystem.searchLibrary(searchTerm), playerSystem.searchDelay);
     });
 }
 
@@ -0,0 +1,126 @@
+"""
+Sharded on-disk layout of the upload and thumbnail folders
+Files are stored two levels of hex directories deep, e.g.
+upload/3f/a2/clip_1a2b3c4d.mp4, so each directory holds about 1/65536 of the
+files instead of all of them. The shard comes from the stem of the stored
+file, which ends in its unique id or content hash (clip_1a2b3c4d), so a
+video's thumbnail, its variants and its preview sprites share one directory.
+Files still in the flat layout, or in the shard of their name before the first
+dot as earlier versions placed them, are found until migrate_layout.py has
+moved them.
+This module must stay importable without Flask so it can run in a process pool
+"""
+
+import hashlib
+import os
+import re
+
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2  # hex digits per level, 256 directories per level
+
+# Stem of a stored file up to its unique id or content hash: the last _<hex> before a
+# dot or the end. Names of the derived files only add dotted parts after it
+STEM_PATTERN = re.compile(r'.*_[0-9a-f]{8,}(?=\.|$)')
+
+
+def shard_key(name):
+    """Part of a file name its shard is derived from
+
+    "01. Intro_1a2b3c4d.mp3" and its "01. Intro_1a2b3c4d.jpg" thumbnail share
+    "01. Intro_1a2b3c4d". Names without an id fall back to the part before the
+    first dot.
+    """
+    match = STEM_PATTERN.match(name)
+    return match.group(0) if match else name.split('.', 1)[0]
+
+
+def _shard_of(key):
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return '/'.join(digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(SHARD_LEVELS))
+
+
+def shard(name):
+    """Shard directory of a file name below its store folder, e.g. '3f/a2'"""
+    return _shard_of(shard_key(name))
+
+
+def legacy_shard(name):
+    """Shard earlier versions placed a file in, keyed on the name before its first dot"""
+    return _shard_of(name.split('.', 1)[0])
+
+
+def _sharded(folder, name):
+    return os.path.join(folder, *shard(name).split('/'), name)
+
+
+def directory(folder, name):
+    """Directory a file named name is written to, created if needed"""
+    path = os.path.join(folder, *shard(name).split('/'))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def path(folder, name):
+    """Path a new file named name is written to"""
+    return os.path.join(directory(folder, name), name)
+
+
+def locate(folder, name):
+    """Path of a stored file, in its shard, its legacy shard or still in the flat layout
+
+    Returns the sharded path when the file is in none of these places.
+    """
+    sharded = _sharded(folder, name)
+    if os.path.isfile(sharded):
+        return sharded
+    flat = os.path.join(folder, name)
+    if os.path.isfile(flat):
+        return flat
+    legacy = legacy_shard(name)
+    if legacy != shard(name):
+        moved = os.path.join(folder, *legacy.split('/'), name)
+        if os.path.isfile(moved):
+            return moved
+    return sharded
+
+
+def relative(folder, name):
+    """Path of a stored file relative to folder with '/' separators, for send_media()"""
+    return os.path.relpath(locate(folder, name), folder).replace(os.sep, '/')
+
+
+def is_shard(name):
+    return len(name) == SHARD_WIDTH and all(c in '0123456789abcdef' for c in name)
+
+
+def _shard_dirs(folder, level=0):
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if is_shard(entry.name) and entry.is_dir(follow_symlinks=False):
+                if level + 1 == SHARD_LEVELS:
+                    yield entry
+                else:
+                    yield from _shard_dirs(entry.path, level + 1)
+
+
+def scan(folder):
+    """Yield an os.DirEntry for every entry of folder, in the shards and at the top level"""
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not (is_shard(entry.name) and entry.is_dir(follow_symlinks=False)):
+                yield entry
+    for shard_dir in _shard_dirs(folder):
+        with os.scandir(shard_dir.path) as entries:
+            yield from entries
+
+
+def mtime_ns(folder):
+    """Latest mtime of folder and its shard directories
+
+    Adding, removing or renaming a file anywhere in the store changes it, so it
+    can tell whether a folder changed without listing the files.
+    """
+    latest = os.stat(folder).st_mtime_ns
+    for shard_dir in _shard_dirs(folder):
+        latest = max(latest, shard_dir.stat(follow_symlinks=False).st_mtime_ns)
+    return latest
@@ -0,0 +1,58 @@
+"""
+Structured JSON logs
+Every line is one JSON object with a timestamp, level, event name and fields,
+plus the id of the request or job it belongs to. Set RMUSIC_LOG_LEVEL to
+change the level (INFO by default).
+This module must stay importable without Flask so it can run in a process pool
+"""
+
+import contextvars
+import json
+import logging
+import os
+import sys
+
+# Request or job id of the current context, added to every line
+context_id = contextvars.ContextVar('context_id', default=None)
+
+logger = logging.getLogger('rmusic')
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        current_id = context_id.get()
+        if current_id:
+            entry['id'] = current_id
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def _configure():
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(os.environ.get('RMUSIC_LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+
+_configure()
+
+
+def info(event, **fields):
+    logger.info(event, extra={'fields': fields})
+
+
+def warning(event, **fields):
+    logger.warning(event, extra={'fields': fields})
+
+
+def error(event, **fields):
+    logger.error(event, extra={'fields': fields})
@@ -0,0 +1,709 @@
+"""
+FFmpeg helpers shared by the web server, background jobs and worker processes
+This module must stay importable without Flask so it can run in a process pool
+"""
+
+import array
+import functools
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import admission
+import logs
+import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    # Waveform peaks are then reduced in pure Python, several times slower
+    np = None
+
+# Grid thumbnails: every width in every available format, best format first
+THUMBNAIL_WIDTHS = (160, 320, 640)
+THUMBNAIL_FORMATS = (
+    # (extension, MIME type, ffmpeg encoder options)
+    ('avif', 'image/avif', ['-c:v', 'libaom-av1', '-still-picture', '1', '-crf', '32', '-cpu-used', '6']),
+    ('webp', 'image/webp', ['-c:v', 'libwebp', '-quality', '75', '-compression_level', '6']),
+)
+
+# Scrubbing previews: one tile every SPRITE_INTERVAL seconds, SPRITE_GRID tiles per sheet
+SPRITE_INTERVAL = 5
+SPRITE_TILE_SIZE = (160, 90)
+SPRITE_GRID = (10, 10)  # columns, rows
+
+# Containers whose index (moov atom) can be moved to the front
+FASTSTART_EXTENSIONS = ('.mp4', '.mov')
+FASTSTART_TEMP_SUFFIX = '.faststart.part'  # .part files are left alone by /cleanup
+
+# HLS ladder: (name, max height, video bitrate, audio bitrate)
+# Renditions are never upscaled, the source rendition keeps the original size
+HLS_LADDER = (
+    ('360p', 360, '800k', '96k'),
+    ('720p', 720, '2800k', '128k'),
+    ('source', None, '6000k', '192k'),
+)
+HLS_SEGMENT_SECONDS = 6
+HLS_MASTER_PLAYLIST = 'master.m3u8'
+HLS_TIMEOUT = 6 * 60 * 60  # seconds, long videos are encoded three times
+
+# Thumbnail frame: this far into the video, skipping black intro frames
+THUMBNAIL_POSITION = 0.1  # fraction of the duration
+THUMBNAIL_MAX_SECONDS = 60
+THUMBNAIL_DEFAULT_SECONDS = 1  # when the duration is unknown, safe for short clips
+
+# Audio waveforms: min/max peaks of the decoded mono track at a few zoom levels
+WAVEFORM_SAMPLE_RATE = 8000  # Hz, plenty for drawing peaks and cheap to decode to
+WAVEFORM_LEVELS = (256, 1024, 4096)  # samples per peak, finest first, each a multiple of the first
+WAVEFORM_EXTENSION = '.peaks'
+WAVEFORM_MAGIC = b'RMWF'
+WAVEFORM_VERSION = 1
+WAVEFORM_READ_SIZE = 1024 * 1024  # bytes of decoded samples reduced at once
+WAVEFORM_TIMEOUT = 30 * 60
+
+# Stream details stored per video, in the order of the video_set_metadata statement
+METADATA_FIELDS = ('duration', 'width', 'height', 'video_codec', 'audio_codec', 'bit_rate', 'has_video', 'has_audio')
+PROBE_TIMEOUT = 30
+
+# ffmpeg processes started on this host; work beyond the limits waits for its
+# turn instead of competing for disk and CPU with playback
+FFMPEG_CONCURRENCY = int(os.environ.get('RMUSIC_FFMPEG_CONCURRENCY', os.cpu_count() or 2))
+FFMPEG_RATE = float(os.environ.get('RMUSIC_FFMPEG_RATE', 20))  # starts per second, 0 for no limit
+ffmpeg_limiter = admission.Limiter('ffmpeg', FFMPEG_CONCURRENCY, FFMPEG_RATE)
+# ffprobe runs take a fraction of a second and uploads wait for them, so they
+# don't queue behind hours-long encodes
+PROBE_CONCURRENCY = int(os.environ.get('RMUSIC_PROBE_CONCURRENCY', 2 * (os.cpu_count() or 2)))
+probe_limiter = admission.Limiter('probe', PROBE_CONCURRENCY)
+
+def run_ffmpeg(operation, command, timeout, limiter=None):
+    """Run an ffmpeg or ffprobe command, recording its runtime and failures per operation
+
+    Waits for a slot of limiter (ffmpeg_limiter by default) first; the runtime
+    doesn't include the wait.
+    """
+    with (limiter or ffmpeg_limiter).slot():
+        start = time.perf_counter()
+        try:
+            result = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            metrics.FFMPEG_FAILURES.inc(operation=operation, reason='timeout')
+            raise
+        except OSError:
+            metrics.FFMPEG_FAILURES.inc(operation=operation, reason='not_found')
+            raise
+        finally:
+            metrics.FFMPEG_SECONDS.observe(time.perf_counter() - start, operation=operation)
+    
+    if result.returncode != 0:
+        metrics.FFMPEG_FAILURES.inc(operation=operation, reason='exit_code')
+    return result
+
+@functools.lru_cache(maxsize=None)
+def _tool_available(tool):
+    try:
+        subprocess.run([tool, '-version'], capture_output=True, check=True, timeout=30)
+        return True
+    except (subprocess.SubprocessError, OSError):
+        return False
+
+def ffmpeg_available():
+    """Whether ffmpeg can be run, checked once per process"""
+    return _tool_available('ffmpeg')
+
+def ffprobe_available():
+    """Whether ffprobe can be run, checked once per process"""
+    return _tool_available('ffprobe')
+
+def _number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+def probe_media(path):
+    """Read duration, resolution, codecs, bitrate and stream flags with a single ffprobe run
+
+    Returns a dict with the METADATA_FIELDS, or None when ffprobe can't read
+    the file (or isn't installed).
+    """
+    if not ffprobe_available():
+        return None
+    
+    try:
+        result = run_ffmpeg('probe', [
+            'ffprobe', '-v', 'error',
+            '-show_entries',
+            'format=duration,bit_rate:stream=codec_type,codec_name,width,height:stream_disposition=attached_pic',
+            '-of', 'json', path
+        ], timeout=PROBE_TIMEOUT, limiter=probe_limiter)
+        
+        if result.returncode != 0:
+            logs.warning('probe_failed', path=path, stderr=result.stderr[-2000:])
+            return None
+        
+        info = json.loads(result.stdout or '{}')
+        fmt = info.get('format', {})
+        streams = info.get('streams', [])
+        # Cover art of audio files is a video stream too, but not one a frame can be taken from
+        video = next((
+            s for s in streams
+            if s.get('codec_type') == 'video' and not s.get('disposition', {}).get('attached_pic')
+        ), None)
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        
+        return {
+            'duration': _number(fmt.get('duration')),
+            'width': _number(video.get('width'), int) if video else None,
+            'height': _number(video.get('height'), int) if video else None,
+            'video_codec': video.get('codec_name') if video else None,
+            'audio_codec': audio.get('codec_name') if audio else None,
+            'bit_rate': _number(fmt.get('bit_rate'), int),
+            'has_video': int(video is not None),
+            'has_audio': int(audio is not None),
+        }
+        
+    except subprocess.TimeoutExpired:
+        logs.warning('probe_timeout', path=path)
+        return None
+    except (OSError, ValueError) as e:
+        logs.error('probe_error', path=path, error=str(e))
+        return None
+
+def thumbnail_time(duration):
+    """Seconds into a video to take its thumbnail from"""
+    if not duration or duration <= 0:
+        return THUMBNAIL_DEFAULT_SECONDS
+    return round(min(duration * THUMBNAIL_POSITION, THUMBNAIL_MAX_SECONDS), 3)
+
+def generate_video_thumbnail(video_path, output_path, time_in_seconds=THUMBNAIL_DEFAULT_SECONDS):
+    """Generate thumbnail from video at specific time"""
+    try:
+        # Ensure thumbnails folder exists
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        if not ffmpeg_available():
+            logs.warning('ffmpeg_missing', operation='thumbnail')
+            return False
+        
+        # Generate thumbnail from video
+        command = [
+            'ffmpeg',
+            '-y',
+            '-ss', str(time_in_seconds),
+            '-i', video_path,
+            '-frames:v', '1',
+            '-vf', 'scale=320:-1',
+            '-q:v', '2',
+            output_path
+        ]
+        
+        # Run ffmpeg command
+        result = run_ffmpeg('thumbnail', command, timeout=30)
+        
+        if result.returncode == 0 and os.path.exists(output_path):
+            thumb_size = os.path.getsize(output_path)
+            logs.info('thumbnail_generated', path=output_path, bytes=thumb_size)
+            return True
+        else:
+            logs.warning('thumbnail_failed', path=video_path, stderr=result.stderr[-2000:])
+            return False
+            
+    except subprocess.TimeoutExpired:
+        logs.warning('thumbnail_timeout', path=video_path)
+        return False
+    except Exception as e:
+        logs.error('thumbnail_error', path=video_path, error=str(e))
+        return False
+
+
+def has_audio_stream(video_path):
+    """Check with ffprobe whether a file has an audio stream"""
+    metadata = probe_media(video_path)
+    return bool(metadata and metadata['has_audio'])
+
+
+def package_hls(video_path, output_dir, ladder=HLS_LADDER, has_audio=None):
+    """Encode a video into an HLS ladder with a master playlist in output_dir
+
+    Everything is written to a temporary directory that replaces output_dir
+    once ffmpeg succeeded, so players never see a half-written ladder.
+    has_audio comes from the stored metadata; None probes the file.
+    """
+    work_dir = output_dir + '.tmp'
+    try:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir)
+        
+        audio = has_audio_stream(video_path) if has_audio is None else has_audio
+        
+        # One decode, split into every rendition of the ladder
+        splits = ''.join(f'[v{i}]' for i in range(len(ladder)))
+        filters = [f'[0:v:0]split={len(ladder)}{splits}']
+        for i, (_, height, _, _) in enumerate(ladder):
+            scale = f"scale=-2:'min({height},ih)'" if height else 'scale=trunc(iw/2)*2:trunc(ih/2)*2'
+            filters.append(f'[v{i}]{scale}[out{i}]')
+        
+        command = ['ffmpeg', '-y', '-i', video_path, '-filter_complex', ';'.join(filters)]
+        stream_map = []
+        for i, (name, _, video_bitrate, audio_bitrate) in enumerate(ladder):
+            command += [
+                '-map', f'[out{i}]',
+                f'-c:v:{i}', 'libx264',
+                f'-b:v:{i}', video_bitrate,
+                f'-maxrate:v:{i}', video_bitrate,
+                f'-bufsize:v:{i}', video_bitrate
+            ]
+            if audio:
+                command += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', audio_bitrate]
+                stream_map.append(f'v:{i},a:{i},name:{name}')
+            else:
+                stream_map.append(f'v:{i},name:{name}')
+        
+        command += [
+            '-preset', 'veryfast',
+            '-pix_fmt', 'yuv420p',
+            # Keyframes on segment boundaries so every rendition switches cleanly
+            '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_SECONDS})',
+            '-f', 'hls',
+            '-hls_time', str(HLS_SEGMENT_SECONDS),
+            '-hls_playlist_type', 'vod',
+            '-hls_flags', 'independent_segments',
+            # Flat layout: the master playlist is written next to the variant playlists
+            '-hls_segment_filename', os.path.join(work_dir, '%v_%05d.ts'),
+            '-master_pl_name', HLS_MASTER_PLAYLIST,
+            '-var_stream_map', ' '.join(stream_map),
+            os.path.join(work_dir, '%v.m3u8')
+        ]
+        
+        result = run_ffmpeg('hls', command, timeout=HLS_TIMEOUT)
+        
+        if result.returncode != 0 or not os.path.exists(os.path.join(work_dir, HLS_MASTER_PLAYLIST)):
+            logs.warning('hls_failed', path=video_path, stderr=result.stderr[-2000:])
+            return False
+        
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.replace(work_dir, output_dir)
+        logs.info('hls_generated', path=output_dir)
+        return True
+        
+    except subprocess.TimeoutExpired:
+        logs.warning('hls_timeout', path=video_path)
+        return False
+    except Exception as e:
+        logs.error('hls_error', path=video_path, error=str(e))
+        return False
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def needs_faststart(video_path):
+    """Walk the top-level atoms of an MP4/MOV file
+
+    Returns True when the moov atom comes after the media data, False when it
+    is already in front and None when the file isn't a usable MP4/MOV.
+    """
+    file_size = os.path.getsize(video_path)
+    seen_mdat = False
+    offset = 0
+    
+    with open(video_path, 'rb') as f:
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            size, kind = struct.unpack('>I4s', f.read(8))
+            
+            if size == 1:
+                # 64-bit size follows the type
+                size = struct.unpack('>Q', f.read(8))[0]
+            elif size == 0:
+                # Atom extends to the end of the file
+                size = file_size - offset
+            
+            if size < 8:
+                return None
+            if kind == b'moov':
+                return seen_mdat
+            if kind == b'mdat':
+                seen_mdat = True
+            offset += size
+    
+    return None
+
+
+def ensure_faststart(video_path):
+    """Losslessly remux an MP4/MOV file with its index in front if needed
+
+    The remuxed copy replaces the original atomically. Returns 'remuxed' when
+    the file was rewritten, 'in_front' when its index already was at the
+    front, False when remuxing failed and None for files that aren't MP4/MOV.
+    """
+    temp_path = video_path + FASTSTART_TEMP_SUFFIX
+    try:
+        needed = needs_faststart(video_path)
+        if needed is None:
+            return None
+        if not needed:
+            return 'in_front'
+        
+        container = 'mov' if video_path.lower().endswith('.mov') else 'mp4'
+        command = [
+            'ffmpeg',
+            '-y',
+            '-i', video_path,
+            '-map', '0',
+            '-c', 'copy',
+            '-ignore_unknown',
+            '-movflags', '+faststart',
+            '-f', container,
+            temp_path
+        ]
+        
+        result = run_ffmpeg('faststart', command, timeout=30 * 60)
+        
+        # Only swap in a copy that really has its index in front
+        if result.returncode != 0 or not os.path.exists(temp_path) or needs_faststart(temp_path) is not False:
+            logs.warning('faststart_failed', path=video_path, stderr=result.stderr[-2000:])
+            return False
+        
+        os.replace(temp_path, video_path)
+        logs.info('faststart_done', path=video_path)
+        return 'remuxed'
+        
+    except subprocess.TimeoutExpired:
+        logs.warning('faststart_timeout', path=video_path)
+        return False
+    except Exception as e:
+        logs.error('faststart_error', path=video_path, error=str(e))
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def _vtt_timestamp(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}"
+
+
+def _parse_duration(ffmpeg_output):
+    """Media duration in seconds from ffmpeg's log, or None"""
+    match = re.search(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)', ffmpeg_output)
+    if not match:
+        # No duration in the header: use the last progress timestamp
+        times = re.findall(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)', ffmpeg_output)
+        if not times:
+            return None
+        match = times[-1]
+        return int(match[0]) * 3600 + int(match[1]) * 60 + float(match[2])
+    return int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+
+
+def preview_sheets(output_folder, vtt_name):
+    """Paths of the sprite sheets that belong to a preview track"""
+    name = os.path.splitext(vtt_name)[0]
+    return sorted(glob.glob(os.path.join(output_folder, glob.escape(name) + '.sprite-*.jpg')))
+
+
+def generate_preview_sprites(video_path, output_folder, name):
+    """Generate scrubbing preview sprite sheets and their WebVTT track in one decode pass
+
+    Writes <name>.sprite-001.jpg, ... and <name>.vtt into output_folder and
+    returns the name of the VTT file, or None on failure.
+    """
+    width, height = SPRITE_TILE_SIZE
+    columns, rows = SPRITE_GRID
+    vtt_name = f"{name}.vtt"
+    generated = False
+    
+    try:
+        os.makedirs(output_folder, exist_ok=True)
+        
+        # Only keyframes are decoded, which is plenty for a preview and much cheaper
+        command = [
+            'ffmpeg',
+            '-y',
+            '-skip_frame', 'nokey',
+            '-i', video_path,
+            '-an', '-sn',
+            '-vf', (
+                f"fps=1/{SPRITE_INTERVAL},"
+                f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,"
+                f"tile={columns}x{rows}"
+            ),
+            '-q:v', '5',
+            os.path.join(output_folder, f"{name}.sprite-%03d.jpg")
+        ]
+        
+        result = run_ffmpeg('previews', command, timeout=30 * 60)
+        sheets = preview_sheets(output_folder, vtt_name)
+        duration = _parse_duration(result.stderr)
+        
+        if result.returncode != 0 or not sheets or not duration:
+            logs.warning('previews_failed', path=video_path, stderr=result.stderr[-2000:])
+            return None
+        
+        # One cue per tile, pointing at its rectangle in the sheet (URLs relative to the track)
+        per_sheet = columns * rows
+        tiles = min(math.ceil(duration / SPRITE_INTERVAL), len(sheets) * per_sheet)
+        lines = ['WEBVTT', '']
+        for i in range(tiles):
+            start = i * SPRITE_INTERVAL
+            end = min((i + 1) * SPRITE_INTERVAL, duration)
+            sheet = os.path.basename(sheets[i // per_sheet])
+            x = (i % per_sheet) % columns * width
+            y = (i % per_sheet) // columns * height
+            lines += [
+                f"{_vtt_timestamp(start)} --> {_vtt_timestamp(end)}",
+                f"{sheet}#xywh={x},{y},{width},{height}",
+                ''
+            ]
+        
+        with open(os.path.join(output_folder, vtt_name), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        
+        logs.info('previews_generated', path=video_path, sheets=len(sheets), tiles=tiles)
+        generated = True
+        return vtt_name
+        
+    except subprocess.TimeoutExpired:
+        logs.warning('previews_timeout', path=video_path)
+        return None
+    except Exception as e:
+        logs.error('previews_error', path=video_path, error=str(e))
+        return None
+    finally:
+        # Whatever went wrong, don't leave sheets or a half-written track behind
+        if not generated:
+            for path in preview_sheets(output_folder, vtt_name) + [os.path.join(output_folder, vtt_name)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+@functools.lru_cache(maxsize=None)
+def _ffmpeg_list(kind):
+    """Output of 'ffmpeg -encoders' or 'ffmpeg -muxers', read once per process"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', f'-{kind}'], capture_output=True, text=True, timeout=30)
+        return result.stdout
+    except (subprocess.SubprocessError, FileNotFoundError):
+        return ''
+
+
+def thumbnail_formats():
+    """The THUMBNAIL_FORMATS this ffmpeg build can write"""
+    available = []
+    for extension, mime_type, options in THUMBNAIL_FORMATS:
+        encoder = options[options.index('-c:v') + 1]
+        if re.search(rf'\s{re.escape(encoder)}\s', _ffmpeg_list('encoders')) and \
+                re.search(rf'\s{extension}\s', _ffmpeg_list('muxers')):
+            available.append((extension, mime_type, options))
+    return available
+
+
+def generate_thumbnail_variants(video_path, output_folder, stem, time_in_seconds=THUMBNAIL_DEFAULT_SECONDS):
+    """Generate the grid thumbnail at every width and format from a single decoded frame
+
+    Files are named <stem>.<width>w.<content hash>.<ext> so they can be cached
+    forever. Returns a list of {name, width, type} dicts, or None on failure.
+    """
+    formats = thumbnail_formats()
+    if not formats:
+        logs.warning('thumbnail_variants_unavailable', reason='No WebP/AVIF encoder available in FFmpeg')
+        return None
+    
+    outputs = [(width, fmt) for width in THUMBNAIL_WIDTHS for fmt in formats]
+    temp_paths = [os.path.join(output_folder, f".{stem}.{i}.{fmt[0]}") for i, (_, fmt) in enumerate(outputs)]
+    
+    try:
+        os.makedirs(output_folder, exist_ok=True)
+        
+        # One frame, split once per output
+        filters = [f"[0:v:0]split={len(outputs)}" + ''.join(f'[s{i}]' for i in range(len(outputs)))]
+        filters += [f"[s{i}]scale={width}:-2[o{i}]" for i, (width, _) in enumerate(outputs)]
+        
+        command = ['ffmpeg', '-y', '-ss', str(time_in_seconds), '-i', video_path,
+                   '-filter_complex', ';'.join(filters)]
+        for i, (_, (_, _, options)) in enumerate(outputs):
+            command += ['-map', f'[o{i}]', '-frames:v', '1'] + options + [temp_paths[i]]
+        
+        result = run_ffmpeg('thumbnail_variants', command, timeout=60)
+        
+        if result.returncode != 0 or not all(os.path.exists(p) and os.path.getsize(p) for p in temp_paths):
+            logs.warning('thumbnail_variants_failed', path=video_path, stderr=result.stderr[-2000:])
+            return None
+        
+        variants = []
+        for temp_path, (width, (extension, mime_type, _)) in zip(temp_paths, outputs):
+            with open(temp_path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            name = f"{stem}.{width}w.{digest}.{extension}"
+            os.replace(temp_path, os.path.join(output_folder, name))
+            variants.append({'name': name, 'width': width, 'type': mime_type})
+        
+        logs.info('thumbnail_variants_generated', path=video_path, files=len(variants))
+        return variants
+        
+    except subprocess.TimeoutExpired:
+        logs.warning('thumbnail_variants_timeout', path=video_path)
+        return None
+    except Exception as e:
+        logs.error('thumbnail_variants_error', path=video_path, error=str(e))
+        return None
+    finally:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def _pcm_samples(data):
+    """Signed 16-bit little-endian PCM as an array of samples"""
+    if np is not None:
+        return np.frombuffer(data, dtype='<i2')
+    samples = array.array('h', data)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples
+
+
+def _group_peaks(mins, maxs, size):
+    """Reduce min and max sequences to one pair per size values, the last group may be shorter"""
+    if np is not None:
+        count = -(-len(mins) // size)
+        pad = count * size - len(mins)
+        # Repeating the last value pads the short group without changing its min or max
+        mins = np.pad(mins, (0, pad), mode='edge').reshape(count, size).min(axis=1)
+        maxs = np.pad(maxs, (0, pad), mode='edge').reshape(count, size).max(axis=1)
+        return mins, maxs
+    starts = range(0, len(mins), size)
+    return [min(mins[i:i + size]) for i in starts], [max(maxs[i:i + size]) for i in starts]
+
+
+def _concat(parts):
+    if np is not None:
+        return np.concatenate(parts)
+    return [value for part in parts for value in part]
+
+
+def _peak_bytes(mins, maxs):
+    """Interleaved (min, max) pairs scaled to signed bytes"""
+    if np is not None:
+        return np.stack((mins >> 8, maxs >> 8), axis=1).astype(np.int8).tobytes()
+    return array.array('b', [value >> 8 for pair in zip(mins, maxs) for value in pair]).tobytes()
+
+
+def generate_waveform(audio_path, output_path, levels=WAVEFORM_LEVELS):
+    """Decode an audio track once and write its min/max peaks at every level
+
+    The decoded samples are streamed from ffmpeg and reduced block by block,
+    so memory doesn't grow with the length of the track. The file holds a
+    little-endian header (magic, version, level count, sample rate), one
+    (samples per peak, peak count) pair per level, then the interleaved
+    signed 8-bit min/max peaks of each level. Returns True on success.
+    """
+    temp_path = output_path + '.tmp'
+    finest = levels[0]
+    peak_bytes = finest * 2
+    command = [
+        'ffmpeg',
+        '-v', 'error',
+        '-i', audio_path,
+        '-map', '0:a:0',
+        '-ac', '1',
+        '-ar', str(WAVEFORM_SAMPLE_RATE),
+        '-f', 's16le',
+        '-acodec', 'pcm_s16le',
+        'pipe:1'
+    ]
+    
+    try:
+        if not ffmpeg_available():
+            logs.warning('ffmpeg_missing', operation='waveform')
+            return False
+        
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        
+        # stderr goes to a file: a full stderr pipe would stall ffmpeg while stdout is read
+        with ffmpeg_limiter.slot(), tempfile.TemporaryFile() as stderr_file:
+            start = time.perf_counter()
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file)
+            except OSError:
+                metrics.FFMPEG_FAILURES.inc(operation='waveform', reason='not_found')
+                raise
+            # Same limit as run_ffmpeg()'s timeout, the pipe is read until ffmpeg exits
+            timer = threading.Timer(WAVEFORM_TIMEOUT, process.kill)
+            timer.start()
+            try:
+                chunks = []
+                pending = b''
+                while True:
+                    data = process.stdout.read(WAVEFORM_READ_SIZE - WAVEFORM_READ_SIZE % peak_bytes)
+                    if not data:
+                        break
+                    pending += data
+                    whole = len(pending) - len(pending) % peak_bytes
+                    if whole:
+                        samples = _pcm_samples(pending[:whole])
+                        chunks.append(_group_peaks(samples, samples, finest))
+                        pending = pending[whole:]
+                
+                # The last, shorter peak
+                pending = pending[:len(pending) - len(pending) % 2]
+                if pending:
+                    samples = _pcm_samples(pending)
+                    chunks.append(_group_peaks(samples, samples, finest))
+                
+                returncode = process.wait()
+                stderr_file.seek(0)
+                stderr = stderr_file.read().decode('utf-8', 'replace')
+            finally:
+                timer.cancel()
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                elapsed = time.perf_counter() - start
+                metrics.FFMPEG_SECONDS.observe(elapsed, operation='waveform')
+        
+        if returncode != 0 or not chunks:
+            reason = 'timeout' if elapsed >= WAVEFORM_TIMEOUT else 'exit_code'
+            metrics.FFMPEG_FAILURES.inc(operation='waveform', reason=reason)
+            logs.warning('waveform_failed', path=audio_path, reason=reason, stderr=stderr[-2000:])
+            return False
+        
+        mins = _concat([chunk[0] for chunk in chunks])
+        maxs = _concat([chunk[1] for chunk in chunks])
+        
+        tables = [struct.pack('<4sHHI', WAVEFORM_MAGIC, WAVEFORM_VERSION, len(levels), WAVEFORM_SAMPLE_RATE)]
+        peaks = []
+        for size in levels:
+            # Coarser levels are reduced from the finest one, not from the samples again
+            level_mins, level_maxs = (mins, maxs) if size == finest else _group_peaks(mins, maxs, size // finest)
+            tables.append(struct.pack('<II', size, len(level_mins)))
+            peaks.append(_peak_bytes(level_mins, level_maxs))
+        
+        with open(temp_path, 'wb') as f:
+            f.write(b''.join(tables + peaks))
+        os.replace(temp_path, output_path)
+        
+        logs.info('waveform_generated', path=output_path, bytes=os.path.getsize(output_path), peaks=len(mins))
+        return True
+    
+    except Exception as e:
+        logs.error('waveform_error', path=audio_path, error=str(e))
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
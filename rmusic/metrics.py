@@ -0,0 +1,197 @@
+"""
+Prometheus metrics in the text exposition format
+Counters and histograms are kept in memory per process and rendered by
+/metrics; gauges are read from a callback at scrape time. Under a
+multi-process server every worker exposes its own series, so scrape each
+worker or aggregate with sum() in the queries.
+This module must stay importable without Flask so it can run in a process pool
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+FFMPEG_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+SIZE_BUCKETS = tuple(2 ** power for power in range(16, 34, 2))  # 64KB to 8GB
+THROUGHPUT_BUCKETS = tuple(2 ** power for power in range(16, 32, 2))  # 64KB/s to 1GB/s
+
+_registry = []
+
+# Stage timings of the current request, filled in by stage()
+current_stages = contextvars.ContextVar('current_stages', default=None)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines += self._render_series(key, value)
+        return lines
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """A value that only goes up"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, with their sum and count"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf) and the sum
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_series(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = _format_labels(self.labels, key, [('le', _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """A value read when metrics are scraped
+
+    collect returns a dict of label value tuples to numbers.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def render(self):
+        try:
+            self._series = {tuple(str(v) for v in key): value for key, value in self.collect().items()}
+        except Exception:
+            # A failing collector must not break the whole scrape
+            self._series = {}
+        return super().render()
+
+
+def render():
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in _registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the current request or job
+
+    The duration goes into the stage histogram and, inside a request, into the
+    request's log line.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        stages = current_stages.get()
+        if stages is not None:
+            stages[name] = round(stages.get(name, 0) + elapsed * 1000, 2)
+
+
+REQUEST_SECONDS = Histogram(
+    'rmusic_request_duration_seconds', 'Time to build a response, per route',
+    ('method', 'route', 'status')
+)
+STAGE_SECONDS = Histogram('rmusic_stage_duration_seconds', 'Time spent per processing stage', ('stage',))
+VIDEO_BYTES_SERVED = Counter(
+    'rmusic_video_bytes_served_total', 'Bytes of video responses sent by the app (not in proxy modes)', ('mode',)
+)
+VIDEO_REDIRECTS = Counter('rmusic_video_redirects_total', 'Video requests redirected to a presigned storage URL')
+UPLOAD_BYTES = Counter('rmusic_upload_bytes_total', 'Bytes received by uploads', ('kind',))
+UPLOAD_SIZE = Histogram('rmusic_upload_size_bytes', 'Size of completed uploads', buckets=SIZE_BUCKETS)
+UPLOAD_THROUGHPUT = Histogram(
+    'rmusic_upload_throughput_bytes_per_second', 'Receive rate of upload request bodies',
+    ('kind',), buckets=THROUGHPUT_BUCKETS
+)
+FFMPEG_SECONDS = Histogram(
+    'rmusic_ffmpeg_duration_seconds', 'FFmpeg runtime per operation', ('operation',), buckets=FFMPEG_BUCKETS
+)
+FFMPEG_FAILURES = Counter('rmusic_ffmpeg_failures_total', 'Failed FFmpeg runs', ('operation', 'reason'))
+ADMISSION_REJECTED = Counter(
+    'rmusic_admission_rejected_total', 'Requests turned away by admission control', ('limiter', 'reason')
+)
+DB_QUERY_SECONDS = Histogram(
+    'rmusic_db_query_seconds', 'SQLite statement time including fetching rows', ('statement',),
+    buckets=QUERY_BUCKETS
+)
+JOB_SECONDS = Histogram(
+    'rmusic_job_duration_seconds', 'Background job runtime', ('kind', 'outcome'), buckets=FFMPEG_BUCKETS
+)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Move the upload and thumbnail folders into the sharded layout
+Files are renamed one at a time into their shard directory while the server
+keeps running: lookups check the shard first and the flat layout and the
+legacy shard after, so a file is found before and after its move. Files in
+the shard of their name before the first dot, where earlier versions put
+names containing dots, move to their shard too. Files still being written
+(.part and .tmp) are left for a later run. Running it again only moves what's
+left.
+Usage: python migrate_layout.py [--dry-run]
+"""
+
+import os
+import sys
+
+import layout
+
+UPLOAD_FOLDER = 'upload'
+THUMBNAILS_FOLDER = 'thumbnails'
+SKIP_SUFFIXES = ('.part', '.tmp')
+PROGRESS_EVERY = 1000  # files between progress lines
+
+
+def _movable(entry):
+    return (entry.is_file(follow_symlinks=False)
+            and not entry.name.startswith('.') and not entry.name.endswith(SKIP_SUFFIXES))
+
+
+def flat_files(folder):
+    """Names of the files still at the top of folder"""
+    with os.scandir(folder) as entries:
+        return sorted(entry.name for entry in entries if _movable(entry))
+
+
+def misplaced_files(folder):
+    """Paths of the files in a shard directory other than their own, by name"""
+    misplaced = {}
+    for entry in layout.scan(folder):
+        if not _movable(entry):
+            continue
+        shard_dir = os.path.relpath(os.path.dirname(entry.path), folder).replace(os.sep, '/')
+        if shard_dir != '.' and shard_dir != layout.shard(entry.name):
+            misplaced[entry.name] = entry.path
+    return misplaced
+
+
+def migrate_folder(folder, dry_run=False):
+    """Move every flat file of folder into its shard; returns how many were moved"""
+    if not os.path.isdir(folder):
+        print(f"  ✗ {folder} not found")
+        return 0
+
+    sources = {name: os.path.join(folder, name) for name in flat_files(folder)}
+    misplaced = misplaced_files(folder)
+    print(f"{folder}: {len(sources)} files in the flat layout, {len(misplaced)} in a legacy shard")
+    sources.update(misplaced)
+    names = sorted(sources)
+    if dry_run:
+        return len(names)
+
+    moved = 0
+    for name in names:
+        source = sources[name]
+        target = layout.path(folder, name)
+
+        # Both exist when a process that resolved the old path before the move
+        # wrote the file again (e.g. a faststart remux); that copy is the newer one
+        if os.path.exists(target):
+            print(f"  ✓ Replaced {layout.shard(name)}/{name} with the newer copy")
+
+        try:
+            os.replace(source, target)
+        except FileNotFoundError:
+            # Deleted since the folder was listed
+            continue
+        moved += 1
+
+        if moved % PROGRESS_EVERY == 0:
+            print(f"  {moved}/{len(names)} moved")
+
+    print(f"  ✓ {moved} files moved")
+    return moved
+
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print("Storage Layout Migration")
+    print("=" * 50)
+
+    dry_run = '--dry-run' in sys.argv
+    total = sum(migrate_folder(folder, dry_run) for folder in (UPLOAD_FOLDER, THUMBNAILS_FOLDER))
+
+    verb = 'Would move' if dry_run else 'Moved'
+    print(f"\n{verb} {total} files into {layout.SHARD_LEVELS}-level shard directories")
+
+    print("=" * 50)
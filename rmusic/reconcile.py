@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Reconcile the database with the upload, thumbnail and HLS stores
+Every store is listed once and compared with the names the database refers to
+as sets, so a pass costs O(files + rows) instead of one lookup per file. Rows
+whose file is gone are deleted in a single transaction and orphaned files are
+moved into a quarantine folder (or key prefix, for buckets) rather than
+removed, so a mistake can be undone until the quarantine is purged.
+Incremental passes skip local folders whose mtime (the latest of their shard
+directories) and library version haven't changed since the last pass.
+Usage: python reconcile.py [--dry-run] [--incremental] [--purge]
+"""
+
+import json
+import os
+import shutil
+import sys
+import time
+
+import db
+import storage
+
+UPLOAD_FOLDER = 'upload'
+THUMBNAILS_FOLDER = 'thumbnails'
+HLS_FOLDER = 'hls'
+QUARANTINE_FOLDER = 'quarantine'
+GRACE_SECONDS = 15 * 60  # newer files may still be waiting for their row to be written
+QUARANTINE_DAYS = 7  # quarantined files are purged after this many days
+INTERVAL_SECONDS = 60 * 60  # between scheduled incremental passes
+SKIP_SUFFIXES = ('.part', '.tmp')  # uploads in progress and HLS ladders being packaged
+
+
+def scan_store(store, now):
+    """List a store once; returns (names, recent) where recent is within the grace period"""
+    names = set()
+    recent = set()
+    for item in store.list():
+        if item['name'].startswith('.') or item['name'].endswith(SKIP_SUFFIXES):
+            continue
+        names.add(item['name'])
+        if now - item['mtime'] < GRACE_SECONDS:
+            recent.add(item['name'])
+    return names, recent
+
+
+def scan_folder(folder, now):
+    """List a flat folder once; returns (paths, recent)
+
+    paths maps entry names to their paths, recent holds the names within the
+    grace period.
+    """
+    paths = {}
+    recent = set()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or entry.name.endswith(SKIP_SUFFIXES):
+                continue
+            paths[entry.name] = entry.path
+            if now - entry.stat(follow_symlinks=False).st_mtime < GRACE_SECONDS:
+                recent.add(entry.name)
+    return paths, recent
+
+
+def referenced_thumbnails(rows):
+    """Names in the thumbnails store the rows refer to, and the stems of their preview tracks"""
+    names = set()
+    tracks = set()
+    for row in rows:
+        if row['thumbnail']:
+            names.add(row['thumbnail'])
+        if row['thumbnail_variants']:
+            names.update(variant['name'] for variant in json.loads(row['thumbnail_variants']))
+        if row['previews']:
+            names.add(row['previews'])
+            tracks.add(os.path.splitext(row['previews'])[0])
+        if row['waveform']:
+            names.add(row['waveform'])
+    return names, tracks
+
+
+def folder_unchanged(label, fingerprint):
+    """Whether a store and the library are as the last recorded pass left them"""
+    if fingerprint is None:
+        return False
+    state = db.query_one('reconcile_state_get', (label,))
+    if not state:
+        return False
+    return state['mtime_ns'] == fingerprint and state['library_version'] == db.query_value('library_state')
+
+
+def record_folder(label, fingerprint):
+    if fingerprint is None:
+        return
+    version = db.query_value('library_state')
+    db.execute('reconcile_state_set', (label, fingerprint, version, time.time()))
+
+
+def quarantine_target(quarantine_dir, folder):
+    """Where a folder's orphans go in a quarantine batch, keeping the folder's name"""
+    return os.path.join(quarantine_dir, os.path.basename(os.path.normpath(folder)))
+
+
+def quarantine(folder, paths, quarantine_dir):
+    """Move entries (a name to path dict) of a flat folder into quarantine_dir"""
+    target = quarantine_target(quarantine_dir, folder)
+    os.makedirs(target, exist_ok=True)
+    for name in sorted(paths):
+        shutil.move(paths[name], os.path.join(target, name))
+
+
+def reconcile(upload_store=None, thumbnail_store=None, hls_folder=HLS_FOLDER,
+              quarantine_folder=QUARANTINE_FOLDER, dry_run=False, incremental=False):
+    """Run one pass and return a report of what was (or, with dry_run, would be) changed
+
+    The stores default to the configured backend for the upload and thumbnail
+    folders. Rows whose stored file is missing are deleted first, so the
+    thumbnails and ladders only they referred to are quarantined in the same pass.
+    """
+    upload_store = upload_store or storage.open_store(UPLOAD_FOLDER)
+    thumbnail_store = thumbnail_store or storage.open_store(THUMBNAILS_FOLDER)
+
+    # A missing upload folder would otherwise look like every file was deleted
+    if not upload_store.ready():
+        raise FileNotFoundError(f"Upload store {upload_store.label} not found")
+
+    now = time.time()
+    quarantine_dir = os.path.join(quarantine_folder, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)))
+    report = {
+        'dry_run': dry_run,
+        'missing_rows': [],
+        'orphans': {},
+        'skipped_folders': [],
+        'deferred': 0,
+        'quarantine': None,
+    }
+
+    rows = db.query_all('videos_reconcile_files')
+
+    label = upload_store.label
+    fingerprint = upload_store.fingerprint()
+    if incremental and folder_unchanged(label, fingerprint):
+        report['skipped_folders'].append(label)
+    else:
+        stored, recent = scan_store(upload_store, now)
+        missing = [row for row in rows if row['storage_name'] not in stored]
+        report['missing_rows'] = [{'id': row['id'], 'storage_name': row['storage_name']} for row in missing]
+
+        # Files of rows that are being deleted become orphans right away
+        missing_ids = {row['id'] for row in missing}
+        rows = [row for row in rows if row['id'] not in missing_ids]
+
+        orphans = stored - recent - {row['storage_name'] for row in rows}
+        report['orphans'][label] = sorted(orphans)
+        report['deferred'] += len(recent)
+
+        if not dry_run:
+            with db.transaction():
+                db.executemany('video_delete', [(video_id,) for video_id in missing_ids])
+            if orphans:
+                upload_store.quarantine(orphans, quarantine_target(quarantine_dir, upload_store.folder))
+                report['quarantine'] = quarantine_dir
+            if not recent:
+                # Quarantining changed the folder, read the fingerprint again
+                record_folder(label, upload_store.fingerprint())
+
+    if thumbnail_store.ready():
+        label = thumbnail_store.label
+        fingerprint = thumbnail_store.fingerprint()
+        if incremental and folder_unchanged(label, fingerprint):
+            report['skipped_folders'].append(label)
+        else:
+            files, recent = scan_store(thumbnail_store, now)
+            names, tracks = referenced_thumbnails(rows)
+
+            # Sprite sheets belong to the track named like them
+            orphans = {
+                name for name in files - recent - names
+                if not ('.sprite-' in name and name.rsplit('.sprite-', 1)[0] in tracks)
+            }
+            report['orphans'][label] = sorted(orphans)
+            report['deferred'] += len(recent)
+
+            if not dry_run:
+                if orphans:
+                    thumbnail_store.quarantine(orphans, quarantine_target(quarantine_dir, thumbnail_store.folder))
+                    report['quarantine'] = quarantine_dir
+                if not recent:
+                    record_folder(label, thumbnail_store.fingerprint())
+
+    if os.path.isdir(hls_folder):
+        # One ladder directory per video, always on local disk
+        if incremental and folder_unchanged(hls_folder, os.stat(hls_folder).st_mtime_ns):
+            report['skipped_folders'].append(hls_folder)
+        else:
+            ladders, recent = scan_folder(hls_folder, now)
+            orphans = ladders.keys() - recent - {row['hls'] for row in rows if row['hls']}
+            report['orphans'][hls_folder] = sorted(orphans)
+            report['deferred'] += len(recent)
+
+            if not dry_run:
+                if orphans:
+                    quarantine(hls_folder, {name: ladders[name] for name in orphans}, quarantine_dir)
+                    report['quarantine'] = quarantine_dir
+                if not recent:
+                    record_folder(hls_folder, os.stat(hls_folder).st_mtime_ns)
+
+    return report
+
+
+def purge_quarantine(quarantine_folder=QUARANTINE_FOLDER, days=QUARANTINE_DAYS):
+    """Delete quarantine batches older than days; returns how many were removed"""
+    if not os.path.isdir(quarantine_folder):
+        return 0
+
+    cutoff = time.time() - days * 86400
+    purged = 0
+    with os.scandir(quarantine_folder) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                purged += 1
+    return purged
+
+
+def print_report(report):
+    for row in report['missing_rows']:
+        print(f"  ✗ Missing file, row {row['id']}: {row['storage_name']}")
+
+    for folder, names in report['orphans'].items():
+        for name in names:
+            print(f"  ✗ Orphaned file in {folder}: {name}")
+
+    for folder in report['skipped_folders']:
+        print(f"  ✓ Unchanged since last pass: {folder}")
+
+    orphan_count = sum(len(names) for names in report['orphans'].values())
+    if report['dry_run']:
+        print(f"\nWould delete {len(report['missing_rows'])} rows and quarantine {orphan_count} files")
+    else:
+        print(f"\nDeleted {len(report['missing_rows'])} rows, quarantined {orphan_count} files")
+    if report['deferred']:
+        print(f"Skipped {report['deferred']} files newer than {GRACE_SECONDS}s")
+    if report['quarantine']:
+        print(f"Quarantined files are in {report['quarantine']}")
+
+if __name__ == '__main__':
+    print("=" * 50)
+    print("Library Reconciler")
+    print("=" * 50)
+
+    db.init_schema()
+    print_report(reconcile(dry_run='--dry-run' in sys.argv, incremental='--incremental' in sys.argv))
+
+    if '--purge' in sys.argv:
+        print(f"Purged {purge_quarantine()} quarantine batches older than {QUARANTINE_DAYS} days")
+
+    db.close_connection()
+
+    print("=" * 50)
@@ -1,58 +1,128 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory, Response
+from flask import Flask, request, jsonify, send_file, redirect, Response, g
 import os
-import sqlite3
+import shutil
 from werkzeug.utils import secure_filename
+from werkzeug.http import is_resource_modified
+from werkzeug.middleware.proxy_fix import ProxyFix
 import uuid
 import time
+import math
+import functools
 import mimetypes
-import subprocess
+import json
+import re
+import threading
+from datetime import datetime, timezone
+
+import admission
+import assets
+import db
+import jobs
+import layout
+import logs
+import metrics
+import storage
+import uploads
+import thumbnail_backfill
+import reconcile
+from delivery import send_media, send_object, send_precompressed, SERVE_MODES
+from media import (
+    generate_video_thumbnail, generate_thumbnail_variants, generate_preview_sprites, preview_sheets,
+    package_hls, ensure_faststart, probe_media, thumbnail_time, ffmpeg_available, ffprobe_available,
+    generate_waveform, HLS_MASTER_PLAYLIST, FASTSTART_EXTENSIONS, THUMBNAIL_FORMATS, METADATA_FIELDS,
+    WAVEFORM_EXTENSION
+)
 
 app = Flask(__name__, static_folder='.')
 
 # Application settings
 UPLOAD_FOLDER = 'upload'
 THUMBNAILS_FOLDER = 'thumbnails'
+HLS_FOLDER = 'hls'  # one directory of playlists and segments per stored video
+QUARANTINE_FOLDER = 'quarantine'  # files removed by /cleanup, purged after reconcile.QUARANTINE_DAYS
 ALLOWED_EXTENSIONS = {'mp4', 'mp3', 'webm', 'ogg', 'avi', 'mov', 'mkv', 'wav'}
 MAX_FILE_SIZE = 500 * 1024 * 1024  # 500MB
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+AUDIO_EXTENSIONS = ('.mp3', '.wav', '.ogg')  # tracks that get a waveform instead of a thumbnail
+MEDIA_EXTENSIONS = tuple(f'.{ext}' for ext in sorted(ALLOWED_EXTENSIONS))
+THUMBNAIL_VARIANT_PATTERN = re.compile(r'\.\d+w\.[0-9a-f]{12}\.(webp|avif)$')  # content-hashed names
+THUMBNAIL_WORKERS = 2  # ffmpeg processes running in the background at most
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB chunks for resumable uploads
+UPLOAD_MAX_SIZE = 4 * 1024 * 1024 * 1024  # 4GB per file for resumable uploads
+UPLOAD_PARALLEL_CHUNKS = 4  # chunks a client may send at once per file
+UPLOAD_PARALLEL_FILES = 2  # files a client may upload at once
+VIDEOS_PAGE_SIZE = 50  # default page size for /videos?limit=
+VIDEOS_MAX_PAGE_SIZE = 200
+SERVE_MODE = os.environ.get('RMUSIC_SERVE_MODE', 'python')  # python, sendfile, x-accel or x-sendfile
+SERVE_X_ACCEL_PREFIX = '/protected/'  # nginx internal location aliased to this folder
+SERVE_READ_SIZE = 256 * 1024  # bytes per read when Python streams files
+HEALTH_FILE_COUNT_TTL = 60  # seconds before /health recounts the folders in the background
+READINESS_TTL = 5  # seconds /readyz answers with its last result, a remote store check is a round trip
+QUIET_ROUTES = ('/livez', '/readyz', '/metrics', '/admission')  # polled often, timed but not logged
+ASSETS_BUILD_FOLDER = assets.BUILD_FOLDER  # minified, fingerprinted and precompressed static assets
+# Upload requests writing or finalizing at once on the host. A client sends up to
+# UPLOAD_PARALLEL_FILES x UPLOAD_PARALLEL_CHUNKS of them, the default lets 8 clients
+# upload at full speed; more clients are slowed down by busy retries, not failed
+UPLOAD_CONCURRENCY = int(os.environ.get('RMUSIC_UPLOAD_CONCURRENCY', 8 * UPLOAD_PARALLEL_FILES * UPLOAD_PARALLEL_CHUNKS))
+UPLOAD_RATE = float(os.environ.get('RMUSIC_UPLOAD_RATE', 50))  # upload requests per second from all clients
+UPLOAD_CLIENT_RATE = float(os.environ.get('RMUSIC_UPLOAD_CLIENT_RATE', 20))  # upload requests per second from one client
+GENERATE_CONCURRENCY = int(os.environ.get('RMUSIC_GENERATE_CONCURRENCY', 1))  # /generate-thumbnails requests at once
+GENERATE_RATE = 1 / 10  # /generate-thumbnails requests per second from all clients
+GENERATE_CLIENT_RATE = 1 / 30  # and from one client
+TRUSTED_PROXIES = int(os.environ.get('RMUSIC_TRUSTED_PROXIES', 0))  # reverse proxies in front setting X-Forwarded-For
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['THUMBNAILS_FOLDER'] = THUMBNAILS_FOLDER
+app.config['HLS_FOLDER'] = HLS_FOLDER
+app.config['QUARANTINE_FOLDER'] = QUARANTINE_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['DATABASE'] = db.DB_PATH
+app.config['SERVE_MODE'] = SERVE_MODE
+app.config['SERVE_X_ACCEL_PREFIX'] = SERVE_X_ACCEL_PREFIX
+app.config['SERVE_READ_SIZE'] = SERVE_READ_SIZE
+
+if SERVE_MODE not in SERVE_MODES:
+    raise ValueError(f"RMUSIC_SERVE_MODE must be one of {', '.join(SERVE_MODES)}")
+
+# Behind a reverse proxy every request comes from the proxy's address, which would
+# put all clients in one admission bucket; take the client from X-Forwarded-For.
+# Only set when the proxies overwrite the header, clients could pick their own key
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 
 # Create folders if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(THUMBNAILS_FOLDER, exist_ok=True)
+os.makedirs(HLS_FOLDER, exist_ok=True)
+
+# Where uploads and thumbnails are kept (RMUSIC_STORAGE); with a remote backend
+# the local folders only stage files until they are saved to it
+video_store = storage.open_store(UPLOAD_FOLDER)
+thumbnail_store = storage.open_store(THUMBNAILS_FOLDER)
+
+# Admission control, shared by all worker processes: requests over the limits get a
+# 429 or 503 with Retry-After, ffmpeg runs queue up behind media.ffmpeg_limiter
+upload_limiter = admission.Limiter('upload', UPLOAD_CONCURRENCY, UPLOAD_RATE, client_rate=UPLOAD_CLIENT_RATE)
+generate_limiter = admission.Limiter(
+    'generate', GENERATE_CONCURRENCY, GENERATE_RATE, burst=3, client_rate=GENERATE_CLIENT_RATE, client_burst=2
+)
+
+# Rebuilt only when a source changed; without a build the sources are served as they are
+try:
+    asset_manifest = assets.ensure_built(app.root_path, os.path.join(app.root_path, ASSETS_BUILD_FOLDER))
+except Exception as e:
+    logs.warning('asset_build_failed', error=str(e))
+    asset_manifest = None
 
 def init_database():
-    """Initialize SQLite database with required columns"""
-    conn = sqlite3.connect('videos.db', check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Create videos table with all required columns
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS videos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        filename TEXT UNIQUE NOT NULL,
-        original_filename TEXT NOT NULL,
-        file_size INTEGER,
-        thumbnail TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-    ''')
-    
-    # Check if thumbnail column exists, if not add it
-    cursor.execute("PRAGMA table_info(videos)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    if 'thumbnail' not in columns:
-        print("Adding thumbnail column to videos table...")
-        cursor.execute('ALTER TABLE videos ADD COLUMN thumbnail TEXT')
-    
-    conn.commit()
-    conn.close()
+    """Initialize SQLite database with required tables, columns and indexes"""
+    db.init_schema()
     print("Database initialized successfully")
 
+# Every process serving the app (dev server, gunicorn, asgi.py) needs the current
+# schema before its first request, the background hooks query the new tables
+init_database()
+
 def sanitize_filename(filename):
     """Sanitize filename by removing special characters and non-ASCII"""
     # Keep only safe characters
@@ -90,58 +160,365 @@ def generate_unique_filename(filename):
     
     return f"{base_name}_{unique_id}.{ext}"
 
-def generate_video_thumbnail(video_path, output_path, time_in_seconds=10):
-    """Generate thumbnail from video at specific time"""
+def save_metadata(storage_name, metadata):
+    """Store probed stream details on every copy of a stored file, or record that probing failed"""
+    values = [metadata[field] for field in METADATA_FIELDS] if metadata else [None] * len(METADATA_FIELDS)
+    db.execute('video_set_metadata', (*values, 1 if metadata else 0, storage_name))
+
+def ensure_metadata(result, video_path):
+    """Stream details of a video_files_by_id row, probing files from before metadata was stored"""
+    if result['probed'] is not None or not ffprobe_available():
+        return {'duration': result['duration'], 'has_video': result['has_video'], 'has_audio': result['has_audio']}
+    
+    with metrics.stage('probe'):
+        metadata = probe_media(video_path)
+    save_metadata(result['storage_name'], metadata)
+    return metadata or {'duration': None, 'has_video': None, 'has_audio': None}
+
+def process_probe_job(job):
+    """Background job: read the stream details of a video stored before they were probed at ingest"""
+    result = db.query_one('video_files_by_id', (job['video_id'],))
+    
+    # Video was deleted or already probed
+    if not result or result['probed'] is not None:
+        return
+    
+    if not video_store.exists(result['storage_name']):
+        return
+    
+    if not ffprobe_available():
+        raise RuntimeError("ffprobe is not available")
+    
+    ensure_metadata(result, video_store.source(result['storage_name']))
+
+jobs.register_handler('probe', process_probe_job)
+
+def process_thumbnail_job(job):
+    """Background job: generate the thumbnail and its WebP/AVIF variants of an uploaded video"""
+    result = db.query_one('video_files_by_id', (job['video_id'],))
+    
+    # Video was deleted or already has its thumbnails
+    if not result or (result['thumbnail'] and result['thumbnail_variants']):
+        return
+    
+    storage_name = result['storage_name']
+    if not video_store.exists(storage_name):
+        return
+    video_path = video_store.source(storage_name)
+    
+    # Audio in a video container has no frame to take, don't spend ffmpeg runs failing on it
+    metadata = ensure_metadata(result, video_path)
+    if metadata['has_video'] == 0:
+        return
+    
+    stem = os.path.splitext(storage_name)[0]
+    seconds = thumbnail_time(metadata['duration'])
+    
+    # The JPEG stays the fallback for browsers without WebP/AVIF
+    if not result['thumbnail']:
+        thumb_name = f"{stem}.jpg"
+        thumb_path = layout.path(app.config['THUMBNAILS_FOLDER'], thumb_name)
+        
+        with metrics.stage('thumbnail'):
+            generated = generate_video_thumbnail(video_path, thumb_path, seconds)
+        if not generated:
+            raise RuntimeError(f"Could not generate thumbnail for {storage_name}")
+        store_thumbnails([thumb_name])
+        
+        # Every copy of the same upload gets the thumbnail
+        db.execute('video_set_thumbnail', (thumb_name, storage_name))
+    
+    if not result['thumbnail_variants']:
+        with metrics.stage('thumbnail_variants'):
+            variants = generate_thumbnail_variants(
+                video_path, layout.directory(app.config['THUMBNAILS_FOLDER'], stem), stem, seconds
+            )
+        if not variants:
+            raise RuntimeError(f"Could not generate thumbnail variants for {storage_name}")
+        store_thumbnails([variant['name'] for variant in variants])
+        
+        db.execute('video_set_thumbnail_variants', (json.dumps(variants), storage_name))
+
+def store_thumbnails(names):
+    """Save files generated into the thumbnails folder to the thumbnail store"""
+    for name in names:
+        thumbnail_store.save(name, layout.locate(app.config['THUMBNAILS_FOLDER'], name))
+
+def remove_thumbnail_variants(variants_json):
+    """Delete the WebP/AVIF files listed in a thumbnail_variants value"""
+    for variant in json.loads(variants_json):
+        thumbnail_store.delete(variant['name'])
+
+def thumbnail_sources(variants_json):
+    """Turn a thumbnail_variants value into <source> type/srcset pairs, best format first"""
+    if not variants_json:
+        return []
+    
+    variants = json.loads(variants_json)
+    sources = []
+    for _, mime_type, _ in THUMBNAIL_FORMATS:
+        candidates = sorted((v for v in variants if v['type'] == mime_type), key=lambda v: v['width'])
+        if candidates:
+            sources.append({
+                'type': mime_type,
+                'srcset': ', '.join(f"/thumb/{v['name']} {v['width']}w" for v in candidates)
+            })
+    return sources
+
+def video_json(row, fields):
+    """Select the requested fields of a listed video"""
+    video = {f: row[f] for f in fields}
+    if 'thumbnail_sources' in video:
+        video['thumbnail_sources'] = thumbnail_sources(video['thumbnail_sources'])
+    return video
+
+jobs.register_handler('thumbnail', process_thumbnail_job)
+
+def process_hls_job(job):
+    """Background job: package an uploaded video as an adaptive-bitrate HLS ladder"""
+    result = db.query_one('video_files_by_id', (job['video_id'],))
+    
+    # Video was deleted or is already packaged
+    if not result or result['hls']:
+        return
+    
+    storage_name = result['storage_name']
+    if not video_store.exists(storage_name):
+        return
+    
+    hls_name = os.path.splitext(storage_name)[0]
+    hls_dir = os.path.join(app.config['HLS_FOLDER'], hls_name)
+    
+    # Encodes run for up to HLS_TIMEOUT, longer than a presigned URL is valid,
+    # and read the file once per rendition: a remote object is downloaded first
+    has_audio = bool(result['has_audio']) if result['probed'] == 1 else None
+    with video_store.fetch(storage_name) as video_path:
+        packaged = package_hls(video_path, hls_dir, has_audio=has_audio)
+    if not packaged:
+        raise RuntimeError(f"Could not package {storage_name} as HLS")
+    
+    with db.transaction(immediate=True):
+        db.execute('video_set_hls', (hls_name, storage_name))
+        still_referenced = db.query_value('blob_ref_count', (storage_name,))
+    
+    # Every copy was deleted while the ladder was being encoded
+    if not still_referenced:
+        shutil.rmtree(hls_dir, ignore_errors=True)
+
+jobs.register_handler('hls', process_hls_job)
+
+def remove_previews(vtt_name):
+    """Delete a preview track and its sprite sheets"""
+    sheets = thumbnail_store.list(prefix=f"{os.path.splitext(vtt_name)[0]}.sprite-")
+    for name in [sheet['name'] for sheet in sheets] + [vtt_name]:
+        thumbnail_store.delete(name)
+
+def process_previews_job(job):
+    """Background job: generate the scrubbing preview sprites of an uploaded video"""
+    result = db.query_one('video_files_by_id', (job['video_id'],))
+    
+    # Video was deleted or already has previews
+    if not result or result['previews']:
+        return
+    
+    storage_name = result['storage_name']
+    if not video_store.exists(storage_name):
+        return
+    
+    # A fresh name per run lets browsers cache the files forever
+    name = f"{os.path.splitext(storage_name)[0]}.{uuid.uuid4().hex[:8]}"
+    output_folder = layout.directory(app.config['THUMBNAILS_FOLDER'], name)
+    vtt_name = generate_preview_sprites(video_store.source(storage_name), output_folder, name)
+    if not vtt_name:
+        raise RuntimeError(f"Could not generate previews for {storage_name}")
+    store_thumbnails([os.path.basename(path) for path in preview_sheets(output_folder, vtt_name)] + [vtt_name])
+    
+    with db.transaction(immediate=True):
+        db.execute('video_set_previews', (vtt_name, storage_name))
+        still_referenced = db.query_value('blob_ref_count', (storage_name,))
+    
+    if not still_referenced:
+        remove_previews(vtt_name)
+
+jobs.register_handler('previews', process_previews_job)
+
+def process_waveform_job(job):
+    """Background job: compute the waveform peaks of an uploaded audio track"""
+    result = db.query_one('video_files_by_id', (job['video_id'],))
+    
+    # Track was deleted or already has its waveform
+    if not result or result['waveform']:
+        return
+    
+    storage_name = result['storage_name']
+    if not video_store.exists(storage_name):
+        return
+    
+    # Probed without an audio stream: nothing to draw
+    if result['has_audio'] == 0:
+        return
+    
+    # Retrying won't install it; a later /generate-waveforms run picks the track up
+    if not ffmpeg_available():
+        raise jobs.PermanentError("ffmpeg is not installed")
+    
+    waveform_name = f"{os.path.splitext(storage_name)[0]}{WAVEFORM_EXTENSION}"
+    waveform_path = layout.path(app.config['THUMBNAILS_FOLDER'], waveform_name)
+    with metrics.stage('waveform'):
+        generated = generate_waveform(video_store.source(storage_name), waveform_path)
+    if not generated:
+        raise RuntimeError(f"Could not compute the waveform of {storage_name}")
+    store_thumbnails([waveform_name])
+    
+    with db.transaction(immediate=True):
+        db.execute('video_set_waveform', (waveform_name, storage_name))
+        still_referenced = db.query_value('blob_ref_count', (storage_name,))
+    
+    if not still_referenced:
+        thumbnail_store.delete(waveform_name)
+
+jobs.register_handler('waveform', process_waveform_job)
+
+def process_faststart_job(job):
+    """Background job: move the index of an uploaded MP4/MOV to the front of the file"""
+    result = db.query_one('video_files_by_id', (job['video_id'],))
+    
+    # Video was deleted or already checked
+    if not result or result['faststart'] is not None:
+        return
+    
+    storage_name = result['storage_name']
+    if not video_store.exists(storage_name):
+        return
+    
+    # The remux rewrites a local file; a remote object is downloaded and replaced when it changed
+    with video_store.fetch(storage_name) as video_path:
+        optimized = ensure_faststart(video_path)
+        if optimized is False:
+            raise RuntimeError(f"Could not remux {storage_name} for faststart")
+        file_size = os.path.getsize(video_path)
+        if optimized == 'remuxed' and not video_store.local:
+            video_store.save(storage_name, video_path)
+    
+    db.execute('video_set_faststart', (1 if optimized else 0, file_size, storage_name))
+
+jobs.register_handler('faststart', process_faststart_job)
+
+def reconcile_library(dry_run=False, incremental=False):
+    return reconcile.reconcile(
+        video_store, thumbnail_store, app.config['HLS_FOLDER'],
+        app.config['QUARANTINE_FOLDER'], dry_run=dry_run, incremental=incremental
+    )
+
+def process_reconcile_job(job):
+    """Background job: incremental reconcile pass, then schedule the next one"""
     try:
-        # Ensure thumbnails folder exists
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        report = reconcile_library(incremental=True)
+        reconcile.purge_quarantine(app.config['QUARANTINE_FOLDER'])
+        # reconcile leaves .part files alone, abandoned uploads are expired here
+        expired = uploads.expire_sessions(app.config['UPLOAD_FOLDER'])
+        if expired:
+            logs.info('upload_sessions_expired', count=expired)
         
-        # Check if ffmpeg is available
-        try:
-            subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-        except (subprocess.CalledProcessError, FileNotFoundError):
-            print("FFmpeg not found. Thumbnail generation disabled.")
-            return False
-        
-        # Generate thumbnail from video
-        command = [
-            'ffmpeg',
-            '-y',
-            '-ss', str(time_in_seconds),
-            '-i', video_path,
-            '-frames:v', '1',
-            '-vf', 'scale=320:-1',
-            '-q:v', '2',
-            output_path
-        ]
-        
-        # Run ffmpeg command
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            timeout=30
+        orphan_count = sum(len(names) for names in report['orphans'].values())
+        if report['missing_rows'] or orphan_count:
+            logs.info('reconcile_done', deleted_rows=len(report['missing_rows']), quarantined=orphan_count)
+    finally:
+        # Reconcile jobs aren't retried, so each pass queues exactly one successor
+        jobs.enqueue('reconcile', max_attempts=1, delay=reconcile.INTERVAL_SECONDS)
+
+jobs.register_handler('reconcile', process_reconcile_job)
+
+_reconcile_scheduled = False
+
+def schedule_reconcile():
+    """Queue the first incremental pass unless another process already did"""
+    global _reconcile_scheduled
+    if _reconcile_scheduled:
+        return
+    
+    with db.transaction(immediate=True):
+        if not jobs.has_active_job('reconcile'):
+            jobs.enqueue('reconcile', max_attempts=1)
+    _reconcile_scheduled = True
+
+@app.before_request
+def start_request():
+    """Give every request an id and start timing it"""
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    g.request_context = (logs.context_id.set(g.request_id), metrics.current_stages.set({}))
+
+@app.after_request
+def finish_request(response):
+    """Record the request's latency and write its log line"""
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.REQUEST_SECONDS.observe(elapsed, method=request.method, route=route, status=response.status_code)
+    response.headers['X-Request-ID'] = g.request_id
+    
+    if route not in QUIET_ROUTES:
+        logs.info(
+            'request', method=request.method, path=request.path, route=route,
+            status=response.status_code, duration_ms=round(elapsed * 1000, 2),
+            bytes=response.content_length, stages=metrics.current_stages.get() or None
         )
-        
-        if result.returncode == 0 and os.path.exists(output_path):
-            thumb_size = os.path.getsize(output_path)
-            print(f"Thumbnail generated: {output_path} ({thumb_size} bytes)")
-            return True
-        else:
-            print(f"Thumbnail generation failed: {result.stderr}")
-            return False
-            
-    except subprocess.TimeoutExpired:
-        print("Thumbnail generation timed out")
-        return False
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    context = g.pop('request_context', None)
+    if context:
+        logs.context_id.reset(context[0])
+        metrics.current_stages.reset(context[1])
+
+@app.before_request
+def start_background_workers():
+    """Start the job workers in whichever process serves requests (dev server or gunicorn)"""
+    # Tried again on the next request; a failure here must not fail the request itself
+    try:
+        jobs.start_workers(THUMBNAIL_WORKERS)
+        thumbnail_backfill.resume_interrupted_runs(UPLOAD_FOLDER, THUMBNAILS_FOLDER)
+        schedule_reconcile()
     except Exception as e:
-        print(f"Error generating thumbnail: {e}")
-        return False
+        logs.error('background_start_error', error=str(e))
+
+def admitted(limiter):
+    """Run a view only when limiter admits the client, answer 429/503 with Retry-After otherwise"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            rejection = limiter.admit(request.remote_addr)
+            if rejection:
+                retry_after = max(1, math.ceil(rejection.retry_after))
+                message = 'Too many requests' if rejection.status == 429 else 'Server busy'
+                response = jsonify({'error': f'{message}, retry in {retry_after}s', 'retry_after': retry_after})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, rejection.status
+            
+            start = time.monotonic()
+            g.admission_release = lambda: limiter.release(time.monotonic() - start)
+            g.admission_kept = False
+            try:
+                return view(*args, **kwargs)
+            finally:
+                if not g.admission_kept:
+                    g.admission_release()
+        return wrapper
+    return decorator
+
+def keep_admission_slot():
+    """Keep the slot of the current request for work that goes on after it; returns its release"""
+    g.admission_kept = True
+    return g.admission_release
 
 @app.route('/')
 def index():
     """Home page"""
     try:
+        # The built page refers to the fingerprinted assets; it must be revalidated itself
+        if asset_manifest:
+            return send_precompressed(ASSETS_BUILD_FOLDER, assets.INDEX_PAGE)
         return send_file('index.html')
     except:
         return "index.html not found", 404
@@ -150,21 +527,223 @@ def index():
 def serve_video(filename):
     """Serve video file"""
     try:
-        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+        # Players stream and seek straight from the bucket
+        if not video_store.local:
+            metrics.VIDEO_REDIRECTS.inc()
+            return redirect(video_store.url(filename))
+        
+        folder = app.config['UPLOAD_FOLDER']
+        response = send_media(folder, layout.relative(folder, filename))
+        # Proxy modes send the bytes themselves and leave Content-Length unset
+        if response.status_code in (200, 206) and request.method != 'HEAD' and response.content_length:
+            metrics.VIDEO_BYTES_SERVED.inc(response.content_length, mode=app.config['SERVE_MODE'])
+        return response
     except Exception as e:
-        print(f"Video error: {e}")
+        logs.error('video_error', error=str(e))
         return "Video not found", 404
 
+def send_thumbnail(filename, mimetype=None, max_age=None):
+    """Send a file of the thumbnail store, proxied when the store is remote"""
+    if not thumbnail_store.local:
+        return send_object(thumbnail_store, filename, mimetype=mimetype, max_age=max_age)
+    folder = app.config['THUMBNAILS_FOLDER']
+    return send_media(folder, layout.relative(folder, filename), mimetype=mimetype, max_age=max_age)
+
+def thumbnail_caching(filename):
+    """MIME type and max age of a thumbnail store file; None when it must be revalidated"""
+    # Variants and preview files get a new name whenever they are regenerated
+    if filename.endswith('.vtt') or '.sprite-' in filename or THUMBNAIL_VARIANT_PATTERN.search(filename):
+        mimetype = {'.vtt': 'text/vtt', '.avif': 'image/avif', '.webp': 'image/webp'}.get(
+            os.path.splitext(filename)[1]
+        )
+        return mimetype, 31536000
+    return None, None
+
 @app.route('/thumb/<filename>')
 def serve_thumbnail(filename):
-    """Serve thumbnail image"""
+    """Serve thumbnail image, preview sprite sheet or preview track"""
     try:
-        return send_from_directory(app.config['THUMBNAILS_FOLDER'], filename)
+        mimetype, max_age = thumbnail_caching(filename)
+        response = send_thumbnail(filename, mimetype=mimetype, max_age=max_age)
+        if max_age:
+            response.cache_control.immutable = True
+        return response
     except Exception as e:
-        print(f"Thumbnail error: {e}")
+        logs.error('thumbnail_error', error=str(e))
         return "Thumbnail not found", 404
 
+@app.route('/waveform/<filename>')
+def serve_waveform(filename):
+    """Serve the precomputed waveform peaks of an audio track"""
+    try:
+        if not filename.endswith(WAVEFORM_EXTENSION):
+            return "Waveform not found", 404
+        
+        # The peaks of a stored file never change
+        response = send_thumbnail(filename, mimetype='application/octet-stream', max_age=31536000)
+        response.cache_control.immutable = True
+        return response
+    except Exception as e:
+        logs.error('waveform_error', error=str(e))
+        return "Waveform not found", 404
+
+def hls_caching(filename):
+    """MIME type and max age of an HLS file, None for files that aren't served"""
+    if filename.endswith('.m3u8'):
+        # Playlists are rewritten when a video is packaged again, revalidate them
+        return 'application/vnd.apple.mpegurl', None
+    if filename.endswith('.ts'):
+        # Segments never change once the ladder is published
+        return 'video/mp2t', 31536000
+    return None
+
+@app.route('/hls/<path:filename>')
+def serve_hls(filename):
+    """Serve HLS playlists and segments"""
+    try:
+        caching = hls_caching(filename)
+        if caching is None:
+            return "HLS file not found", 404
+        mimetype, max_age = caching
+        response = send_media(app.config['HLS_FOLDER'], filename, mimetype=mimetype, max_age=max_age)
+        if max_age:
+            response.cache_control.immutable = True
+        return response
+    except Exception as e:
+        logs.error('hls_error', error=str(e))
+        return "HLS file not found", 404
+
+def find_blob(content_hash):
+    """Return the stored file (storage_name, thumbnail, file_size) with this hash, or None"""
+    if not content_hash:
+        return None
+    
+    blob = db.query_one('blob_by_hash', (content_hash,))
+    
+    # Ignore rows whose file was removed behind our back
+    if blob and video_store.exists(blob['storage_name']):
+        return blob
+    return None
+
+def inspect_upload(file_path, content_hash):
+    """Find the stored copy of an upload, or probe and store it when it's new; returns (blob, metadata)"""
+    with metrics.stage('dedupe_lookup'):
+        blob = find_blob(content_hash)
+    if blob:
+        return blob, None
+    
+    with metrics.stage('probe'):
+        metadata = probe_media(file_path)
+    # A remote store gets the file before its row is written
+    with metrics.stage('store'):
+        video_store.save(os.path.basename(file_path), file_path)
+    return None, metadata
+
+def register_upload(original_filename, unique_filename, file_path, content_hash, blob=None, metadata=None):
+    """Add an uploaded file to the library and queue its background processing
+
+    A file whose content is already stored becomes a new row pointing at the
+    existing file and thumbnail; the new copy is removed. Pass blob when the
+    duplicate was detected before any bytes were written (file_path is None).
+    metadata is the probe_media() result of a new file, which inspect_upload()
+    has already saved to the video store.
+    Must run inside db.transaction() so the row and its jobs commit together.
+    """
+    # Extract video name (without extension)
+    video_name = original_filename.rsplit('.', 1)[0]
+    
+    if blob is None:
+        with metrics.stage('dedupe_lookup'):
+            blob = find_blob(content_hash)
+        # Stored by inspect_upload() while the same content was registered by another upload
+        if blob and file_path:
+            video_store.delete(unique_filename)
+    elif file_path and os.path.basename(file_path) != blob['storage_name']:
+        os.remove(file_path)
+    
+    if blob:
+        storage_name, thumbnail, file_size = blob['storage_name'], blob['thumbnail'], blob['file_size']
+        thumbnail_variants, hls, previews = blob['thumbnail_variants'], blob['hls'], blob['previews']
+        waveform = blob['waveform']
+    else:
+        storage_name, thumbnail, file_size = unique_filename, None, video_store.stat(unique_filename)['size']
+        thumbnail_variants, hls, previews, waveform = None, None, None, None
+    
+    metrics.UPLOAD_SIZE.observe(file_size)
+    
+    with metrics.stage('db_insert'):
+        video_id = db.execute('video_insert', (
+            video_name, unique_filename, original_filename, file_size, thumbnail,
+            thumbnail_variants, content_hash, storage_name, hls, previews, waveform
+        )).lastrowid
+        
+        if blob:
+            db.execute('video_copy_metadata', (video_id,))
+            metadata = db.query_one('video_files_by_id', (video_id,))
+        elif ffprobe_available():
+            save_metadata(storage_name, metadata)
+    
+    # Faststart remux, thumbnails, previews and HLS ladders run in the background so the upload returns immediately
+    if not blob and storage_name.lower().endswith(FASTSTART_EXTENSIONS):
+        jobs.enqueue('faststart', video_id)
+    
+    job_id = None
+    hls_job_id = None
+    # Files probed without a video stream get no frame-based jobs
+    if storage_name.lower().endswith(VIDEO_EXTENSIONS) and not (metadata and metadata['has_video'] == 0):
+        if not thumbnail or not thumbnail_variants:
+            # The original's job still to run sets the thumbnail of every copy
+            if blob:
+                job_id = db.query_value('job_active_for_storage', ('thumbnail', storage_name))
+            if job_id is None:
+                job_id = jobs.enqueue('thumbnail', video_id)
+        # A duplicate's previews and ladder come from the jobs queued for the original upload
+        if not blob:
+            jobs.enqueue('previews', video_id)
+            hls_job_id = jobs.enqueue('hls', video_id)
+    
+    # Audio tracks get their waveform peaks instead; a duplicate shares the original's
+    if not blob and storage_name.lower().endswith(AUDIO_EXTENSIONS) and not (metadata and metadata['has_audio'] == 0):
+        jobs.enqueue('waveform', video_id)
+    
+    return {
+        'message': 'File uploaded successfully',
+        'id': video_id,
+        'filename': unique_filename,
+        'name': video_name,
+        'size': file_size,
+        'duration': metadata['duration'] if metadata else None,
+        'thumbnail': thumbnail,
+        'thumbnail_sources': thumbnail_sources(thumbnail_variants),
+        'job_id': job_id,
+        'hls_job_id': hls_job_id,
+        'deduplicated': bool(blob),
+        'url': f"/video/{storage_name}",
+        'hls_url': f"/hls/{hls}/{HLS_MASTER_PLAYLIST}" if hls else None,
+        'preview_url': f"/thumb/{previews}" if previews else None,
+        'waveform_url': f"/waveform/{waveform}" if waveform else None
+    }
+
+def record_upload_bytes(kind, size, seconds):
+    metrics.UPLOAD_BYTES.inc(size, kind=kind)
+    if seconds > 0:
+        metrics.UPLOAD_THROUGHPUT.observe(size / seconds, kind=kind)
+
+def clean_upload_filename(filename):
+    """Sanitize an uploaded filename, returns (filename, error)"""
+    # Sanitize filename to handle Unicode/emoji issues
+    original_filename = sanitize_filename(filename)
+    
+    if not original_filename:
+        original_filename = "uploaded_file"
+    
+    if not allowed_file(original_filename):
+        return None, 'File format not supported. Allowed: MP4, MP3, AVI, MOV, MKV, WEBM, WAV, OGG'
+    
+    return original_filename, None
+
 @app.route('/upload', methods=['POST'])
+@admitted(upload_limiter)
 def upload_file():
     """Upload video or audio file"""
     try:
@@ -176,156 +755,506 @@ def upload_file():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        # Sanitize filename to handle Unicode/emoji issues
-        original_filename = sanitize_filename(file.filename)
+        original_filename, error = clean_upload_filename(file.filename)
+        if error:
+            return jsonify({'error': error}), 400
         
-        if not original_filename:
-            original_filename = "uploaded_file"
+        # Create unique filename
+        unique_filename = generate_unique_filename(original_filename)
+        file_path = layout.path(app.config['UPLOAD_FOLDER'], unique_filename)
         
-        if not allowed_file(original_filename):
-            return jsonify({'error': 'File format not supported. Allowed: MP4, MP3, AVI, MOV, MKV, WEBM, WAV, OGG'}), 400
+        # Save file, hashing it while it streams to disk
+        start = time.perf_counter()
+        with metrics.stage('save'):
+            file_size, content_hash = uploads.save_stream(file.stream, file_path)
+        record_upload_bytes('form', file_size, time.perf_counter() - start)
+        
+        # Before the transaction: a read held open while ffprobe runs
+        # couldn't upgrade to a write once a background job committed
+        blob, metadata = inspect_upload(file_path, content_hash)
+        
+        # Save information to database
+        with db.transaction():
+            result = register_upload(original_filename, unique_filename, file_path, content_hash, blob, metadata)
+        
+        return jsonify(result), 201
+        
+    except Exception as e:
+        logs.error('upload_error', error=str(e))
+        return jsonify({'error': f'Error uploading file: {str(e)}'}), 500
+
+def upload_limits():
+    """Chunk size and parallelism resumable upload clients must keep to"""
+    return {
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'max_parallel_chunks': UPLOAD_PARALLEL_CHUNKS,
+        'max_parallel_files': UPLOAD_PARALLEL_FILES
+    }
+
+def upload_session_response(session):
+    """Session details returned to resumable upload clients"""
+    return {
+        'upload_id': session['id'],
+        'filename': session['original_filename'],
+        'size': session['size'],
+        'status': session['status'],
+        'video_id': session['video_id'],
+        'ranges': session['ranges'],
+        'received_bytes': session['received_bytes'],
+        **upload_limits(),
+        'url': f"/uploads/{session['id']}"
+    }
+
+@app.route('/uploads', methods=['GET'])
+def get_upload_limits():
+    """Upload limits, read by clients before they start sending files"""
+    response = jsonify(upload_limits())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/uploads', methods=['POST'])
+@admitted(upload_limiter)
+def create_upload():
+    """Start a resumable upload: JSON body {filename, size, sha256 (optional)}
+
+    When the client sends the SHA-256 of a file that is already stored, the
+    video is added right away and no bytes need to be uploaded.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        
+        try:
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'size must be an integer'}), 400
+        
+        if size < 0 or size > UPLOAD_MAX_SIZE:
+            return jsonify({'error': f'File size must be between 0 and {UPLOAD_MAX_SIZE} bytes'}), 400
+        
+        if not data.get('filename'):
+            return jsonify({'error': 'No file selected'}), 400
+        
+        original_filename, error = clean_upload_filename(data['filename'])
+        if error:
+            return jsonify({'error': error}), 400
         
-        # Create unique filename
         unique_filename = generate_unique_filename(original_filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         
-        # Save file
-        file.save(file_path)
+        content_hash = str(data.get('sha256') or '').lower() or None
+        if content_hash:
+            with db.transaction(immediate=True):
+                # The stored file may have been remuxed since, so its size can differ
+                blob = find_blob(content_hash)
+                if blob:
+                    return jsonify(register_upload(
+                        original_filename, unique_filename, None, content_hash, blob
+                    )), 201
+        
+        session = uploads.create_session(original_filename, unique_filename, size, app.config['UPLOAD_FOLDER'])
+        
+        response = jsonify(upload_session_response(session))
+        response.headers['Location'] = f"/uploads/{session['id']}"
+        return response, 201
+        
+    except Exception as e:
+        logs.error('upload_session_error', error=str(e))
+        return jsonify({'error': f'Error starting upload: {str(e)}'}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def get_upload(upload_id):
+    """Get received byte ranges of a resumable upload"""
+    try:
+        session = uploads.get_session(upload_id)
+        
+        if not session:
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        response = jsonify(upload_session_response(session))
+        response.headers['Upload-Offset'] = str(session['offset'])
+        response.headers['Upload-Length'] = str(session['size'])
+        response.headers['Cache-Control'] = 'no-store'
+        return response
         
-        # Generate thumbnail for video files
-        thumbnail_filename = None
-        if original_filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')):
-            thumb_name = f"{os.path.splitext(unique_filename)[0]}.jpg"
-            thumb_path = os.path.join(app.config['THUMBNAILS_FOLDER'], thumb_name)
+    except Exception as e:
+        logs.error('upload_status_error', error=str(e))
+        return jsonify({'error': f'Error fetching upload: {str(e)}'}), 500
+
+@app.route('/uploads/<upload_id>', methods=['PUT', 'PATCH'])
+@admitted(upload_limiter)
+def upload_chunk(upload_id):
+    """Write one chunk of a resumable upload at ?offset= (or Upload-Offset header)"""
+    try:
+        session = uploads.get_session(upload_id)
+        
+        if not session:
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        if session['status'] != 'uploading':
+            return jsonify({'error': 'Upload already finalized'}), 409
+        
+        try:
+            offset = int(request.args.get('offset', request.headers.get('Upload-Offset', '')))
+        except ValueError:
+            return jsonify({'error': 'offset must be an integer'}), 400
+        
+        length = request.content_length
+        if length is None:
+            return jsonify({'error': 'Content-Length required'}), 411
+        
+        if offset < 0 or offset + length > session['size']:
+            return jsonify({'error': 'Chunk outside of file'}), 416
+        
+        # Raw request body: streamed straight into the file, no temp-file spooling
+        start = time.perf_counter()
+        with metrics.stage('save'):
+            written = uploads.write_chunk(session, offset, request.stream, length, app.config['UPLOAD_FOLDER'])
+        record_upload_bytes('chunk', written, time.perf_counter() - start)
+        if written != length:
+            return jsonify({'error': f'Incomplete chunk: {written} of {length} bytes received'}), 400
+        
+        session = uploads.get_session(upload_id)
+        response = jsonify({
+            'upload_id': upload_id,
+            'ranges': session['ranges'],
+            'received_bytes': session['received_bytes']
+        })
+        response.headers['Upload-Offset'] = str(session['offset'])
+        return response
+        
+    except Exception as e:
+        logs.error('chunk_upload_error', error=str(e))
+        return jsonify({'error': f'Error uploading chunk: {str(e)}'}), 500
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+@admitted(upload_limiter)
+def finalize_upload(upload_id):
+    """Finish a resumable upload and add the file to the library"""
+    try:
+        session = uploads.get_session(upload_id)
+        
+        if not session:
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        # Finalizing twice returns the same video
+        if session['status'] == 'completed':
+            return jsonify({'message': 'File uploaded successfully', 'id': session['video_id']}), 200
+        
+        try:
+            file_path = uploads.complete(session, app.config['UPLOAD_FOLDER'])
+        except ValueError as e:
+            return jsonify({'error': str(e), 'ranges': session['ranges']}), 409
+        
+        # Chunks arrive out of order so the assembled file is hashed here. Hashing, probing
+        # and storing happen before the transaction, like in upload_file(): holding the
+        # write lock meanwhile would block chunk writes and job claims
+        with metrics.stage('hash'):
+            content_hash = uploads.hash_file(file_path)
+        blob, metadata = inspect_upload(file_path, content_hash)
+        
+        with db.transaction(immediate=True):
+            # A concurrent finalize of the same upload may have finished meanwhile
+            session = uploads.get_session(upload_id)
+            if not session:
+                return jsonify({'error': 'Upload not found'}), 404
+            if session['status'] == 'completed':
+                return jsonify({'message': 'File uploaded successfully', 'id': session['video_id']}), 200
             
-            if generate_video_thumbnail(file_path, thumb_path):
-                thumbnail_filename = thumb_name
-            else:
-                print(f"Could not generate thumbnail for {unique_filename}")
+            result = register_upload(
+                session['original_filename'], session['filename'], file_path, content_hash, blob, metadata
+            )
+            uploads.mark_completed(upload_id, result['id'])
         
-        # Save information to database
-        conn = sqlite3.connect('videos.db')
-        cursor = conn.cursor()
+        return jsonify(result), 201
         
-        # Extract video name (without extension)
-        video_name = original_filename.rsplit('.', 1)[0]
-        file_size = os.path.getsize(file_path)
+    except Exception as e:
+        logs.error('finalize_upload_error', error=str(e))
+        return jsonify({'error': f'Error finalizing upload: {str(e)}'}), 500
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Cancel a resumable upload"""
+    try:
+        session = uploads.get_session(upload_id)
         
-        cursor.execute('''
-        INSERT INTO videos (name, filename, original_filename, file_size, thumbnail)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (video_name, unique_filename, original_filename, file_size, thumbnail_filename))
+        if not session:
+            return jsonify({'error': 'Upload not found'}), 404
         
-        video_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        if session['status'] != 'uploading':
+            return jsonify({'error': 'Upload already finalized'}), 409
         
-        return jsonify({
-            'message': 'File uploaded successfully',
-            'id': video_id,
-            'filename': unique_filename,
-            'name': video_name,
-            'size': file_size,
-            'thumbnail': thumbnail_filename,
-            'url': f"/video/{unique_filename}"
-        }), 201
+        uploads.abort(session, app.config['UPLOAD_FOLDER'])
+        return jsonify({'message': 'Upload cancelled'}), 200
         
     except Exception as e:
-        print(f"Upload error: {str(e)}")
-        return jsonify({'error': f'Error uploading file: {str(e)}'}), 500
+        logs.error('abort_upload_error', error=str(e))
+        return jsonify({'error': f'Error cancelling upload: {str(e)}'}), 500
+
+def parse_list_args():
+    """Parse ?fields= and ?limit= shared by /videos and /search"""
+    fields = request.args.get('fields')
+    fields = [f.strip() for f in fields.split(',') if f.strip()] if fields else list(db.VIDEO_LIST_COLUMNS)
+    unknown = [f for f in fields if f not in db.VIDEO_LIST_COLUMNS]
+    if unknown:
+        return None, None, f"Unknown fields: {', '.join(unknown)}"
+    
+    try:
+        limit = min(max(int(request.args.get('limit', VIDEOS_PAGE_SIZE)), 1), VIDEOS_MAX_PAGE_SIZE)
+    except ValueError:
+        return None, None, 'limit must be an integer'
+    
+    return fields, limit, None
+
+def build_search_query(text):
+    """Turn user input into an FTS5 query where every word matches as a prefix"""
+    terms = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{term}"*' for term in terms)
 
 @app.route('/videos', methods=['GET'])
 def get_videos():
-    """Get list of videos"""
-    try:
-        conn = sqlite3.connect('videos.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT id, name, filename, original_filename, file_size, thumbnail,
-               strftime('%Y-%m-%d %H:%M:%S', created_at) as created_at
-        FROM videos 
-        ORDER BY created_at DESC
-        ''')
-        
-        videos = []
-        for row in cursor.fetchall():
-            video = dict(row)
-            video['url'] = f"/video/{video['filename']}"
-            if video['thumbnail']:
-                video['thumbnail_url'] = f"/thumb/{video['thumbnail']}"
-            videos.append(video)
-        
-        conn.close()
-        return jsonify(videos)
+    """Get list of videos
+
+    Without query parameters the whole library is returned as an array.
+    With ?limit= and/or ?after=<created_at,id> a page is returned together
+    with the cursor of the next page. ?fields= selects the returned fields.
+    """
+    try:
+        paginated = 'limit' in request.args or 'after' in request.args
+        
+        # Validate parameters
+        fields, limit, error = parse_list_args()
+        if error:
+            return jsonify({'error': error}), 400
+        
+        after = request.args.get('after')
+        if after:
+            try:
+                after_created_at, after_id = after.rsplit(',', 1)
+                after_id = int(after_id)
+            except ValueError:
+                return jsonify({'error': 'after must be <created_at>,<id>'}), 400
+        
+        # Unchanged library: answer 304 from the version counter without reading any rows
+        version, updated_at = db.query_one('library_state')
+        etag = f"lib-{version}"
+        last_modified = datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = Response(status=304)
+        else:
+            # One extra row tells whether there is a next page
+            rows = db.list_videos(
+                fields,
+                after=(after_created_at, after_id) if after else None,
+                limit=limit + 1 if paginated else None
+            )
+            
+            next_cursor = None
+            if paginated and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = f"{rows[-1]['_cursor_created_at']},{rows[-1]['_cursor_id']}"
+            
+            videos = [video_json(row, fields) for row in rows]
+            
+            if paginated:
+                response = jsonify({'videos': videos, 'next_cursor': next_cursor})
+            else:
+                response = jsonify(videos)
+        
+        # Let browsers cache the list but revalidate it on every load
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
-        print(f"Get videos error: {str(e)}")
+        logs.error('get_videos_error', error=str(e))
         return jsonify({'error': f'Error fetching videos: {str(e)}'}), 500
 
+@app.route('/search', methods=['GET'])
+def search_library():
+    """Search videos by name
+
+    ?q= is matched word by word as prefixes against name and original
+    filename, best matches first. Pages with ?limit= and ?offset=.
+    """
+    try:
+        fields, limit, error = parse_list_args()
+        if error:
+            return jsonify({'error': error}), 400
+        
+        try:
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({'error': 'offset must be an integer'}), 400
+        
+        match = build_search_query(request.args.get('q', ''))
+        if not match:
+            return jsonify({'videos': [], 'next_offset': None})
+        
+        # One extra row tells whether there is a next page
+        rows = db.search_videos(fields, match, limit + 1, offset)
+        
+        next_offset = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_offset = offset + limit
+        
+        return jsonify({
+            'videos': [video_json(row, fields) for row in rows],
+            'next_offset': next_offset
+        })
+        
+    except Exception as e:
+        logs.error('search_error', error=str(e))
+        return jsonify({'error': f'Error searching videos: {str(e)}'}), 500
+
 @app.route('/video/<int:video_id>', methods=['DELETE'])
 def delete_video(video_id):
     """Delete video"""
     try:
-        conn = sqlite3.connect('videos.db')
-        cursor = conn.cursor()
-        
         # Get video info before deletion
-        cursor.execute('SELECT filename, thumbnail FROM videos WHERE id = ?', (video_id,))
-        result = cursor.fetchone()
+        result = db.query_one('video_files_by_id', (video_id,))
         
         if not result:
-            conn.close()
             return jsonify({'error': 'Video not found'}), 404
         
-        filename, thumbnail = result
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        storage_name, thumbnail = result['storage_name'], result['thumbnail']
+        hls, previews = result['hls'], result['previews']
         
-        # Delete file from system
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # Delete record from database, and count the rows still sharing its files
+        with db.transaction(immediate=True):
+            db.execute('video_delete', (video_id,))
+            blob_refs = db.query_value('blob_ref_count', (storage_name,))
+            thumb_refs = db.query_value('thumbnail_ref_count', (thumbnail,)) if thumbnail else 0
         
-        # Delete thumbnail if exists
-        if thumbnail:
-            thumb_path = os.path.join(app.config['THUMBNAILS_FOLDER'], thumbnail)
-            if os.path.exists(thumb_path):
-                os.remove(thumb_path)
+        # Delete file from system once no copy refers to it
+        if blob_refs == 0:
+            video_store.delete(storage_name)
         
-        # Delete record from database
-        cursor.execute('DELETE FROM videos WHERE id = ?', (video_id,))
-        conn.commit()
-        conn.close()
+        # The HLS ladder belongs to the file
+        if blob_refs == 0 and hls:
+            shutil.rmtree(os.path.join(app.config['HLS_FOLDER'], hls), ignore_errors=True)
+        if blob_refs == 0 and previews:
+            remove_previews(previews)
+        if blob_refs == 0 and result['thumbnail_variants']:
+            remove_thumbnail_variants(result['thumbnail_variants'])
+        if blob_refs == 0 and result['waveform']:
+            thumbnail_store.delete(result['waveform'])
+        
+        # Delete thumbnail if exists
+        if thumbnail and thumb_refs == 0:
+            thumbnail_store.delete(thumbnail)
         
         return jsonify({'message': 'Video deleted successfully'}), 200
         
     except Exception as e:
-        print(f"Delete error: {str(e)}")
+        logs.error('delete_error', error=str(e))
         return jsonify({'error': f'Error deleting video: {str(e)}'}), 500
 
-@app.route('/health')
-def health_check():
-    """Health check endpoint"""
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Get status of a background job"""
     try:
-        db_exists = os.path.exists('videos.db')
-        upload_exists = os.path.exists(app.config['UPLOAD_FOLDER'])
-        thumbs_exists = os.path.exists(app.config['THUMBNAILS_FOLDER'])
+        job = jobs.get_job(job_id)
         
-        # Count videos in database
-        conn = sqlite3.connect('videos.db')
-        cursor = conn.cursor()
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
         
-        cursor.execute('SELECT COUNT(*) FROM videos')
-        video_count = cursor.fetchone()[0]
+        return jsonify(job)
         
-        cursor.execute('SELECT COUNT(*) FROM videos WHERE thumbnail IS NOT NULL')
-        thumb_count = cursor.fetchone()[0]
-        
-        conn.close()
+    except Exception as e:
+        logs.error('job_status_error', error=str(e))
+        return jsonify({'error': f'Error fetching job: {str(e)}'}), 500
+
+@app.route('/livez')
+def liveness_check():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+_readiness = {'error': None, 'checked_at': None}
+
+def readiness_error():
+    """Why the process isn't ready, None when it is"""
+    try:
+        db.query_value('ping')
+    except Exception as e:
+        return f'Database error: {str(e)}'
+    
+    for store in (video_store, thumbnail_store):
+        if not store.ready():
+            return f'{store.label} is not available'
+    return None
+
+@app.route('/readyz')
+def readiness_check():
+    """Readiness probe: the database answers and the media stores are reachable
+    
+    The result is reused for READINESS_TTL seconds, so frequent probes of
+    several workers don't each query the stores.
+    """
+    now = time.monotonic()
+    if _readiness['checked_at'] is None or now - _readiness['checked_at'] > READINESS_TTL:
+        _readiness.update(error=readiness_error(), checked_at=now)
+    
+    if _readiness['error']:
+        return jsonify({'status': 'unavailable', 'error': _readiness['error']}), 503
+    return jsonify({'status': 'ok'})
+
+_file_counts = {'upload': 0, 'thumbnails': 0, 'counted_at': None}
+_file_counts_lock = threading.Lock()
+_file_counts_refreshing = False
+
+def count_files(store):
+    if not store.ready():
+        return 0
+    return sum(1 for item in store.list() if not item['name'].startswith('.'))
+
+def refresh_file_counts():
+    global _file_counts_refreshing
+    try:
+        counts = {
+            'upload': count_files(video_store),
+            'thumbnails': count_files(thumbnail_store),
+            'counted_at': time.time()
+        }
+        with _file_counts_lock:
+            _file_counts.update(counts)
+    finally:
+        _file_counts_refreshing = False
+
+def cached_file_counts():
+    """Folder file counts, recounted in the background once older than HEALTH_FILE_COUNT_TTL
+    
+    Listing a remote store can take long, so even the first count of a
+    process runs in the background; until it is done the counts are 0 and
+    counted_at is None.
+    """
+    global _file_counts_refreshing
+    counted_at = _file_counts['counted_at']
+    if counted_at is None or time.time() - counted_at > HEALTH_FILE_COUNT_TTL:
+        with _file_counts_lock:
+            start = not _file_counts_refreshing
+            _file_counts_refreshing = True
+        if start:
+            threading.Thread(target=refresh_file_counts, daemon=True).start()
+    
+    with _file_counts_lock:
+        return dict(_file_counts)
+
+@app.route('/health')
+def health_check():
+    """Health check endpoint
+    
+    Video counts come from trigger-maintained counters and file counts from a
+    cache, so this stays cheap on large libraries.
+    """
+    try:
+        db_exists = os.path.exists(db.DB_PATH)
+        upload_exists = video_store.ready()
+        thumbs_exists = thumbnail_store.ready()
         
-        # Count files
-        upload_count = len(os.listdir(app.config['UPLOAD_FOLDER'])) if upload_exists else 0
-        thumb_count_files = len(os.listdir(app.config['THUMBNAILS_FOLDER'])) if thumbs_exists else 0
+        video_count, thumb_count = db.query_one('library_counters')
+        file_counts = cached_file_counts()
         
         return jsonify({
             'status': 'ok',
@@ -335,102 +1264,105 @@ def health_check():
             'thumbnails_folder': thumbs_exists,
             'video_count': video_count,
             'thumbnail_count': thumb_count,
-            'upload_files': upload_count,
-            'thumb_files': thumb_count_files
+            'upload_files': file_counts['upload'],
+            'thumb_files': file_counts['thumbnails'],
+            'files_counted_at': file_counts['counted_at']
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics of this process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admission')
+def admission_status():
+    """Occupancy of the admission limiters and the job queue, for tuning the limits
+    
+    Slots in use, tokens and the job queue are host-wide; waiting work and
+    rejections are those of the worker process that answers.
+    """
+    return jsonify({
+        'pid': os.getpid(),
+        'limiters': admission.occupancy(),
+        'jobs': jobs.queue_depth()
+    })
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup_orphaned_files():
-    """Clean up orphaned files"""
+    """Clean up orphaned files
+    
+    Orphans are moved to the quarantine folder; ?dry_run=1 only reports them.
+    """
     try:
-        conn = sqlite3.connect('videos.db')
-        cursor = conn.cursor()
-        
-        # Get all registered files
-        cursor.execute('SELECT id, filename, thumbnail FROM videos')
-        database_files = cursor.fetchall()
+        dry_run = request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+        report = reconcile_library(dry_run=dry_run)
         
-        orphaned_count = 0
+        orphan_count = sum(len(names) for names in report['orphans'].values())
+        for row in report['missing_rows']:
+            logs.info('missing_video_record', storage_name=row['storage_name'], dry_run=dry_run)
         
-        for video_id, filename, thumbnail in database_files:
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            
-            # If file doesn't exist on system
-            if not os.path.exists(file_path):
-                cursor.execute('DELETE FROM videos WHERE id = ?', (video_id,))
-                orphaned_count += 1
-                print(f"Deleted missing video record: {filename}")
-                
-                # Also delete thumbnail if exists
-                if thumbnail:
-                    thumb_path = os.path.join(app.config['THUMBNAILS_FOLDER'], thumbnail)
-                    if os.path.exists(thumb_path):
-                        os.remove(thumb_path)
-        
-        conn.commit()
-        
-        # Check for files without records
-        for folder_name, folder_path in [('upload', UPLOAD_FOLDER), ('thumbnails', THUMBNAILS_FOLDER)]:
-            if os.path.exists(folder_path):
-                files = os.listdir(folder_path)
-                if folder_name == 'upload':
-                    database_filenames = [f for _, f, _ in database_files]
-                else:
-                    database_filenames = [t for _, _, t in database_files if t]
-                
-                for file in files:
-                    if file not in database_filenames:
-                        file_path = os.path.join(folder_path, file)
-                        os.remove(file_path)
-                        orphaned_count += 1
-                        print(f"Deleted orphaned {folder_name} file: {file}")
-        
-        conn.close()
+        if dry_run:
+            message = f"Dry run: would delete {len(report['missing_rows'])} records and quarantine {orphan_count} files"
+        else:
+            message = f"Cleanup completed successfully, deleted {len(report['missing_rows'])} records and quarantined {orphan_count} files"
         
-        return jsonify({
-            'message': f'Cleanup completed successfully, deleted {orphaned_count} files'
-        }), 200
+        return jsonify({'message': message, 'report': report}), 200
         
     except Exception as e:
-        print(f"Cleanup error: {str(e)}")
+        logs.error('cleanup_error', error=str(e))
         return jsonify({'error': f'Error during cleanup: {str(e)}'}), 500
 
 @app.route('/generate-thumbnails', methods=['POST'])
+@admitted(generate_limiter)
 def generate_missing_thumbnails():
     """Generate thumbnails for videos that don't have them"""
     try:
-        conn = sqlite3.connect('videos.db')
-        cursor = conn.cursor()
+        # Bulk mode runs in the background across all cores; poll or stream its progress.
+        # The run holds on to the request's slot until it ends
+        if request.args.get('mode') == 'bulk':
+            release = keep_admission_slot()
+            run_id = thumbnail_backfill.start_run(UPLOAD_FOLDER, THUMBNAILS_FOLDER, on_done=release)
+            return jsonify({
+                'message': 'Bulk thumbnail generation started',
+                'run_id': run_id,
+                'status_url': f"/generate-thumbnails/{run_id}",
+                'events_url': f"/generate-thumbnails/{run_id}/events"
+            }), 202
         
         # Get videos without thumbnails
-        cursor.execute('SELECT id, filename FROM videos WHERE thumbnail IS NULL')
-        videos_without_thumbs = cursor.fetchall()
+        videos_without_thumbs = db.query_all('videos_missing_thumbnail')
         
         generated_count = 0
         failed_count = 0
+        done = set()
         
-        for video_id, filename in videos_without_thumbs:
-            video_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        for row in videos_without_thumbs:
+            filename = row['storage_name']
+            # Copies of the same file were covered by the first one
+            if filename in done:
+                continue
+            done.add(filename)
             
-            if os.path.exists(video_path) and filename.lower().endswith(('.mp4', '.avi', '.mov', '.mkv', '.webm')):
+            # Probed without a video stream: nothing to take a frame from
+            if row['has_video'] == 0:
+                failed_count += 1
+            elif filename.lower().endswith(VIDEO_EXTENSIONS) and video_store.exists(filename):
                 thumb_name = f"{os.path.splitext(filename)[0]}.jpg"
-                thumb_path = os.path.join(app.config['THUMBNAILS_FOLDER'], thumb_name)
+                thumb_path = layout.path(app.config['THUMBNAILS_FOLDER'], thumb_name)
                 
-                if generate_video_thumbnail(video_path, thumb_path):
-                    cursor.execute('UPDATE videos SET thumbnail = ? WHERE id = ?', (thumb_name, video_id))
+                if generate_video_thumbnail(video_store.source(filename), thumb_path, thumbnail_time(row['duration'])):
+                    store_thumbnails([thumb_name])
+                    db.execute('video_set_thumbnail', (thumb_name, filename))
                     generated_count += 1
-                    print(f"Generated thumbnail for {filename}")
+                    logs.info('thumbnail_generated', filename=filename)
                 else:
                     failed_count += 1
-                    print(f"Failed to generate thumbnail for {filename}")
+                    logs.warning('thumbnail_failed', filename=filename)
             else:
                 failed_count += 1
         
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'message': f'Thumbnail generation completed: {generated_count} generated, {failed_count} failed',
             'generated': generated_count,
@@ -438,59 +1370,191 @@ def generate_missing_thumbnails():
         }), 200
         
     except Exception as e:
-        print(f"Thumbnail generation error: {str(e)}")
+        logs.error('thumbnail_generation_error', error=str(e))
         return jsonify({'error': f'Error generating thumbnails: {str(e)}'}), 500
 
+def queue_missing(kind, statement, extensions=VIDEO_EXTENSIONS):
+    """Queue a background job for every stored file returned by statement"""
+    queued = []
+    with db.transaction(immediate=True):
+        for video_id, storage_name in db.query_all(statement):
+            if storage_name.lower().endswith(extensions):
+                queued.append(jobs.enqueue(kind, video_id))
+    return queued
+
+@app.route('/generate-hls', methods=['POST'])
+def generate_missing_hls():
+    """Queue HLS packaging for videos that don't have a ladder yet"""
+    try:
+        queued = queue_missing('hls', 'videos_missing_hls')
+        
+        return jsonify({
+            'message': f'Queued HLS packaging for {len(queued)} videos',
+            'job_ids': queued
+        }), 202
+        
+    except Exception as e:
+        logs.error('hls_queue_error', error=str(e))
+        return jsonify({'error': f'Error queueing HLS packaging: {str(e)}'}), 500
+
+@app.route('/generate-thumbnail-variants', methods=['POST'])
+def generate_missing_thumbnail_variants():
+    """Queue WebP/AVIF thumbnail generation for videos that don't have them yet"""
+    try:
+        queued = queue_missing('thumbnail', 'videos_missing_thumbnail_variants')
+        
+        return jsonify({
+            'message': f'Queued thumbnail variants for {len(queued)} videos',
+            'job_ids': queued
+        }), 202
+        
+    except Exception as e:
+        logs.error('thumbnail_variant_queue_error', error=str(e))
+        return jsonify({'error': f'Error queueing thumbnail variants: {str(e)}'}), 500
+
+@app.route('/generate-previews', methods=['POST'])
+def generate_missing_previews():
+    """Queue scrubbing preview generation for videos that don't have previews yet"""
+    try:
+        queued = queue_missing('previews', 'videos_missing_previews')
+        
+        return jsonify({
+            'message': f'Queued preview generation for {len(queued)} videos',
+            'job_ids': queued
+        }), 202
+        
+    except Exception as e:
+        logs.error('preview_queue_error', error=str(e))
+        return jsonify({'error': f'Error queueing preview generation: {str(e)}'}), 500
+
+@app.route('/generate-waveforms', methods=['POST'])
+def generate_missing_waveforms():
+    """Queue waveform peaks for audio tracks that don't have them yet"""
+    try:
+        queued = queue_missing('waveform', 'videos_missing_waveform', AUDIO_EXTENSIONS)
+        
+        return jsonify({
+            'message': f'Queued waveform generation for {len(queued)} tracks',
+            'job_ids': queued
+        }), 202
+        
+    except Exception as e:
+        logs.error('waveform_queue_error', error=str(e))
+        return jsonify({'error': f'Error queueing waveform generation: {str(e)}'}), 500
+
+@app.route('/generate-metadata', methods=['POST'])
+def generate_missing_metadata():
+    """Queue ffprobe runs for files stored before their stream details were read at upload"""
+    try:
+        if not ffprobe_available():
+            return jsonify({'error': 'ffprobe is not available'}), 503
+        
+        queued = queue_missing('probe', 'videos_missing_metadata', MEDIA_EXTENSIONS)
+        
+        return jsonify({
+            'message': f'Queued metadata probing for {len(queued)} files',
+            'job_ids': queued
+        }), 202
+        
+    except Exception as e:
+        logs.error('metadata_queue_error', error=str(e))
+        return jsonify({'error': f'Error queueing metadata probing: {str(e)}'}), 500
+
+@app.route('/generate-thumbnails/<int:run_id>', methods=['GET'])
+def get_thumbnail_run(run_id):
+    """Get progress of a bulk thumbnail run"""
+    try:
+        run = thumbnail_backfill.get_run(run_id)
+        
+        if not run:
+            return jsonify({'error': 'Run not found'}), 404
+        
+        return jsonify(run)
+        
+    except Exception as e:
+        logs.error('thumbnail_run_error', error=str(e))
+        return jsonify({'error': f'Error fetching run: {str(e)}'}), 500
+
+@app.route('/generate-thumbnails/<int:run_id>/events', methods=['GET'])
+def stream_thumbnail_run(run_id):
+    """Stream progress of a bulk thumbnail run as server-sent events"""
+    if not thumbnail_backfill.get_run(run_id):
+        return jsonify({'error': 'Run not found'}), 404
+    
+    def events():
+        last_sent = None
+        while True:
+            run = thumbnail_backfill.get_run(run_id)
+            if run != last_sent:
+                yield f"data: {json.dumps(run)}\n\n"
+                last_sent = run
+            if run['status'] != 'running':
+                break
+            time.sleep(1)
+    
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 # Static file routes
+def send_asset(folder, filename):
+    """Send a fingerprinted asset from the build, cached forever, or else its source"""
+    built = f"{folder}/{filename}"
+    if asset_manifest and os.path.isfile(os.path.join(app.root_path, ASSETS_BUILD_FOLDER, built)):
+        response = send_precompressed(ASSETS_BUILD_FOLDER, built, max_age=31536000)
+        response.cache_control.immutable = True
+        return response
+    return send_media(folder, filename)
+
 @app.route('/css/<path:filename>')
 def serve_css(filename):
     try:
-        return send_from_directory('css', filename)
+        return send_asset('css', filename)
     except:
         return "CSS file not found", 404
 
 @app.route('/js/<path:filename>')
 def serve_js(filename):
     try:
-        return send_from_directory('js', filename)
+        return send_asset('js', filename)
     except:
         return "JS file not found", 404
 
 @app.route('/icon/<path:filename>')
 def serve_icon(filename):
     try:
-        return send_from_directory('icon', filename)
+        return send_asset('icon', filename)
     except:
         return "Icon file not found", 404
 
 if __name__ == '__main__':
     # Initialize database on startup
-    init_database()
-    
     print("=" * 60)
     print("Video Streaming Server - Professional Version")
     print("=" * 60)
     print(f"Upload folder: {os.path.abspath(UPLOAD_FOLDER)}")
     print(f"Thumbnails folder: {os.path.abspath(THUMBNAILS_FOLDER)}")
-    print(f"Database: {os.path.abspath('videos.db')}")
+    print(f"Database: {db.DB_PATH}")
     print(f"Server URL: http://localhost:5000")
     print("=" * 60)
     print("Professional features:")
-    print("   • Automatic thumbnail generation")
+    print("   • Automatic thumbnail generation (background queue)")
     print("   • Lightweight frontend")
     print("   • Fast page loading")
     print("   • YouTube-like design")
     print("=" * 60)
     
     # Check for ffmpeg
-    try:
-        subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
+    if ffmpeg_available():
         print("FFmpeg is available for thumbnail generation")
-    except (subprocess.CalledProcessError, FileNotFoundError):
+    else:
         print("FFmpeg not found. Thumbnail generation will be disabled.")
         print("To enable thumbnails, install FFmpeg from: https://ffmpeg.org/download.html")
+    if not ffprobe_available():
+        print("FFprobe not found. Durations and stream details won't be read.")
     
     print("=" * 60)
     
+    # Process queued jobs left over from a previous run
+    jobs.start_workers(THUMBNAIL_WORKERS)
+    
     # Run the app
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
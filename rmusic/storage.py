@@ -0,0 +1,260 @@
+"""
+Storage backends for uploaded files and thumbnails
+LocalStorage keeps a store in a local folder in the sharded layout. S3Storage
+keeps it in an S3-compatible bucket (AWS, MinIO, a moto server, ...) under the
+same keys, e.g. upload/3f/a2/clip_1a2b3c4d.mp4, so a local library moves to a
+bucket with a plain sync of the folders.
+Select the backend with RMUSIC_STORAGE=local|s3. The S3 backend needs boto3
+and reads RMUSIC_S3_BUCKET, RMUSIC_S3_ENDPOINT (MinIO or moto) and
+RMUSIC_S3_REGION; credentials come from the usual AWS settings.
+This module must stay importable without Flask so it can run in a process pool
+"""
+
+import mimetypes
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import layout
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    # Only needed with RMUSIC_STORAGE=s3
+    boto3 = None
+
+STORAGE_BACKEND = os.environ.get('RMUSIC_STORAGE', 'local')
+STORAGE_BACKENDS = ('local', 's3')
+S3_BUCKET = os.environ.get('RMUSIC_S3_BUCKET')
+S3_ENDPOINT = os.environ.get('RMUSIC_S3_ENDPOINT')  # e.g. http://localhost:9000 for MinIO
+S3_REGION = os.environ.get('RMUSIC_S3_REGION')
+S3_PART_SIZE = 16 * 1024 * 1024  # multipart chunk size for uploads and downloads
+S3_TRANSFER_THREADS = 8  # parts transferred at once
+S3_URL_EXPIRES = 60 * 60  # seconds a presigned URL stays valid
+READ_SIZE = 256 * 1024  # bytes per block when reading a stored file
+
+
+class LocalStorage:
+    """Files in a local folder, in the sharded layout"""
+    local = True
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.label = folder
+
+    def exists(self, name):
+        return os.path.isfile(layout.locate(self.folder, name))
+
+    def stat(self, name):
+        """Size, mtime and ETag of a stored file, or None when it's missing"""
+        try:
+            st = os.stat(layout.locate(self.folder, name))
+        except FileNotFoundError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'etag': f"{st.st_mtime_ns:x}-{st.st_size:x}"}
+
+    def save(self, name, path):
+        """Move a local file into the store"""
+        target = layout.path(self.folder, name)
+        if os.path.abspath(path) != os.path.abspath(target):
+            os.replace(path, target)
+
+    def read(self, name, start=0, length=None):
+        """Yield the bytes of a stored file, or of a range of it"""
+        with open(layout.locate(self.folder, name), 'rb') as f:
+            f.seek(start)
+            while length is None or length > 0:
+                block = f.read(READ_SIZE if length is None else min(READ_SIZE, length))
+                if not block:
+                    break
+                if length is not None:
+                    length -= len(block)
+                yield block
+
+    def delete(self, name):
+        path = layout.locate(self.folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def list(self, prefix=None):
+        """Yield {name, size, mtime} of the stored files
+
+        A prefix has to include the stem of the stored file, which picks the
+        shard to list.
+        """
+        if prefix is None:
+            entries = layout.scan(self.folder)
+        else:
+            shard_dirs = {os.path.join(self.folder, *shard.split('/'))
+                          for shard in (layout.shard(prefix), layout.legacy_shard(prefix))}
+            entries = []
+            for folder in (self.folder, *sorted(shard_dirs)):
+                if os.path.isdir(folder):
+                    with os.scandir(folder) as found:
+                        entries += [entry for entry in found if entry.name.startswith(prefix)]
+
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                yield {'name': entry.name, 'size': st.st_size, 'mtime': st.st_mtime}
+
+    def source(self, name):
+        """Path ffmpeg reads the stored file from"""
+        return layout.locate(self.folder, name)
+
+    @contextmanager
+    def fetch(self, name):
+        """Local path of a stored file, for tools that rewrite it in place"""
+        yield layout.locate(self.folder, name)
+
+    def url(self, name, expires=S3_URL_EXPIRES):
+        """Direct download URL; local files are served by the app"""
+        return None
+
+    def quarantine(self, names, target):
+        """Move stored files into the target directory"""
+        os.makedirs(target, exist_ok=True)
+        for name in sorted(names):
+            shutil.move(layout.locate(self.folder, name), os.path.join(target, name))
+
+    def fingerprint(self):
+        """Value that changes whenever a file is added or removed (see layout.mtime_ns)"""
+        return layout.mtime_ns(self.folder)
+
+    def ready(self):
+        return os.path.isdir(self.folder)
+
+
+class S3Storage:
+    """Objects in an S3-compatible bucket, keyed like the local sharded layout"""
+    local = False
+
+    def __init__(self, bucket, prefix, endpoint_url=None, region=None):
+        if boto3 is None:
+            raise RuntimeError("RMUSIC_STORAGE=s3 needs boto3: pip install boto3")
+        if not bucket:
+            raise ValueError("RMUSIC_S3_BUCKET must be set when RMUSIC_STORAGE=s3")
+
+        self.bucket = bucket
+        self.folder = prefix.strip('/')
+        self.prefix = self.folder + '/'
+        self.label = f"s3://{bucket}/{self.prefix}"
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region)
+        # Parts of large files are sent and fetched in parallel
+        self.transfer = TransferConfig(
+            multipart_threshold=S3_PART_SIZE,
+            multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_TRANSFER_THREADS,
+            use_threads=True
+        )
+
+    def key(self, name):
+        return f"{self.prefix}{layout.shard(name)}/{name}"
+
+    def exists(self, name):
+        return self.stat(name) is not None
+
+    def stat(self, name):
+        """Size, mtime and ETag of a stored object, or None when it's missing"""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return {'size': head['ContentLength'], 'mtime': head['LastModified'].timestamp(),
+                'etag': head['ETag'].strip('"')}
+
+    def save(self, name, path):
+        """Upload a local file (multipart, in parallel) and remove the local copy"""
+        self.client.upload_file(
+            path, self.bucket, self.key(name), Config=self.transfer,
+            ExtraArgs={'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+        )
+        os.remove(path)
+
+    def read(self, name, start=0, length=None):
+        """Yield the bytes of a stored object, or of a range of it"""
+        options = {}
+        if start or length is not None:
+            end = '' if length is None else start + length - 1
+            options['Range'] = f"bytes={start}-{end}"
+        body = self.client.get_object(Bucket=self.bucket, Key=self.key(name), **options)['Body']
+        try:
+            yield from body.iter_chunks(READ_SIZE)
+        finally:
+            body.close()
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def list(self, prefix=None):
+        """Yield {name, size, mtime} of the stored objects
+
+        A prefix has to include the stem of the stored file, which picks the
+        shard to list.
+        """
+        key_prefix = self.prefix if prefix is None else self.key(prefix)
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=key_prefix):
+            for item in page.get('Contents', []):
+                yield {'name': item['Key'].rsplit('/', 1)[-1], 'size': item['Size'],
+                       'mtime': item['LastModified'].timestamp()}
+
+    def source(self, name):
+        """Presigned URL ffmpeg reads the object from, seeking with range requests
+
+        The URL expires after S3_URL_EXPIRES; work that can take longer uses fetch().
+        """
+        return self.url(name)
+
+    @contextmanager
+    def fetch(self, name):
+        """Download an object to a temporary file, for tools that need it on disk"""
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self.key(name), path, Config=self.transfer)
+            yield path
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def url(self, name, expires=S3_URL_EXPIRES):
+        """Presigned GET URL, for redirecting players straight to the bucket"""
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=expires
+        )
+
+    def quarantine(self, names, target):
+        """Move stored objects below the target key prefix
+
+        Purge old quarantine batches with a lifecycle rule on the bucket.
+        """
+        target = target.replace(os.sep, '/').strip('/')
+        for name in sorted(names):
+            source = {'Bucket': self.bucket, 'Key': self.key(name)}
+            self.client.copy(source, self.bucket, f"{target}/{name}", Config=self.transfer)
+            self.client.delete_object(**source)
+
+    def fingerprint(self):
+        """Buckets have no cheap change marker, every reconcile pass lists them"""
+        return None
+
+    def ready(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+            return True
+        except Exception:
+            return False
+
+
+def open_store(folder):
+    """The configured backend for one of the media folders"""
+    if STORAGE_BACKEND not in STORAGE_BACKENDS:
+        raise ValueError(f"RMUSIC_STORAGE must be one of {', '.join(STORAGE_BACKENDS)}")
+    if STORAGE_BACKEND == 's3':
+        return S3Storage(S3_BUCKET, os.path.basename(os.path.normpath(folder)), S3_ENDPOINT, S3_REGION)
+    return LocalStorage(folder)
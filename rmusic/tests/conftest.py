@@ -0,0 +1,43 @@
+"""
+Shared fixtures: every test gets its own database and a client of the app
+The server keeps its folders relative to the working directory and opens
+its database on import, so both point into a scratch directory before any
+test module imports it
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+WORK_DIR = tempfile.mkdtemp(prefix='rmusic-tests-')
+os.environ.setdefault('RMUSIC_DB_PATH', os.path.join(WORK_DIR, 'videos.db'))
+os.environ.setdefault('RMUSIC_ADMISSION_DIR', os.path.join(WORK_DIR, 'admission'))
+os.chdir(WORK_DIR)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh database with the current schema"""
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'videos.db'))
+    db.init_schema()
+    yield
+    db.close_connection()
+
+
+@pytest.fixture
+def client(database, monkeypatch):
+    """Test client of the app, without background workers picking up the jobs it queues"""
+    import jobs
+    import server
+    import thumbnail_backfill
+
+    monkeypatch.setattr(jobs, 'start_workers', lambda count=None: None)
+    monkeypatch.setattr(thumbnail_backfill, 'resume_interrupted_runs', lambda *args: None)
+    monkeypatch.setattr(server, 'schedule_reconcile', lambda: None)
+    return server.app.test_client()
@@ -0,0 +1,45 @@
+import sqlite3
+
+import db
+
+
+def test_schema_is_brought_up_to_date_on_an_old_database(tmp_path, monkeypatch):
+    """A database from before the migrations keeps its rows and gets every new table and column"""
+    path = tmp_path / 'videos.db'
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            filename TEXT UNIQUE NOT NULL,
+            original_filename TEXT NOT NULL,
+            file_size INTEGER,
+            thumbnail TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute(
+        "INSERT INTO videos (name, filename, original_filename, file_size) VALUES ('old', 'old.mp4', 'Old.mp4', 42)"
+    )
+    conn.commit()
+    conn.close()
+
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(path))
+    try:
+        db.init_schema()
+
+        for table, column, column_type in db.REQUIRED_COLUMNS:
+            assert column in db.table_columns(table), (table, column)
+        assert db.query_all('job_counts_by_status') == []
+
+        # The existing row is counted and found by search
+        video_count, thumbnail_count = db.query_one('library_counters')
+        assert (video_count, thumbnail_count) == (1, 0)
+        assert [row['id'] for row in db.search_videos(['id'], 'old*', 10)] == [1]
+
+        # Running it again changes nothing
+        db.init_schema()
+        assert db.query_value('video_count') == 1
+    finally:
+        db.close_connection()
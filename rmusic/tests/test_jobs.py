@@ -0,0 +1,97 @@
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def handler(database, monkeypatch):
+    """Registers the handler of 'test' jobs, which raises what the test puts into errors"""
+    monkeypatch.setattr(jobs, '_handlers', {})
+    monkeypatch.setattr(jobs, 'RETRY_BASE_DELAY', 0)
+    errors = []
+    calls = []
+
+    def run(job):
+        calls.append(job['id'])
+        if errors:
+            raise errors.pop(0)
+
+    jobs.register_handler('test', run)
+    return errors, calls
+
+
+def run_next():
+    job = jobs._claim_next_job()
+    assert job is not None
+    jobs._run_job(job)
+    return jobs.get_job(job['id'])
+
+
+def test_claimed_job_is_leased(handler):
+    job_id = jobs.enqueue('test')
+
+    job = jobs._claim_next_job()
+    assert job['id'] == job_id
+    assert job['attempts'] == 1
+    assert jobs.get_job(job_id)['status'] == 'running'
+
+    # Another worker doesn't get it while the lease holds
+    assert jobs._claim_next_job() is None
+
+
+def test_expired_lease_is_claimed_again(handler, monkeypatch):
+    monkeypatch.setattr(jobs, 'LEASE_SECONDS', -1)
+    job_id = jobs.enqueue('test')
+
+    jobs._claim_next_job()
+    job = jobs._claim_next_job()
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+
+
+def test_failed_job_is_retried_until_it_succeeds(handler):
+    errors, calls = handler
+    errors.append(RuntimeError('ffmpeg crashed'))
+    job_id = jobs.enqueue('test')
+
+    job = run_next()
+    assert job['status'] == 'pending'
+    assert job['last_error'] == 'ffmpeg crashed'
+
+    job = run_next()
+    assert job['status'] == 'done'
+    assert job['last_error'] is None
+    assert calls == [job_id, job_id]
+
+
+def test_job_fails_after_max_attempts(handler):
+    errors, calls = handler
+    errors.extend(RuntimeError(f'attempt {n}') for n in range(2))
+    jobs.enqueue('test', max_attempts=2)
+
+    run_next()
+    job = run_next()
+    assert job['status'] == 'failed'
+    assert job['attempts'] == 2
+    assert job['last_error'] == 'attempt 1'
+    assert jobs._claim_next_job() is None
+
+
+def test_permanent_error_is_not_retried(handler):
+    errors, calls = handler
+    errors.append(jobs.PermanentError('not a video'))
+    jobs.enqueue('test')
+
+    job = run_next()
+    assert job['status'] == 'failed'
+    assert job['attempts'] == 1
+    assert job['last_error'] == 'not a video'
+    assert jobs._claim_next_job() is None
+
+
+def test_job_without_handler_fails(handler):
+    jobs.enqueue('unknown', max_attempts=1)
+
+    job = run_next()
+    assert job['status'] == 'failed'
+    assert 'unknown' in job['last_error']
@@ -0,0 +1,86 @@
+import hashlib
+import os
+
+import db
+import server
+
+
+def start_upload(client, content, filename='clip.mp4', sha256=None):
+    data = {'filename': filename, 'size': len(content)}
+    if sha256:
+        data['sha256'] = sha256
+    response = client.post('/uploads', json=data)
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def send_chunk(client, upload_id, content, offset, length):
+    response = client.put(f'/uploads/{upload_id}?offset={offset}', data=content[offset:offset + length])
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_chunks_out_of_order_are_assembled_on_finalize(client):
+    content = os.urandom(3000)
+    session = start_upload(client, content)
+
+    send_chunk(client, session['upload_id'], content, 2000, 1000)
+    progress = send_chunk(client, session['upload_id'], content, 0, 1000)
+    assert progress['ranges'] == [[0, 1000], [2000, 1000]]
+
+    # A gap is left, the upload can't be finalized yet
+    response = client.post(f"/uploads/{session['upload_id']}/finalize")
+    assert response.status_code == 409
+
+    send_chunk(client, session['upload_id'], content, 1000, 1000)
+    response = client.post(f"/uploads/{session['upload_id']}/finalize")
+    assert response.status_code == 201
+    result = response.get_json()
+    assert not result['deduplicated']
+    assert result['size'] == len(content)
+
+    row = db.query_one('video_files_by_id', (result['id'],))
+    with open(server.video_store.source(row['storage_name']), 'rb') as f:
+        assert f.read() == content
+
+    # Finalizing again returns the same video
+    response = client.post(f"/uploads/{session['upload_id']}/finalize")
+    assert response.status_code == 200
+    assert response.get_json()['id'] == result['id']
+
+
+def test_known_hash_is_deduplicated_without_upload(client):
+    content = os.urandom(2000)
+    first = start_upload(client, content)
+    send_chunk(client, first['upload_id'], content, 0, len(content))
+    original = client.post(f"/uploads/{first['upload_id']}/finalize").get_json()
+
+    duplicate = start_upload(client, content, 'copy.mp4', hashlib.sha256(content).hexdigest())
+    assert duplicate['deduplicated']
+    assert 'upload_id' not in duplicate
+
+    original_row = db.query_one('video_files_by_id', (original['id'],))
+    duplicate_row = db.query_one('video_files_by_id', (duplicate['id'],))
+    assert duplicate_row['storage_name'] == original_row['storage_name']
+    assert db.query_value('blob_ref_count', (original_row['storage_name'],)) == 2
+
+
+def test_duplicate_content_is_deduplicated_on_finalize(client):
+    content = os.urandom(2000)
+    results = []
+    for filename in ('a.mp4', 'b.mp4'):
+        session = start_upload(client, content, filename)
+        send_chunk(client, session['upload_id'], content, 0, len(content))
+        results.append(client.post(f"/uploads/{session['upload_id']}/finalize").get_json())
+
+    original, duplicate = results
+    assert duplicate['deduplicated']
+    storage_name = db.query_one('video_files_by_id', (original['id'],))['storage_name']
+    assert db.query_one('video_files_by_id', (duplicate['id'],))['storage_name'] == storage_name
+
+    # Only the original's file is kept
+    assert server.video_store.exists(storage_name)
+    assert not server.video_store.exists(duplicate['filename'])
+
+    # The duplicate reuses the thumbnail job queued for the original
+    assert duplicate['job_id'] == original['job_id']
@@ -0,0 +1,72 @@
+import io
+import os
+
+import db
+import server
+
+
+def add_video(name):
+    with db.transaction():
+        return db.execute('video_insert', (
+            name, f'{name}.mp4', f'{name}.mp4', 100, None, None, None, f'{name}.mp4', None, None, None
+        )).lastrowid
+
+
+def upload(client, content, filename):
+    response = client.post('/upload', data={'file': (io.BytesIO(content), filename)})
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def test_videos_pages_follow_the_cursor(client):
+    ids = [add_video(f'video{n}') for n in range(5)]
+
+    seen = []
+    cursor = None
+    while True:
+        url = '/videos?limit=2' + (f'&after={cursor}' if cursor else '')
+        page = client.get(url).get_json()
+        seen += [video['id'] for video in page['videos']]
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+
+    # Newest first; rows created in the same second are ordered by id
+    assert seen == sorted(ids, reverse=True)
+
+
+def test_bad_cursor_is_rejected(client):
+    assert client.get('/videos?after=nonsense').status_code == 400
+
+
+def test_unchanged_library_answers_304(client):
+    add_video('first')
+    response = client.get('/videos')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = client.get('/videos', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    add_video('second')
+    response = client.get('/videos', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(response.get_json()) == 2
+
+
+def test_shared_file_is_deleted_with_its_last_copy(client):
+    content = os.urandom(2000)
+    original = upload(client, content, 'song.mp4')
+    duplicate = upload(client, content, 'again.mp4')
+    assert duplicate['deduplicated']
+    storage_name = db.query_one('video_files_by_id', (original['id'],))['storage_name']
+
+    assert client.delete(f"/video/{original['id']}").status_code == 200
+    assert server.video_store.exists(storage_name)
+    assert db.query_value('blob_ref_count', (storage_name,)) == 1
+
+    assert client.delete(f"/video/{duplicate['id']}").status_code == 200
+    assert not server.video_store.exists(storage_name)
+    assert client.delete(f"/video/{duplicate['id']}").status_code == 404
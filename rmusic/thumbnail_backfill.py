@@ -0,0 +1,249 @@
+"""
+Parallel, resumable thumbnail backfill
+Videos without a thumbnail are processed in a pool of worker processes sized
+to the machine's cores, at most the ffmpeg concurrency limit; the workers take
+their ffmpeg slots from the same host-wide limiter as the server. Results are committed in batches together with the
+run's progress, so an interrupted run continues from the last committed batch.
+A run covers the videos that were missing a thumbnail when it started, up to
+the highest id at that time, so its progress can't pass its total. Videos whose
+thumbnail failed aren't tried again by the same run, not even after a resume;
+the next run picks them up.
+A timer thread renews the run's heartbeat while it works; a run whose
+heartbeat stopped is taken over by the next process that starts or resumes it.
+Videos are read from, and thumbnails saved to, the configured storage backend
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+import layout
+import logs
+import metrics
+import storage
+from media import generate_video_thumbnail, thumbnail_time, FFMPEG_CONCURRENCY
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+BATCH_SIZE = 64  # rows handed to the pool and committed together
+LEASE_SECONDS = 120  # a run without a heartbeat for this long is resumed
+HEARTBEAT_INTERVAL = LEASE_SECONDS / 4  # seconds between heartbeats of a working run
+
+_active_runs = set()
+_runs_lock = threading.Lock()
+_resumed = False
+
+metrics.Gauge(
+    'rmusic_thumbnail_backfill_remaining', 'Videos left in running bulk thumbnail runs',
+    collect=lambda: {(): db.query_value('run_remaining')}
+)
+
+
+def get_run(run_id):
+    """Return run progress as a dict, or None if it doesn't exist"""
+    row = db.query_one('run_get', (run_id,))
+
+    if not row:
+        return None
+
+    run = dict(row)
+    run['percent'] = round(100.0 * run['processed'] / run['total'], 1) if run['total'] else 100.0
+    return run
+
+
+def start_run(upload_folder, thumbnails_folder, on_done=None):
+    """Start a bulk run, or return the one that is already in progress
+
+    A run left behind by a crashed or restarted process is resumed instead
+    of starting over. on_done is called once the run this call launched
+    ends, or right away when it launched none.
+    """
+    launched = False
+    try:
+        now = time.time()
+        with db.transaction(immediate=True):
+            row = db.query_one('run_active')
+
+            if row:
+                run_id, heartbeat = row
+                if run_id in _active_runs or (heartbeat is not None and heartbeat >= now - LEASE_SECONDS):
+                    return run_id
+                # Interrupted run: take it over, unless another process just did
+                if db.execute('run_heartbeat', (now, run_id, heartbeat)).rowcount == 0:
+                    return run_id
+            else:
+                total, max_video_id = db.query_one('videos_missing_thumbnail_range')
+                run_id = db.execute('run_insert', (total, max_video_id, now, now)).lastrowid
+
+        launched = _launch(run_id, upload_folder, thumbnails_folder, now, on_done)
+        return run_id
+    finally:
+        if not launched and on_done:
+            on_done()
+
+
+def resume_interrupted_runs(upload_folder, thumbnails_folder):
+    """Resume a run that was interrupted by a restart (once per process, until that succeeds)"""
+    global _resumed
+    if _resumed:
+        return
+
+    row = db.query_one('run_interrupted', (time.time() - LEASE_SECONDS,))
+
+    if row:
+        logs.info('thumbnail_run_resumed', run_id=row[0])
+        start_run(upload_folder, thumbnails_folder)
+    _resumed = True
+
+
+class _Lease:
+    """Ownership of a run, kept alive by a heartbeat thread
+
+    The heartbeat value written last identifies the owner. Once another
+    process has taken the run over, lost is set and the run's writes match
+    no row.
+    """
+
+    def __init__(self, run_id, heartbeat):
+        self.run_id = run_id
+        self.heartbeat = heartbeat
+        self.lost = False
+        # Held around every write that checks the heartbeat and around the
+        # transactions containing one, so a beat never waits on this run's own write lock
+        self.lock = threading.RLock()
+        self._stopped = threading.Event()
+        threading.Thread(target=self._renew, name=f"thumbnail-run-{run_id}-heartbeat", daemon=True).start()
+
+    def _renew(self):
+        while not self._stopped.wait(HEARTBEAT_INTERVAL):
+            with self.lock:
+                now = time.time()
+                try:
+                    renewed = db.execute('run_heartbeat', (now, self.run_id, self.heartbeat)).rowcount
+                except Exception as e:
+                    # e.g. the database is busy; the next beat tries again
+                    logs.warning('thumbnail_run_heartbeat_failed', run_id=self.run_id, error=str(e))
+                    continue
+                if not renewed:
+                    self.lost = True
+                    logs.warning('thumbnail_run_taken_over', run_id=self.run_id)
+                    return
+                self.heartbeat = now
+
+    def write(self, name, params):
+        """Run a statement ending in (id, heartbeat) for this run; False once the run was lost"""
+        with self.lock:
+            if not self.lost and db.execute(name, (*params, self.run_id, self.heartbeat)).rowcount == 0:
+                self.lost = True
+            return not self.lost
+
+    def stop(self):
+        self._stopped.set()
+
+
+def _launch(run_id, upload_folder, thumbnails_folder, heartbeat, on_done=None):
+    """Run a bulk run in a background thread unless this process already does; True when launched"""
+    with _runs_lock:
+        if run_id in _active_runs:
+            return False
+        _active_runs.add(run_id)
+
+    thread = threading.Thread(
+        target=_run,
+        args=(run_id, upload_folder, thumbnails_folder, heartbeat, on_done),
+        name=f"thumbnail-run-{run_id}",
+        daemon=True
+    )
+    thread.start()
+    return True
+
+
+def _generate_thumbnail(task):
+    """Worker process entry point"""
+    storage_name, video_path, thumb_name, thumb_path, seconds = task
+    return storage_name, thumb_name, generate_video_thumbnail(video_path, thumb_path, seconds)
+
+
+def _next_batch(last_video_id, max_video_id, video_store, thumbnails_folder):
+    rows = db.query_all('videos_missing_thumbnail_after', (last_video_id, max_video_id, BATCH_SIZE))
+
+    tasks = []
+    skipped = 0
+    seen = set()
+    for video_id, storage_name, duration, has_video in rows:
+        # Duplicate uploads share a file, one thumbnail covers all of them
+        if storage_name in seen:
+            continue
+        seen.add(storage_name)
+
+        # has_video is 0 when ffprobe found no video stream to take a frame from
+        if (not storage_name.lower().endswith(VIDEO_EXTENSIONS) or has_video == 0
+                or not video_store.exists(storage_name)):
+            skipped += 1
+            continue
+        thumb_name = f"{os.path.splitext(storage_name)[0]}.jpg"
+        tasks.append((
+            storage_name, video_store.source(storage_name), thumb_name, layout.path(thumbnails_folder, thumb_name),
+            thumbnail_time(duration)
+        ))
+
+    last_id = rows[-1][0] if rows else None
+    return tasks, skipped, len(rows), last_id
+
+
+def _run(run_id, upload_folder, thumbnails_folder, heartbeat, on_done=None):
+    # spawn keeps the workers free of the server's threads and works on every platform;
+    # more workers than ffmpeg slots would only wait for them
+    pool = ProcessPoolExecutor(
+        max_workers=max(1, min(os.cpu_count() or 1, FFMPEG_CONCURRENCY)),
+        mp_context=multiprocessing.get_context('spawn')
+    )
+    lease = _Lease(run_id, heartbeat)
+
+    try:
+        video_store = storage.open_store(upload_folder)
+        thumbnail_store = storage.open_store(thumbnails_folder)
+        last_video_id, max_video_id = db.query_one('run_position', (run_id,))
+        if max_video_id is None:
+            # Started before runs recorded their range
+            max_video_id = db.query_one('videos_missing_thumbnail_range')[1]
+
+        while True:
+            tasks, skipped, row_count, last_id = _next_batch(
+                last_video_id, max_video_id, video_store, thumbnails_folder
+            )
+            if row_count == 0:
+                break
+
+            results = list(pool.map(_generate_thumbnail, tasks))
+            done = [(thumb_name, storage_name) for storage_name, thumb_name, ok in results if ok]
+            failed = len(results) - len(done)
+            for thumb_name, _ in done:
+                thumbnail_store.save(thumb_name, layout.path(thumbnails_folder, thumb_name))
+
+            # Thumbnails and progress are committed together, one transaction per batch
+            with lease.lock, db.transaction():
+                db.executemany('video_set_thumbnail', done)
+                owned = lease.write('run_progress', (row_count, len(done), failed, skipped, last_id))
+            if not owned:
+                # Another process continues the run from its last committed batch
+                return
+
+            last_video_id = last_id
+
+        if lease.write('run_complete', (time.time(),)):
+            logs.info('thumbnail_run_completed', run_id=run_id)
+
+    except Exception as e:
+        lease.write('run_fail', (str(e), time.time()))
+        logs.error('thumbnail_run_failed', run_id=run_id, error=str(e))
+
+    finally:
+        lease.stop()
+        pool.shutdown()
+        with _runs_lock:
+            _active_runs.discard(run_id)
+        if on_done:
+            on_done()
@@ -0,0 +1,158 @@
+"""
+Resumable chunked uploads
+A client opens an upload session, PUTs chunks at byte offsets (in any order and
+several at a time) and finalizes it. Chunks are written straight into a .part
+file at the top of the upload folder, so finalizing is a rename into the file's
+shard and a dropped connection only costs the chunk that was in flight.
+Sessions idle for UPLOAD_SESSION_TTL are expired by the reconcile job, which
+deletes abandoned .part files with them.
+"""
+
+import hashlib
+import os
+import time
+import uuid
+
+import db
+import layout
+
+PART_SUFFIX = '.part'
+READ_SIZE = 1024 * 1024  # bytes read from the request per write
+UPLOAD_SESSION_TTL = int(os.environ.get('RMUSIC_UPLOAD_SESSION_TTL', 24 * 60 * 60))  # seconds without a chunk
+
+
+def part_path(upload_folder, filename):
+    """Path of the file a session writes its chunks into"""
+    return os.path.join(upload_folder, filename + PART_SUFFIX)
+
+
+def merge_ranges(chunks):
+    """Merge (offset, length) chunks into sorted, non-overlapping [offset, length] ranges"""
+    ranges = []
+    for offset, length in sorted(tuple(chunk) for chunk in chunks):
+        if ranges and offset <= ranges[-1][0] + ranges[-1][1]:
+            end = max(ranges[-1][0] + ranges[-1][1], offset + length)
+            ranges[-1][1] = end - ranges[-1][0]
+        else:
+            ranges.append([offset, length])
+    return ranges
+
+
+def save_stream(stream, path):
+    """Write a stream to path, hashing it on the way; returns (size, sha256 hex)"""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as f:
+        while True:
+            block = stream.read(READ_SIZE)
+            if not block:
+                break
+            digest.update(block)
+            f.write(block)
+            size += len(block)
+    return size, digest.hexdigest()
+
+
+def hash_file(path):
+    """SHA-256 hex digest of a file on disk"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_session(original_filename, filename, size, upload_folder):
+    """Open an upload session and preallocate its .part file"""
+    upload_id = uuid.uuid4().hex
+
+    with open(part_path(upload_folder, filename), 'wb') as f:
+        f.truncate(size)
+
+    now = time.time()
+    db.execute('upload_session_insert', (upload_id, original_filename, filename, size, now, now))
+    return get_session(upload_id)
+
+
+def get_session(upload_id):
+    """Return session details with the byte ranges received so far, or None"""
+    row = db.query_one('upload_session_get', (upload_id,))
+    if not row:
+        return None
+
+    session = dict(row)
+    ranges = merge_ranges(db.query_all('upload_chunks_for_session', (upload_id,)))
+    session['ranges'] = ranges
+    session['received_bytes'] = sum(length for _, length in ranges)
+    # Length of the contiguous prefix, the tus Upload-Offset
+    session['offset'] = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+    return session
+
+
+def write_chunk(session, offset, stream, length, upload_folder):
+    """Copy a chunk from the request stream into the .part file at offset
+
+    Returns the number of bytes written; the chunk is only recorded when it
+    arrived complete, so a client can simply send it again.
+    """
+    written = 0
+    with open(part_path(upload_folder, session['filename']), 'r+b') as f:
+        f.seek(offset)
+        while written < length:
+            block = stream.read(min(READ_SIZE, length - written))
+            if not block:
+                break
+            f.write(block)
+            written += len(block)
+
+    if written == length:
+        now = time.time()
+        with db.transaction():
+            db.execute('upload_chunk_insert', (session['id'], offset, length))
+            db.execute('upload_session_touch', (now, session['id']))
+
+    return written
+
+
+def complete(session, upload_folder):
+    """Move a fully received upload into place and return its final path"""
+    final_path = layout.path(upload_folder, session['filename'])
+
+    if session['received_bytes'] != session['size']:
+        raise ValueError(f"Upload incomplete: {session['received_bytes']} of {session['size']} bytes received")
+
+    # A previous finalize may have renamed the file before failing
+    if os.path.exists(part_path(upload_folder, session['filename'])):
+        os.replace(part_path(upload_folder, session['filename']), final_path)
+
+    return final_path
+
+
+def mark_completed(upload_id, video_id):
+    with db.transaction():
+        db.execute('upload_session_complete', (video_id, time.time(), upload_id))
+        db.execute('upload_chunks_delete', (upload_id,))
+
+
+def abort(session, upload_folder):
+    """Delete a session that hasn't been finalized and its partial file"""
+    path = part_path(upload_folder, session['filename'])
+    if os.path.exists(path):
+        os.remove(path)
+
+    with db.transaction():
+        db.execute('upload_chunks_delete', (session['id'],))
+        db.execute('upload_session_delete', (session['id'],))
+
+
+def expire_sessions(upload_folder, ttl=UPLOAD_SESSION_TTL):
+    """Delete sessions idle for ttl seconds, and the .part files of unfinished ones; returns how many"""
+    idle = db.query_all('upload_sessions_idle', (time.time() - ttl,))
+    for upload_id, filename, status in idle:
+        if status != 'completed':
+            abort({'id': upload_id, 'filename': filename}, upload_folder)
+        else:
+            with db.transaction():
+                db.execute('upload_chunks_delete', (upload_id,))
+                db.execute('upload_session_delete', (upload_id,))
+    return len(idle)